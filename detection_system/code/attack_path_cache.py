@@ -0,0 +1,189 @@
+"""This module precomputes to which attacks each host is exposed. A host is exposed to
+    an attack if one of its services has a vulnerability which satisfies a precondition
+    the attack requires or which the attack exploits:
+
+    (Host)<-[:HOSTED_AT]-(Service)-[:HAS_VULNERABILITY]->(Vulnerability)
+    (Attack)-[:REQUIRES]->(Precondition)-[:SATISFIED_BY]->(Vulnerability)
+    (Attack)-[:EXPLOITS]->(Vulnerability)
+
+    The relations are loaded once into adjacency sets and the result is kept as a tuple
+    of attack names per host, so an alert can look up the exposure of a host without a
+    multi hop query. When services or vulnerabilities change only the hosts of the
+    changed services are recomputed.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import sys
+from typing import Iterable, Optional, Set, Tuple
+
+from beartype import beartype
+
+from neo4j_database_access import Neo4jDatabaseAccess
+
+
+class AttackPathCache:
+    """Keeps a summary of the attacks each host is exposed to.
+    """
+
+    @beartype
+    def __init__(self, neo4j_driver: Neo4jDatabaseAccess, persist: bool = True):
+        """Initializes an empty cache, call refresh to load the graph.
+
+        Args:
+            neo4j_driver (Neo4jDatabaseAccess): connection to the graph database
+            persist (bool): if True the summaries are also stored as exposed_to
+            property on the host nodes
+        """
+        self.neo4j_driver = neo4j_driver
+        self.persist = persist
+        self.services_by_host = {}
+        self.hosts_by_service = {}
+        self.vulnerabilities_by_service = {}
+        self.attacks_by_vulnerability = {}
+        self.exposure = {}
+
+    def refresh(self):
+        """Loads all relations from the graph and recomputes the summary of every host.
+        """
+        self.services_by_host = {}
+        self.hosts_by_service = {}
+        self.vulnerabilities_by_service = {}
+        query = ('MATCH (s:Service)-[:HOSTED_AT]->(h:Host) '
+                'RETURN s.name AS service, h.ip_address AS ip_address')
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            self._add_hosted_at(row['service'], row['ip_address'])
+        query = ('MATCH (s:Service)-[:HAS_VULNERABILITY]->(v:Vulnerability) '
+                'RETURN s.name AS service, v.cve_code AS cve_code')
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            self.vulnerabilities_by_service.setdefault(row['service'], set()).add(row['cve_code'])
+        self._load_attacks()
+
+        self._update_hosts(set(self.services_by_host) | set(self.exposure))
+        print(f'Attack paths computed for hosts: {len(self.exposure)}')
+
+    @beartype
+    def refresh_services(self, service_names: Iterable[str]):
+        """Reloads the relations of the given services and recomputes the hosts which
+        hosted them before or host them now.
+
+        Args:
+            service_names (Iterable[str]): names of the changed services
+        """
+        service_names = list(service_names)
+        if not service_names:
+            return
+        affected_hosts = set()
+        for service in service_names:
+            for ip_address in self.hosts_by_service.pop(service, set()):
+                affected_hosts.add(ip_address)
+                self.services_by_host[ip_address].discard(service)
+            self.vulnerabilities_by_service.pop(service, None)
+
+        parameters = {'services': service_names}
+        query = ('MATCH (s:Service)-[:HOSTED_AT]->(h:Host) WHERE s.name IN $services '
+                'RETURN s.name AS service, h.ip_address AS ip_address')
+        for row in self.neo4j_driver.execute_and_return_query_result(query, parameters) or []:
+            self._add_hosted_at(row['service'], row['ip_address'])
+            affected_hosts.add(row['ip_address'])
+        query = ('MATCH (s:Service)-[:HAS_VULNERABILITY]->(v:Vulnerability) WHERE s.name IN $services '
+                'RETURN s.name AS service, v.cve_code AS cve_code')
+        for row in self.neo4j_driver.execute_and_return_query_result(query, parameters) or []:
+            self.vulnerabilities_by_service.setdefault(row['service'], set()).add(row['cve_code'])
+
+        self._update_hosts(affected_hosts)
+
+    def refresh_attacks(self):
+        """Reloads attacks and preconditions. They rarely change so all hosts are recomputed.
+        """
+        self._load_attacks()
+        self._update_hosts(set(self.services_by_host) | set(self.exposure))
+
+    @beartype
+    def host_moved(self, old_ip_address: Optional[str], new_ip_address: Optional[str]):
+        """Moves the summary of a host whose ip address changed.
+
+        Args:
+            old_ip_address (str, optional): previous ip address
+            new_ip_address (str, optional): current ip address
+        """
+        if old_ip_address is None or new_ip_address is None:
+            return
+        services = self.services_by_host.pop(old_ip_address, set())
+        self.services_by_host[new_ip_address] = services
+        for service in services:
+            hosts = self.hosts_by_service[service]
+            hosts.discard(old_ip_address)
+            hosts.add(new_ip_address)
+        self.exposure.pop(old_ip_address, None)
+        self._update_hosts([new_ip_address])
+
+    @beartype
+    def exposed_attacks(self, ip_address: str) -> Tuple[str, ...]:
+        """Returns the attacks a host is exposed to.
+
+        Args:
+            ip_address (str): ip address of the host
+
+        Returns:
+            Tuple[str, ...]: names of the attacks, empty if the host is not exposed
+        """
+        return self.exposure.get(ip_address, ())
+
+    def _load_attacks(self):
+        """Loads which attacks are enabled by which vulnerability.
+        """
+        self.attacks_by_vulnerability = {}
+        query = ('MATCH (a:Attack)-[:REQUIRES]->(:Precondition)-[:SATISFIED_BY]->(v:Vulnerability) '
+                'RETURN a.name AS attack, v.cve_code AS cve_code '
+                'UNION '
+                'MATCH (a:Attack)-[:EXPLOITS]->(v:Vulnerability) '
+                'RETURN a.name AS attack, v.cve_code AS cve_code')
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            self.attacks_by_vulnerability.setdefault(row['cve_code'], set()).add(sys.intern(row['attack']))
+
+    def _add_hosted_at(self, service: str, ip_address: str):
+        """Adds a HOSTED_AT relation to both adjacency sets.
+        """
+        self.services_by_host.setdefault(ip_address, set()).add(service)
+        self.hosts_by_service.setdefault(service, set()).add(ip_address)
+
+    def _compute_host(self, ip_address: str) -> Tuple[str, ...]:
+        """Follows the relations of a single host.
+        """
+        attacks: Set[str] = set()
+        for service in self.services_by_host.get(ip_address, ()):
+            for cve_code in self.vulnerabilities_by_service.get(service, ()):
+                attacks.update(self.attacks_by_vulnerability.get(cve_code, ()))
+        return tuple(sorted(attacks))
+
+    def _update_hosts(self, ip_addresses: Iterable[str]):
+        """Recomputes the summary of the given hosts and stores the ones which changed.
+        """
+        changed = []
+        for ip_address in ip_addresses:
+            attacks = self._compute_host(ip_address)
+            if self.exposure.get(ip_address, ()) == attacks:
+                continue
+            if attacks:
+                self.exposure[ip_address] = attacks
+            else:
+                self.exposure.pop(ip_address, None)
+            changed.append({'ip_address': ip_address, 'exposed_to': list(attacks)})
+        if self.persist and changed:
+            query = ('UNWIND $rows AS row '
+                    'MATCH (h:Host {ip_address: row.ip_address}) '
+                    'SET h.exposed_to = row.exposed_to')
+            self.neo4j_driver.execute_and_return_query_result(query, {'rows': changed})
+
+
+if __name__ == '__main__':
+    NEO4J_URI = 'bolt://localhost:30687'
+    NEO4J_USER = 'neo4j'
+    NEO4J_PASS = '1234'
+    neo4j_driver = Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+    attack_path_cache = AttackPathCache(neo4j_driver)
+    attack_path_cache.refresh()
+    for host_ip, host_attacks in attack_path_cache.exposure.items():
+        print(host_ip, host_attacks)
+    neo4j_driver.close()
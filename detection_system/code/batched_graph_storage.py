@@ -0,0 +1,381 @@
+"""This module collects the mutations of the ingest and writes them to the graph storage
+    in batches. With neo4j a batch is applied in one transaction, so a log line no
+    longer costs a round trip and a commit per mutation.
+
+    A batch is written when it holds BATCH_SIZE mutations or when a background thread
+    finds it older than FLUSH_INTERVAL_SECONDS, so the detection sees the connections
+    of a quiet log after at most that time. The mutations are applied in their order,
+    so the updates of a client keep their order. Reads of the ingest are answered
+    without a query where possible, the other reads and the block and notification
+    updates of the detection write the pending batch first. A batch which fails because
+    the storage is unavailable is written again after a growing delay, the ingest
+    waits meanwhile. After MAX_BATCH_RETRIES or for any other error it is dropped, use
+    write_ahead_spool if no mutation may be lost.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import logging
+import threading
+import time
+from typing import List
+
+from beartype import beartype
+
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+from write_ahead_spool import MAX_RETRY_SECONDS, RETRY_SECONDS, is_transient
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL_SECONDS = 0.5
+# Attempts after the first one to write a batch the storage could not take, about 15 seconds
+MAX_BATCH_RETRIES = 5
+
+BATCHES_WRITTEN = METRICS.counter('ids_batches_written_total', 'Batches of mutations written to the storage')
+BATCH_ERRORS = METRICS.counter('ids_batch_errors_total', 'Batches of mutations the storage failed to write')
+BATCH_RETRIES = METRICS.counter('ids_batch_retries_total', 'Batches written again after a transient error')
+
+
+class BatchedGraphStorage(GraphStorage):
+    """Collects the mutations of a storage and writes them in batches. Reads go to the
+    storage, except the constraint checks of the ingest which are answered locally.
+    """
+
+    @beartype
+    def __init__(self, graph_storage: GraphStorage, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS):
+        """Creates an empty batch.
+
+        Args:
+            graph_storage (GraphStorage): the storage the batches are written to
+            batch_size (int): number of mutations which are written together
+            flush_interval (float): seconds after which a pending batch is written
+        """
+        self.graph_storage = graph_storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.constraints = set()
+        self.flush_status = True
+        self._batch = []
+        self._batch_start = None
+        self._lock = threading.Lock()
+        self._thread = None
+        METRICS.gauge('ids_batch_pending_mutations', 'Mutations of the batch which were not written yet',
+                      function=self.pending)
+
+    def start(self):
+        """Writes old batches in a daemon thread.
+        """
+        self.flush_status = True
+        self._thread = threading.Thread(target=self._start, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and writes the pending batch.
+        """
+        self.flush_status = False
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def close(self):
+        """Writes the pending batch and closes the storage.
+        """
+        self.stop()
+        self.graph_storage.close()
+
+    def flush(self):
+        """Writes the pending batch. Transient errors of the storage are retried with a
+        growing delay, a batch which still fails is dropped, its error is logged.
+        """
+        with self._lock:
+            batch = self._batch
+            self._batch = []
+            self._batch_start = None
+            if not batch:
+                return
+            retry_seconds = RETRY_SECONDS
+            for attempt in range(MAX_BATCH_RETRIES + 1):
+                try:
+                    self.graph_storage.write_batch(batch)
+                    BATCHES_WRITTEN.inc()
+                    return
+                # A failing storage must not stop the ingest
+                except Exception as exception:  # pylint: disable=broad-except
+                    if attempt == MAX_BATCH_RETRIES or not is_transient(exception):
+                        BATCH_ERRORS.inc()
+                        logging.error('Writing a batch of %s mutations raised an error: \n %s', len(batch), exception)
+                        return
+                    BATCH_RETRIES.inc()
+                    logging.error('Writing a batch of %s mutations raised an error, retrying in %s seconds: \n %s',
+                                  len(batch), retry_seconds, exception)
+                time.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+
+    def pending(self) -> int:
+        """Returns the number of mutations which were not written yet.
+
+        Returns:
+            int: size of the pending batch
+        """
+        return len(self._batch)
+
+    def _start(self):
+        """Writes the batch whenever it is older than the flush interval until stop is
+        called.
+        """
+        while self.flush_status is True:
+            time.sleep(self.flush_interval)
+            batch_start = self._batch_start
+            if batch_start is not None and time.monotonic() - batch_start >= self.flush_interval:
+                self.flush()
+
+    def _append(self, method_name: str, *args):
+        """Adds a mutation to the batch and writes the batch if it is full.
+        """
+        with self._lock:
+            if self._batch_start is None:
+                self._batch_start = time.monotonic()
+            self._batch.append((method_name, args))
+            full = len(self._batch) >= self.batch_size
+        if full:
+            self.flush()
+
+    @beartype
+    def create_host(self, host_json: str):
+        """Adds the creation of a host to the batch.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._append('create_host', host_json)
+
+    @beartype
+    def upsert_host(self, host_json: str):
+        """Adds the creation of a host if it does not exist to the batch.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._append('upsert_host', host_json)
+
+    @beartype
+    def create_connection(self, connection_json: str):
+        """Adds the creation of a connection to the batch.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._append('create_connection', connection_json)
+
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        """Adds the creation of a connection if it does not exist to the batch.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._append('upsert_connection', connection_json)
+
+    @beartype
+    def create_service(self, service_json: str):
+        """Creates a service right away, services are only created by the setup.
+
+        Args:
+            service_json (str): data of the service in json format.
+        """
+        self.flush()
+        self.graph_storage.create_service(service_json)
+
+    @beartype
+    def create_edge(self, edge_data: str):
+        """Adds the creation of an edge to the batch.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._append('create_edge', edge_data)
+
+    @beartype
+    def merge_edge(self, edge_data: str):
+        """Adds the creation of an edge if the nodes are not connected yet to the batch.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._append('merge_edge', edge_data)
+
+    @beartype
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Writes the batch and creates the constraint, a schema change can not be part
+        of a transaction with data changes in neo4j.
+
+        Args:
+            node_name (str): name of the node the constraint should be applied on.
+            property_names (List[str]): names of the properties of the constraint.
+        """
+        self.flush()
+        self.graph_storage.create_unique_property_constraint(node_name, property_names)
+        self.constraints.add((node_name, tuple(property_names)))
+
+    @beartype
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Writes the batch and checks the storage if a node exists.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_name (str): name of the property.
+            property_value ([type]): value of the property.
+
+        Returns:
+            bool: True if node exists False otherwise.
+        """
+        self.flush()
+        return self.graph_storage.check_if_node_exists(node_name, property_name, property_value)
+
+    @beartype
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Checks if the constraint was seen before or exists in the storage, only a
+        missing constraint is looked up again.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_names (List[str]): names of the properties of the constraint.
+
+        Returns:
+            bool: True if the constraint exists False otherwise
+        """
+        if (node_name, tuple(property_names)) in self.constraints:
+            return True
+        exists = self.graph_storage.check_if_constraint_exists(node_name, property_names)
+        if exists:
+            self.constraints.add((node_name, tuple(property_names)))
+        return exists
+
+    @beartype
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """Writes the batch and checks the storage if a host is blocked.
+
+        Args:
+            ip_address (str): ip address of host to verify
+
+        Returns:
+            bool: True if host is currently blocked
+        """
+        self.flush()
+        return self.graph_storage.check_if_host_is_blocked(ip_address)
+
+    @beartype
+    def update_connection_status(self, connection_name: str, status: str):
+        """Adds the status update of a connection to the batch.
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            status (str): status to be set for the connection
+        """
+        self._append('update_connection_status', connection_name, status)
+
+    @beartype
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Adds the time update of a connection to the batch.
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            time (str): time of the last update
+        """
+        self._append('update_connnection_time', connection_name, time)
+
+    @beartype
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Writes the batch and updates the block status of a host right away, so the
+        host exists and the block is not delayed.
+
+        Args:
+            ip_address (str): ip_address of the host to be blocked
+            is_blocked (str): state of the block status (True/False)
+        """
+        self.flush()
+        self.graph_storage.update_and_return_host_block(ip_address, is_blocked)
+
+    @beartype
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Writes the batch and updates the notification status of a host right away.
+
+        Args:
+            ip_address (str): ip_address of the host
+            sent (str): state of the notification status (True/False)
+        """
+        self.flush()
+        self.graph_storage.update_and_return_host_notification_sent(ip_address, sent)
+
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Adds the ip address update of a host to the batch.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+        """
+        self._append('update_host_ip_address', old_ip_address, new_ip_address)
+
+    @beartype
+    def update_service_version(self, service_name: str, version: str):
+        """Adds the version update of a service to the batch.
+
+        Args:
+            service_name (str): name of the service
+            version (str): version of the service
+        """
+        self._append('update_service_version', service_name, version)
+
+    @beartype
+    def update_service_port(self, service_name: str, port: str):
+        """Adds the port update of a service to the batch.
+
+        Args:
+            service_name (str): name of the service
+            port (str): port of the service
+        """
+        self._append('update_service_port', service_name, port)
+
+    def count_active_connections_per_host(self):
+        """Writes the batch and counts the active connections in the storage.
+
+        Returns:
+            result (list): a list of dictonaries with the host properties as h and the
+            number of active connections as count
+        """
+        self.flush()
+        return self.graph_storage.count_active_connections_per_host()
+
+    def get_blocked_hosts(self):
+        """Returns the ip addresses of all blocked hosts of the storage.
+
+        Returns:
+            List[str]: the ip addresses
+        """
+        return self.graph_storage.get_blocked_hosts()
+
+    def write_batch(self, mutations: list):
+        """Adds the mutations of another batch to this one.
+
+        Args:
+            mutations (list): name of the method and its arguments
+        """
+        for method_name, args in mutations:
+            self._append(method_name, *args)
+
+
+if __name__ == '__main__':
+    import json
+
+    from in_memory_database_access import InMemoryDatabaseAccess
+
+    example_storage = BatchedGraphStorage(InMemoryDatabaseAccess(), batch_size=10)
+    example_storage.start()
+    example_storage.upsert_host(json.dumps({'ip_address': '127.0.0.1', 'creation_time': '1635015162',
+                                            'is_blocked': 'False', 'notification_sent': 'False'}))
+    example_storage.upsert_connection(json.dumps({'status': 'active', 'name': 'mqtt-explorer-0a61e6f1',
+                                                  'last_update_time': '1635015162'}))
+    print(example_storage.pending(), example_storage.count_active_connections_per_host(), example_storage.pending())
+    example_storage.close()
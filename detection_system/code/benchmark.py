@@ -0,0 +1,286 @@
+"""This module benchmarks the stages of the detection system with synthetic mosquitto
+    logs: parsing with FormatLog, tailing with LocalFileAccess, the write path of the log
+    transformation and a detection pass of the network monitoring. Each stage reports
+    the throughput and the p50 and p99 latency of a single operation. The results are
+    compared with stored baselines and the run fails if a stage got slower than the
+    tolerance allows.
+
+    The graph stages run against the in memory storage by default so the benchmark works
+    without a database. With --backend neo4j the local neo4j instance is used and the graph
+    is purged before the run, never point it to a database which holds data to keep.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List
+
+from beartype import beartype
+
+from format_log import FormatLog
+from local_file_access import LocalFileAccess
+from graph_storage import STORAGE_BACKENDS, create_graph_storage
+from log_generator import MosquittoLogGenerator, LogReplayer
+from mosquitto_log_transformation import MosquittoLogTransformation
+from metrics_endpoint import METRICS
+from network_monitoring import NetworkMonitoring
+from query_profiler import PROFILER
+from stage_timing import STAGE_TIMING
+
+NEO4J_URI = 'bolt://localhost:30687'
+NEO4J_USER = 'neo4j'
+NEO4J_PASS = '1234'
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+# Allowed relative regression of throughput and p99 latency against the baseline
+DEFAULT_TOLERANCE = 0.5
+# Latencies of a few microseconds vary more than the tolerance, smaller differences are ignored
+MIN_LATENCY_SLACK_MS = 0.05
+DEFAULT_LINES = 20000
+DEFAULT_DETECTION_PASSES = 200
+
+
+class DiscardNotification:
+    """Stands in for the AlarmNotification so detection passes do not send emails.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def connect_to_smtp_server(self):
+        """Nothing to connect.
+        """
+
+    def send_email(self, message: str):
+        """Keeps the message instead of sending it.
+        """
+        self.messages.append(message)
+
+    def stop_smtp(self):
+        """Nothing to stop.
+        """
+
+
+@beartype
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Returns the value below which the given fraction of the values lies.
+
+    Args:
+        sorted_values (List[float]): values in ascending order
+        fraction (float): e.g. 0.99 for the p99
+
+    Returns:
+        float: the percentile or 0.0 if there are no values
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+@beartype
+def measure(name: str, operation: Callable, arguments: Iterable) -> Dict:
+    """Calls the operation once for each argument and records the duration of every call.
+
+    Args:
+        name (str): name of the stage
+        operation (Callable): function with a single argument
+        arguments (Iterable): the arguments of the calls
+
+    Returns:
+        Dict: name, operations, seconds, throughput, p50_ms and p99_ms of the stage
+    """
+    durations = []
+    timer = time.perf_counter
+    begin = timer()
+    for argument in arguments:
+        start = timer()
+        operation(argument)
+        durations.append(timer() - start)
+    seconds = timer() - begin
+    durations.sort()
+    return {'name': name,
+            'operations': len(durations),
+            'seconds': round(seconds, 4),
+            'throughput': round(len(durations) / seconds, 1) if seconds > 0 else 0.0,
+            'p50_ms': round(percentile(durations, 0.5) * 1000, 4),
+            'p99_ms': round(percentile(durations, 0.99) * 1000, 4)
+            }
+
+
+class Benchmark:
+    """Runs the stages with the same generated log.
+    """
+
+    @beartype
+    def __init__(self, backend: str = 'memory', n_lines: int = DEFAULT_LINES,
+                 detection_passes: int = DEFAULT_DETECTION_PASSES, seed: int = 0):
+        """Initializes the benchmark and generates the log lines.
+
+        Args:
+            backend (str): a storage backend, memory, sqlite or neo4j for the local instance
+            n_lines (int): number of log lines used by each stage
+            detection_passes (int): number of detection passes
+            seed (int): seed of the log generator
+        """
+        self.backend = backend
+        self.detection_passes = detection_passes
+        generator = MosquittoLogGenerator(start_time=1635015162, seed=seed)
+        self.lines = list(generator.lines('mixed', n_lines))
+
+    def run(self) -> List[Dict]:
+        """Runs all stages.
+
+        Returns:
+            List[Dict]: the result of each stage
+        """
+        neo4j_driver = self._create_driver()
+        try:
+            return [self.bench_format_log(),
+                    self.bench_tail(),
+                    self.bench_write_path(neo4j_driver),
+                    self.bench_detection(neo4j_driver)]
+        finally:
+            neo4j_driver.close()
+
+    def bench_format_log(self) -> Dict:
+        """Measures the extraction of all fields of one line.
+        """
+        log_formatter = FormatLog()
+
+        def parse(line):
+            log_formatter.extract_ip_address_by_row(line)
+            log_formatter.extract_port_number_by_row(line)
+            log_formatter.extract_time_in_seconds_by_row(line)
+            log_formatter.extract_connection_name_by_row(line)
+            log_formatter.extract_version_by_row(line)
+            log_formatter.reset_host_data()
+            log_formatter.reset_connection_data()
+
+        return measure('format_log', parse, self.lines)
+
+    def bench_tail(self) -> Dict:
+        """Measures reading appended lines with the tail of LocalFileAccess. The tail is
+        started on the empty file before the lines are appended, so it only reads them
+        and never waits for the writer.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, 'mosquitto.log'), 'w', encoding='utf-8').close()
+            local_file = LocalFileAccess(directory, 'mosquitto.log')
+            loglines = local_file.tail_file()
+            # The first call seeks to the end of the empty file
+            next(loglines)
+            LogReplayer(os.path.join(directory, 'mosquitto.log')).replay(self.lines)
+            result = measure('tail', lambda _: next(loglines), range(len(self.lines)))
+            local_file.close()
+        return result
+
+    def bench_write_path(self, neo4j_driver) -> Dict:
+        """Measures writing each line to the graph with the log transformation.
+        """
+        log_transformation = MosquittoLogTransformation(neo4j_driver)
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            return measure('write_path', log_transformation.process_line, self.lines)
+
+    def bench_detection(self, neo4j_driver) -> Dict:
+        """Measures detection passes over the graph created by the write path.
+        """
+        network_monitoring = NetworkMonitoring(NEO4J_URI, NEO4J_USER, NEO4J_PASS,
+                                               neo4j_driver=neo4j_driver,
+                                               email_notification=DiscardNotification())
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            return measure('detection', lambda _: network_monitoring.run_detection_pass(),
+                           range(self.detection_passes))
+
+    def _create_driver(self):
+        """Creates an empty graph with the mosquitto service node.
+        """
+        if self.backend == 'sqlite':
+            from sqlite_database_access import SqliteDatabaseAccess
+
+            neo4j_driver = SqliteDatabaseAccess(os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+        else:
+            neo4j_driver = create_graph_storage(self.backend, NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+        if self.backend == 'neo4j':
+            from graph_retention import GraphRetention
+
+            GraphRetention(neo4j_driver).purge_graph()
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            neo4j_driver.create_service(json.dumps({'name': 'Mosquitto', 'port': '1883',
+                                                    'version': '1.6.9', 'protocol': 'MQTT'}))
+        return neo4j_driver
+
+
+@beartype
+def compare_with_baselines(results: List[Dict], baselines: Dict, tolerance: float) -> List[str]:
+    """Compares the results with the baselines of the same backend.
+
+    Args:
+        results (List[Dict]): results of the stages
+        baselines (Dict): throughput and p99_ms of each stage by name
+        tolerance (float): allowed relative regression e.g. 0.5 for 50%
+
+    Returns:
+        List[str]: a description of each regression, empty if there is none
+    """
+    regressions = []
+    for result in results:
+        baseline = baselines.get(result['name'])
+        if baseline is None:
+            continue
+        if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+            regressions.append(f"{result['name']}: throughput {result['throughput']}/s "
+                               f"is below the baseline {baseline['throughput']}/s")
+        if result['p99_ms'] > max(baseline['p99_ms'] * (1 + tolerance),
+                                  baseline['p99_ms'] + MIN_LATENCY_SLACK_MS):
+            regressions.append(f"{result['name']}: p99 {result['p99_ms']}ms "
+                               f"is above the baseline {baseline['p99_ms']}ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the detection system.')
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS, default='memory')
+    parser.add_argument('--lines', type=int, default=DEFAULT_LINES)
+    parser.add_argument('--passes', type=int, default=DEFAULT_DETECTION_PASSES)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--baselines', default=BASELINE_FILE)
+    parser.add_argument('--update-baselines', action='store_true',
+                        help='store the results as new baselines instead of comparing them')
+    arguments = parser.parse_args()
+
+    # Instruments the database access like in production if IDS_METRICS_PORT is set
+    METRICS.start_from_environment()
+    benchmark_results = Benchmark(arguments.backend, arguments.lines, arguments.passes).run()
+    for stage in benchmark_results:
+        print(f"{stage['name']:<12} {stage['operations']:>8} ops {stage['throughput']:>12.1f} ops/s "
+              f"p50 {stage['p50_ms']:>9.4f}ms p99 {stage['p99_ms']:>9.4f}ms")
+    if STAGE_TIMING.enabled:
+        STAGE_TIMING.dump()
+    if PROFILER.enabled and arguments.backend == 'neo4j':
+        PROFILER.dump()
+
+    all_baselines = {}
+    if os.path.exists(arguments.baselines):
+        with open(arguments.baselines, 'r', encoding='utf-8') as baseline_file:
+            all_baselines = json.load(baseline_file)
+    if arguments.update_baselines:
+        all_baselines[arguments.backend] = {stage['name']: {'throughput': stage['throughput'],
+                                                            'p99_ms': stage['p99_ms']}
+                                            for stage in benchmark_results}
+        with open(arguments.baselines, 'w', encoding='utf-8') as baseline_file:
+            json.dump(all_baselines, baseline_file, indent=4)
+        print(f'Stored baselines for backend {arguments.backend}')
+    else:
+        found_regressions = compare_with_baselines(benchmark_results,
+                                                   all_baselines.get(arguments.backend, {}),
+                                                   arguments.tolerance)
+        for regression in found_regressions:
+            print(f'REGRESSION {regression}')
+        if found_regressions:
+            sys.exit(1)
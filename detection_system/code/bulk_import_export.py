@@ -0,0 +1,441 @@
+"""This module turns mosquitto logs into csv files for the neo4j-admin import, the
+    fastest way to create a graph of months of logs from scratch. The lines are
+    processed by the MosquittoLogTransformation like in the running system, but the
+    storage is a CsvExportStorage which records the mutations instead of applying them.
+
+    Every mutation is a row with the key of its node or edge and a sequence number.
+    The rows are collected in chunks which are sorted and written to run files, so
+    the memory stays bounded by the chunk size. The runs are merged, all rows of a key
+    come in order and are folded to the final properties of the node, duplicate edges
+    are dropped. The output are deduplicated node files for Host, Connection and
+    Service and relationship files for STARTS_CONNECTION and CONNECTS_TO.
+
+    Adapted from:
+    https://neo4j.com/docs/operations-manual/4.4/tools/neo4j-admin/neo4j-admin-import/
+    [last accessed April 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import argparse
+import csv
+import heapq
+import json
+import os
+import shutil
+from typing import Iterable, Iterator, List
+
+from beartype import beartype
+
+from graph_storage import GraphStorage
+from mosquitto_log_transformation import MosquittoLogTransformation
+
+CHUNK_ROWS = 200000
+RUN_DIRECTORY = 'runs'
+# File name, header and properties of every node label
+NODE_FILES = {'Host': ('hosts.csv', ('ip_address', 'creation_time', 'notification_sent', 'is_blocked')),
+              'Connection': ('connections.csv', ('name', 'status', 'port', 'last_update_time')),
+              'Service': ('services.csv', ('name', 'port', 'protocol', 'version'))}
+EDGE_FILES = {'STARTS_CONNECTION': ('starts_connection.csv', 'Host', 'Connection'),
+              'CONNECTS_TO': ('connects_to.csv', 'Connection', 'Service')}
+MOSQUITTO_SERVICE = {'name': 'Mosquitto', 'port': '1883', 'version': '1.6.9', 'protocol': 'MQTT'}
+
+
+class ExternalSorter:
+    """Sorts rows of strings which do not fit into memory. Full chunks are sorted and
+    written as csv run files which are merged when the rows are read.
+    """
+
+    def __init__(self, directory: str, name: str, chunk_rows: int = CHUNK_ROWS):
+        self.directory = directory
+        self.name = name
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.runs = []
+
+    def add(self, row: tuple):
+        """Adds a row and writes a run if the chunk is full.
+
+        Args:
+            row (tuple): strings, the rows are sorted by their columns in order
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self._write_run()
+
+    def sorted_rows(self) -> Iterator[tuple]:
+        """Merges the runs and the rows in memory.
+
+        Yields:
+            tuple: the rows in sorted order
+        """
+        self.rows.sort()
+        run_files = [open(path, 'r', encoding='utf-8', newline='') for path in self.runs]
+        try:
+            yield from heapq.merge(self.rows, *[map(tuple, csv.reader(run_file)) for run_file in run_files])
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def _write_run(self):
+        """Sorts the rows of the chunk and writes them to a new run file.
+        """
+        self.rows.sort()
+        path = os.path.join(self.directory, f'{self.name}-{len(self.runs):06d}.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as run_file:
+            csv.writer(run_file).writerows(self.rows)
+        self.runs.append(path)
+        self.rows = []
+
+
+class CsvExportStorage(GraphStorage):
+    """Records the mutations of the log transformation as sortable rows. Nodes are
+    rows of key, sequence number, operation and json properties, edges rows of the
+    keys of their nodes. Reads only know what the export itself needs.
+    """
+
+    def __init__(self, directory: str, chunk_rows: int = CHUNK_ROWS):
+        """Initializes one sorter per node label and edge type.
+
+        Args:
+            directory (str): directory of the run files
+            chunk_rows (int): rows per sorted run
+        """
+        self.sequence = 0
+        self.constraints = set()
+        self.nodes = {label: ExternalSorter(directory, label, chunk_rows) for label in NODE_FILES}
+        self.edges = {edge_name: ExternalSorter(directory, edge_name, chunk_rows) for edge_name in EDGE_FILES}
+
+    def close(self):
+        """Nothing to close, the rows are read by the export.
+        """
+
+    def _node_row(self, label: str, key: str, operation: str, properties: dict):
+        """Records a create or set of node properties.
+        """
+        self.sequence += 1
+        self.nodes[label].add((key, f'{self.sequence:012d}', operation, json.dumps(properties)))
+
+    @beartype
+    def create_host(self, host_json: str):
+        """Records a host.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        host_data = json.loads(host_json)
+        self._node_row('Host', host_data['ip_address'], 'create', host_data)
+
+    @beartype
+    def upsert_host(self, host_json: str):
+        """Records a host, only the first one of an ip address is exported.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self.create_host(host_json)
+
+    @beartype
+    def create_connection(self, connection_json: str):
+        """Records a connection.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        connection_data = json.loads(connection_json)
+        self._node_row('Connection', connection_data['name'], 'create', connection_data)
+
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        """Records a connection, only the first one of a name is exported.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self.create_connection(connection_json)
+
+    @beartype
+    def create_service(self, service_json: str):
+        """Records a service.
+
+        Args:
+            service_json (str): data of the service in json format.
+        """
+        service_data = json.loads(service_json)
+        self._node_row('Service', service_data['name'], 'create', service_data)
+
+    @beartype
+    def create_edge(self, edge_data: str):
+        """Records an edge between two nodes given by their key.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        edge_data = json.loads(edge_data)
+        if edge_data['edge_name'] not in EDGE_FILES:
+            raise ValueError('Edges of type ' + edge_data['edge_name'] + ' are not exported')
+        # The key is the first property of each node description
+        self.edges[edge_data['edge_name']].add((edge_data['node1']['property_values'][0],
+                                                edge_data['node2']['property_values'][0]))
+
+    @beartype
+    def merge_edge(self, edge_data: str):
+        """Records an edge, edges are deduplicated anyway.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self.create_edge(edge_data)
+
+    @beartype
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Remembers the constraint, the import creates no constraints.
+
+        Args:
+            node_name (str): name of the node the constraint should be applied on.
+            property_names (List[str]): names of the properties of the constraint.
+        """
+        self.constraints.add((node_name, tuple(property_names)))
+
+    @beartype
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Nodes are not looked up, creates are deduplicated by the export.
+
+        Returns:
+            bool: always False
+        """
+        return False
+
+    @beartype
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Checks if the constraint was created before.
+
+        Returns:
+            bool: True if the constraint exists False otherwise
+        """
+        return (node_name, tuple(property_names)) in self.constraints
+
+    @beartype
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """No host of a new graph is blocked.
+
+        Returns:
+            bool: always False
+        """
+        return False
+
+    @beartype
+    def update_connection_status(self, connection_name: str, status: str):
+        """Records the status of a connection.
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            status (str): status to be set for the connection
+        """
+        self._node_row('Connection', connection_name, 'set', {'status': status})
+
+    @beartype
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Records the time a connection was last updated.
+
+        Args:
+            connection_name (str): name of the connection
+            time (str): the timestamp to set
+        """
+        self._node_row('Connection', connection_name, 'set', {'last_update_time': time})
+
+    @beartype
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Records the block status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host to be blocked
+            is_blocked (str): state of the block status (True/False)
+        """
+        self._node_row('Host', ip_address, 'set', {'is_blocked': is_blocked})
+
+    @beartype
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Records the notification status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host
+            sent (str): state of the notification status (True/False)
+        """
+        self._node_row('Host', ip_address, 'set', {'notification_sent': sent})
+
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """The ip address is the key of the rows of a host and its edges, a host can
+        only be moved in the imported graph.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+
+        Raises:
+            ValueError: always, the keys of the export can not change
+        """
+        raise ValueError('The csv export can not move the host ' + old_ip_address + ' to ' + new_ip_address
+                         + ', move it after the import')
+
+    @beartype
+    def update_service_version(self, service_name: str, version: str):
+        """Records the version of a service.
+
+        Args:
+            service_name (str): name of the service
+            version (str): version of the service
+        """
+        self._node_row('Service', service_name, 'set', {'version': version})
+
+    @beartype
+    def update_service_port(self, service_name: str, port: str):
+        """Records the port of a service.
+
+        Args:
+            service_name (str): name of the service
+            port (str): port of the service
+        """
+        self._node_row('Service', service_name, 'set', {'port': port})
+
+    def count_active_connections_per_host(self):
+        """The export does not keep the graph, the detection runs on the imported one.
+
+        Returns:
+            List[dict]: an empty list
+        """
+        return []
+
+    def get_blocked_hosts(self):
+        """No host of a new graph is blocked.
+
+        Returns:
+            List[str]: an empty list
+        """
+        return []
+
+
+class BulkImportExport:
+    """Writes the csv files of the neo4j-admin import for mosquitto logs.
+    """
+
+    @beartype
+    def __init__(self, output_directory: str, chunk_rows: int = CHUNK_ROWS):
+        """Initializes the export.
+
+        Args:
+            output_directory (str): directory of the csv files
+            chunk_rows (int): rows which are sorted in memory at once
+        """
+        self.output_directory = output_directory
+        self.chunk_rows = chunk_rows
+
+    @beartype
+    def export(self, lines: Iterable[str]) -> dict:
+        """Processes the lines and writes the node and relationship files.
+
+        Args:
+            lines (Iterable[str]): lines of mosquitto logs in the order they were written
+
+        Returns:
+            dict: number of rows written by file name
+        """
+        run_directory = os.path.join(self.output_directory, RUN_DIRECTORY)
+        os.makedirs(run_directory, exist_ok=True)
+        try:
+            export_storage = CsvExportStorage(run_directory, self.chunk_rows)
+            export_storage.create_service(json.dumps(MOSQUITTO_SERVICE))
+            log_transformation = MosquittoLogTransformation(export_storage)
+            for line in lines:
+                log_transformation.process_line(line)
+            counts = {}
+            for label, (file_name, property_names) in NODE_FILES.items():
+                counts[file_name] = self._write_nodes(export_storage.nodes[label], label, file_name,
+                                                      property_names)
+            for edge_name, (file_name, start_label, end_label) in EDGE_FILES.items():
+                counts[file_name] = self._write_edges(export_storage.edges[edge_name], edge_name, file_name,
+                                                      start_label, end_label)
+            return counts
+        finally:
+            shutil.rmtree(run_directory, ignore_errors=True)
+
+    def import_command(self) -> str:
+        """Returns the neo4j-admin command which imports the written files.
+
+        Returns:
+            str: the command line
+        """
+        arguments = [f'--nodes={label}={os.path.join(self.output_directory, file_name)}'
+                     for label, (file_name, _) in NODE_FILES.items()]
+        arguments += [f'--relationships={edge_name}={os.path.join(self.output_directory, file_name)}'
+                      for edge_name, (file_name, _, _) in EDGE_FILES.items()]
+        return 'neo4j-admin import --database=neo4j ' + ' '.join(arguments)
+
+    def _write_nodes(self, sorter: ExternalSorter, label: str, file_name: str, property_names: tuple) -> int:
+        """Folds the rows of every key to the final properties and writes one line per
+        node. The key is the ID of the node.
+        """
+        header = [property_names[0] + ':ID(' + label + ')'] + list(property_names[1:])
+        written = 0
+        with open(os.path.join(self.output_directory, file_name), 'w', encoding='utf-8', newline='') as node_file:
+            writer = csv.writer(node_file)
+            writer.writerow(header)
+            key, properties = None, None
+            for row_key, _, operation, row_properties in sorter.sorted_rows():
+                if row_key != key:
+                    if properties is not None:
+                        writer.writerow([properties.get(name) for name in property_names])
+                        written += 1
+                    key, properties = row_key, None
+                # Like MERGE the first create wins, like MATCH ... SET a set needs the node
+                if operation == 'create' and properties is None:
+                    properties = json.loads(row_properties)
+                elif operation == 'set' and properties is not None:
+                    properties.update(json.loads(row_properties))
+            if properties is not None:
+                writer.writerow([properties.get(name) for name in property_names])
+                written += 1
+        return written
+
+    def _write_edges(self, sorter: ExternalSorter, edge_name: str, file_name: str, start_label: str,
+                     end_label: str) -> int:
+        """Writes every pair of node keys once.
+        """
+        written = 0
+        with open(os.path.join(self.output_directory, file_name), 'w', encoding='utf-8', newline='') as edge_file:
+            writer = csv.writer(edge_file)
+            writer.writerow([':START_ID(' + start_label + ')', ':END_ID(' + end_label + ')', ':TYPE'])
+            previous = None
+            for row in sorter.sorted_rows():
+                if row != previous:
+                    writer.writerow([row[0], row[1], edge_name])
+                    written += 1
+                    previous = row
+        return written
+
+
+def read_lines(paths: List[str]) -> Iterator[str]:
+    """Streams the lines of the log files in the given order.
+
+    Args:
+        paths (List[str]): paths of the log files
+
+    Yields:
+        str: one line
+    """
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', errors='replace') as log_file:
+            yield from log_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes mosquitto logs as csv files for neo4j-admin import')
+    parser.add_argument('logs', nargs='+', help='mosquitto log files, oldest first')
+    parser.add_argument('--output', default='import', help='directory of the csv files')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows sorted in memory at once')
+    arguments = parser.parse_args()
+    bulk_export = BulkImportExport(arguments.output, arguments.chunk_rows)
+    for exported_file, row_count in bulk_export.export(read_lines(arguments.logs)).items():
+        print(f'{exported_file}: {row_count} rows')
+    print(bulk_export.import_command())
@@ -0,0 +1,164 @@
+"""This module builds the allowlist of the MQTT clients which are expected in the
+    deployment from the Node-RED flows of the rooms. Every mqtt-broker node of a flow
+    which is used by an mqtt in or mqtt out node is a client of the broker:
+
+    - a client id set in the node is allowed exactly
+    - an empty client id is generated by Node-RED as nodered_ and random hex digits,
+      so the prefix nodered_ is allowed
+
+    The endpoints the clients connect to (broker and port) are kept as well, the
+    mosquitto log does not name the endpoint of a connect, so they are only reported.
+    A lookup is a set lookup and one startswith over the prefixes, so it is cheap
+    enough for every connect. The log transformation writes the edge of a known client
+    to the service once and skips it on the reconnects, and the sessions of unknown
+    client ids are counted and reported as soon as they connect. The flows are read
+    from IDS_FLOW_FILES, comma separated glob patterns, or from the backups of the
+    rooms and the test environment.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import glob
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Set
+
+from beartype import beartype
+
+from connection_sessionizer import ConnectionSessionizer, SessionEvent
+from metrics_endpoint import METRICS
+
+FLOW_FILES_VARIABLE = 'IDS_FLOW_FILES'
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_FLOW_FILES = (os.path.join(REPOSITORY_ROOT, 'app_deployments', 'rooms', '*', 'room*_flow_backup', 'flows.json'),
+                      os.path.join(REPOSITORY_ROOT, 'test_enviornment', 'node_red_backup', 'flows.json'))
+# Prefix of the client ids Node-RED generates if the broker node has none
+NODE_RED_PREFIX = 'nodered_'
+# Unknown client ids which are remembered and printed, the others are only counted
+MAX_UNKNOWN_CLIENTS = 1000
+
+CLIENT_SESSIONS = METRICS.counter('ids_client_sessions_total', 'Opened sessions by allowlist result', 'client')
+
+
+class ClientAllowlist:
+    """The expected client ids and prefixes of client ids and their broker endpoints.
+    """
+
+    def __init__(self, client_ids: Iterable[str] = (), prefixes: Iterable[str] = (),
+                 endpoints: Iterable[str] = ()) -> None:
+        """Creates the allowlist.
+
+        Args:
+            client_ids (Iterable[str]): client ids which are allowed exactly
+            prefixes (Iterable[str]): prefixes of generated client ids
+            endpoints (Iterable[str]): broker and port the clients connect to, e.g.
+            10.152.183.248:1883
+        """
+        self.client_ids = set(client_ids)
+        self.prefixes = tuple(sorted(set(prefixes)))
+        self.endpoints = set(endpoints)
+        # Unknown client id -> number of sessions, in the order they were seen first
+        self.unknown_clients = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.client_ids) + len(self.prefixes)
+
+    @classmethod
+    @beartype
+    def from_flows(cls, patterns: Optional[List[str]] = None) -> 'ClientAllowlist':
+        """Reads the clients of all flow files.
+
+        Args:
+            patterns (List[str], optional): glob patterns of the flows.json files,
+            IDS_FLOW_FILES or the backups of the repository if not set
+
+        Returns:
+            ClientAllowlist: the allowlist of the flows
+        """
+        if patterns is None:
+            value = os.environ.get(FLOW_FILES_VARIABLE)
+            patterns = [pattern.strip() for pattern in value.split(',')] if value else list(DEFAULT_FLOW_FILES)
+        client_ids, prefixes, endpoints = set(), set(), set()
+        for file_path in sorted({path for pattern in patterns for path in glob.glob(pattern)}):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as flow_file:
+                    nodes = json.load(flow_file)
+            # A broken backup must not stop the ingest, its clients are unknown
+            except (OSError, ValueError) as exception:
+                logging.error('Reading the flow %s raised an error: \n %s', file_path, exception)
+                continue
+            used_brokers = {node.get('broker') for node in nodes if node.get('type') in ('mqtt in', 'mqtt out')}
+            for node in nodes:
+                if node.get('type') != 'mqtt-broker' or node.get('id') not in used_brokers:
+                    continue
+                if node.get('clientid'):
+                    client_ids.add(node['clientid'])
+                else:
+                    prefixes.add(NODE_RED_PREFIX)
+                endpoints.add(str(node.get('broker')) + ':' + str(node.get('port') or '1883'))
+        return cls(client_ids, prefixes, endpoints)
+
+    def is_known(self, client_id: Optional[str]) -> bool:
+        """Checks if a client id is expected in the deployment.
+
+        Args:
+            client_id (str): id the client connected with
+
+        Returns:
+            bool: True if the id or its prefix is on the allowlist
+        """
+        if not client_id:
+            return False
+        return client_id in self.client_ids or (bool(self.prefixes) and client_id.startswith(self.prefixes))
+
+    @beartype
+    def observe(self, sessionizer: ConnectionSessionizer):
+        """Checks the client of every session the sessionizer opens.
+
+        Args:
+            sessionizer (ConnectionSessionizer): the sessionizer of the log transformation
+        """
+        sessionizer.add_listener(self.process_event)
+
+    @beartype
+    def process_event(self, event: SessionEvent):
+        """Counts an opened session as known or unknown, an unknown client id is
+        printed when it connects the first time.
+
+        Args:
+            event (SessionEvent): event of the sessionizer
+        """
+        if event.kind != 'opened':
+            return
+        client_id = event.session.client_id
+        if self.is_known(client_id):
+            CLIENT_SESSIONS.inc(label_value='known')
+            return
+        CLIENT_SESSIONS.inc(label_value='unknown')
+        if client_id in self.unknown_clients:
+            self.unknown_clients[client_id] += 1
+        elif len(self.unknown_clients) < MAX_UNKNOWN_CLIENTS:
+            self.unknown_clients[client_id] = 1
+            print(f'Unknown client {client_id} connected from {event.session.ip_address}')
+
+    def unknown(self) -> Set[str]:
+        """Returns the unknown client ids which were seen.
+
+        Returns:
+            Set[str]: the client ids, at most MAX_UNKNOWN_CLIENTS
+        """
+        return set(self.unknown_clients)
+
+
+if __name__ == '__main__':
+    from log_generator import MosquittoLogGenerator
+
+    example_allowlist = ClientAllowlist.from_flows()
+    print(example_allowlist.client_ids, example_allowlist.prefixes, example_allowlist.endpoints)
+    example_sessionizer = ConnectionSessionizer()
+    example_allowlist.observe(example_sessionizer)
+    for example_line in MosquittoLogGenerator(seed=0).lines('mixed', 2000):
+        example_sessionizer.process_line(example_line)
+    print(len(example_allowlist.unknown()), 'unknown clients')
@@ -0,0 +1,294 @@
+"""This module provides the compact encodings of the state the detection system keeps in
+    the process. An ip address is an integer instead of a dotted string, 32 bit for
+    IPv4 and 128 bit with an additional flag bit for IPv6, so both never collide.
+    Names which are referenced many times, like the client ids of the connections, are
+    interned once in a symbol table and referenced by their dense number, which is also
+    the index into arrays holding their properties.
+
+    Strings are only produced again at the boundaries, when the graph is written or an
+    alert is sent.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import socket
+from array import array
+from typing import Hashable, Iterator, Optional, Union
+
+IPV6_FLAG = 1 << 128
+# Markers of the integer columns, the values are far outside of timestamps and ports
+MISSING = -2 ** 63
+UNENCODED = MISSING + 1
+
+
+def ip_to_int(ip_address: str) -> int:
+    """Encodes an ip address as integer.
+
+    Args:
+        ip_address (str): IPv4 or IPv6 address
+
+    Raises:
+        ValueError: if the string is no ip address
+
+    Returns:
+        int: the address, IPv6 addresses have the IPV6_FLAG bit set
+    """
+    try:
+        if ':' in ip_address:
+            return IPV6_FLAG | int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big')
+        # inet_aton also accepts short forms like 10.1, only dotted quads are addresses
+        if ip_address.count('.') != 3:
+            raise ValueError(ip_address)
+        return int.from_bytes(socket.inet_aton(ip_address), 'big')
+    except OSError as exception:
+        raise ValueError('Not an ip address: ' + ip_address) from exception
+
+
+def int_to_ip(value: int) -> str:
+    """Decodes an integer of ip_to_int.
+
+    Args:
+        value (int): the encoded address
+
+    Returns:
+        str: the address in its usual notation
+    """
+    if value & IPV6_FLAG:
+        return socket.inet_ntop(socket.AF_INET6, (value ^ IPV6_FLAG).to_bytes(16, 'big'))
+    return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+
+def ip_key(ip_address) -> Union[int, str]:
+    """Returns the key of an ip address in the indexes. Only addresses in their usual
+    notation are encoded, anything else stays a string, so two different strings never
+    get the same key.
+
+    Args:
+        ip_address: ip address of a host
+
+    Returns:
+        Union[int, str]: the encoded address or the unchanged value
+    """
+    # Called for every line, so the packed bytes are compared instead of decoding the integer
+    try:
+        if ':' in ip_address:
+            packed = socket.inet_pton(socket.AF_INET6, ip_address)
+            if socket.inet_ntop(socket.AF_INET6, packed) != ip_address:
+                return ip_address
+            return IPV6_FLAG | int.from_bytes(packed, 'big')
+        packed = socket.inet_aton(ip_address)
+    except (OSError, TypeError):
+        return ip_address
+    return int.from_bytes(packed, 'big') if socket.inet_ntoa(packed) == ip_address else ip_address
+
+
+def ip_from_key(key: Union[int, str]) -> str:
+    """Returns the ip address of a key of ip_key.
+
+    Args:
+        key (Union[int, str]): the key
+
+    Returns:
+        str: the ip address
+    """
+    return int_to_ip(key) if isinstance(key, int) else key
+
+
+class SymbolTable:
+    """Assigns every distinct name a dense number in the order of first use. The numbers
+    index the arrays which hold the properties of the named objects.
+    """
+
+    def __init__(self):
+        self.numbers = {}
+        self.names = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: Hashable) -> bool:
+        return name in self.numbers
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.names)
+
+    def intern(self, name: Hashable) -> int:
+        """Returns the number of a name, a new name gets the next number.
+
+        Args:
+            name (str): e.g. a client id
+
+        Returns:
+            int: the number of the name
+        """
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.names)
+            self.names.append(name)
+        return number
+
+    def number(self, name: Hashable) -> Optional[int]:
+        """Returns the number of a name without interning it.
+
+        Args:
+            name (str): e.g. a client id
+
+        Returns:
+            int: the number or None if the name is unknown
+        """
+        return self.numbers.get(name)
+
+    def name(self, number: int) -> Hashable:
+        """Returns the name of a number.
+
+        Args:
+            number (int): a number returned by intern
+
+        Returns:
+            Hashable: the name
+        """
+        return self.names[number]
+
+
+class SymbolColumn:
+    """A property of numbered nodes with few distinct values, like a status or a flag.
+    Each row is the number of its value in a symbol table.
+    """
+
+    def __init__(self, symbols: Optional[SymbolTable] = None):
+        """Creates an empty column.
+
+        Args:
+            symbols (SymbolTable, optional): table shared with other columns
+        """
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.numbers = array('l')
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __getitem__(self, row: int):
+        return self.symbols.names[self.numbers[row]]
+
+    def __setitem__(self, row: int, value):
+        self.numbers[row] = self.symbols.intern(value)
+
+    def append(self, value):
+        """Adds a row.
+
+        Args:
+            value: the value of the new row
+        """
+        self.numbers.append(self.symbols.intern(value))
+
+    def code(self, value) -> Optional[int]:
+        """Returns the number of a value, rows can be compared with it without decoding.
+
+        Args:
+            value: e.g. 'True'
+
+        Returns:
+            int: the number or None if no row ever had the value
+        """
+        return self.symbols.number(value)
+
+
+class IntegerColumn:
+    """A property of numbered nodes which holds numbers as strings, like a timestamp.
+    The rows are 64 bit integers, values which do not convert back to the same string
+    are kept in a dictonary.
+    """
+
+    def __init__(self):
+        """Creates an empty column.
+        """
+        self.values = array('q')
+        self.unencoded = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, row: int):
+        value = self.values[row]
+        if value == MISSING:
+            return None
+        if value == UNENCODED:
+            return self.unencoded[row]
+        return str(value)
+
+    def __setitem__(self, row: int, value):
+        self.unencoded.pop(row, None)
+        self.values[row] = self._encode(row, value)
+
+    def append(self, value):
+        """Adds a row.
+
+        Args:
+            value: the value of the new row
+        """
+        self.values.append(self._encode(len(self.values), value))
+
+    def _encode(self, row: int, value) -> int:
+        """Returns the integer of a value, other values are stored in the dictonary.
+        """
+        if value is None:
+            return MISSING
+        if isinstance(value, str) and value.isdecimal() and len(value) < 19 and str(int(value)) == value:
+            return int(value)
+        self.unencoded[row] = value
+        return UNENCODED
+
+
+class AddressColumn:
+    """The ip addresses of numbered nodes. IPv4 addresses are 32 bit rows, other values
+    are kept in a dictonary.
+    """
+
+    def __init__(self):
+        """Creates an empty column.
+        """
+        self.values = array('q')
+        self.unencoded = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, row: int):
+        value = self.values[row]
+        if value == UNENCODED:
+            return self.unencoded[row]
+        return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+    def __setitem__(self, row: int, value):
+        self.unencoded.pop(row, None)
+        self.values[row] = self._encode(row, value)
+
+    def append(self, value):
+        """Adds a row.
+
+        Args:
+            value: the ip address of the new row
+        """
+        self.values.append(self._encode(len(self.values), value))
+
+    def _encode(self, row: int, value) -> int:
+        """Returns the integer of an IPv4 address, other values are stored in the
+        dictonary.
+        """
+        key = ip_key(value)
+        if isinstance(key, int) and not key & IPV6_FLAG:
+            return key
+        self.unencoded[row] = value
+        return UNENCODED
+
+
+if __name__ == '__main__':
+    for example_address in ('10.244.0.12', '2001:db8::1'):
+        example_value = ip_to_int(example_address)
+        print(example_address, example_value, int_to_ip(example_value))
+    example_symbols = SymbolTable()
+    print([example_symbols.intern(client_id) for client_id in ('nodered_1', 'mqttsa-2', 'nodered_1')])
+    example_column = IntegerColumn()
+    for example_time in ('1635015162', None, 'unknown'):
+        example_column.append(example_time)
+    print([example_column[row] for row in range(len(example_column))], example_column.values)
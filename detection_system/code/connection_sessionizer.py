@@ -0,0 +1,202 @@
+"""This module correlates the lines mosquitto writes for one client. A client shows up
+    in up to three lines, only the first two contain its ip address:
+
+    1635015162: New connection from 10.244.0.12 on port 1883.
+    1635015162: New client connected from 10.244.0.12 as nodered_3f2a9c1e (p2, c1, k60).
+    1635015170: Client nodered_3f2a9c1e disconnected.
+
+    The sessionizer keeps the open sockets per ip address and one compact session per
+    connected client id. Sockets which never send a CONNECT are bounded per ip address
+    and the ip address without a new socket for the longest time is dropped once
+    MAX_PENDING_ADDRESSES have open sockets, so a scan from many addresses can not grow
+    the table. Ip addresses are kept as integers and ports and timestamps as
+    numbers, the ip address string is only created again for the events. Every
+    transition is a dictonary operation, so the ip address of a disconnect is known
+    without a database lookup. Opened and closed sessions are
+    returned as events with source ip, duration and the reason of the disconnect and
+    passed to the listeners, e.g. the metrics of the session durations.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import re
+from collections import deque
+from typing import Callable, Optional, Union
+
+from beartype import beartype
+
+from compact_state import ip_from_key, ip_key
+from metrics_endpoint import METRICS
+
+NEW_CONNECTION = re.compile(r'^(\d+): New connection from (\S+) on port (\d+)\.')
+CLIENT_CONNECTED = re.compile(r'^(\d+): New client connected from (\S+) as (\S+)')
+CLIENT_DISCONNECTED = re.compile(r'^(\d+): (?:Client (\S+) (disconnected)\.'
+                                 r'|Client (\S+) has exceeded (timeout), disconnecting\.'
+                                 r'|Socket (error) on client ([^\s,]+), disconnecting\.)')
+ALREADY_CONNECTED = re.compile(r'^(\d+): Client (\S+) already connected, closing old connection\.')
+# Sockets of an ip address which did not send a CONNECT yet, older ones are dropped
+MAX_PENDING_SOCKETS = 64
+# Ip addresses with open sockets, the one without a new socket for the longest time is dropped
+MAX_PENDING_ADDRESSES = 10000
+DISCONNECT_REASONS = {'disconnected': 'disconnected', 'timeout': 'timeout', 'error': 'socket_error'}
+
+SESSION_DURATION = METRICS.histogram('ids_session_duration_seconds', 'Duration of closed client sessions',
+                                     'reason', buckets=(1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 21600.0, 86400.0))
+PENDING_SOCKETS_DROPPED = METRICS.counter('ids_pending_sockets_dropped_total',
+                                          'Open sockets dropped with their ip address before a CONNECT')
+
+
+class Session:
+    """A connected client with the socket it was accepted on. The address is the key of
+    compact_state.ip_key.
+    """
+    __slots__ = ('client_id', 'address', 'port', 'opened', 'connected')
+
+    def __init__(self, client_id: str, address: Union[int, str], port: Optional[int], opened: int,
+                 connected: int):
+        self.client_id = client_id
+        self.address = address
+        self.port = port
+        self.opened = opened
+        self.connected = connected
+
+    @property
+    def ip_address(self) -> str:
+        """The ip address the client connected from.
+        """
+        return ip_from_key(self.address)
+
+
+class SessionEvent:
+    """A session which was opened or closed.
+    """
+    __slots__ = ('kind', 'session', 'closed', 'reason')
+
+    def __init__(self, kind: str, session: Session, closed: Optional[int] = None, reason: Optional[str] = None):
+        self.kind = kind
+        self.session = session
+        self.closed = closed
+        self.reason = reason
+
+    @property
+    def duration(self) -> Optional[int]:
+        """Seconds from the accepted socket until the session was closed.
+        """
+        if self.closed is None:
+            return None
+        return self.closed - self.session.opened
+
+
+class ConnectionSessionizer:
+    """Keeps the open sockets and the live sessions of the broker.
+    """
+
+    def __init__(self):
+        """Starts without sessions, clients which connected before the log was read are
+        only known once they connect again.
+        """
+        self.pending_sockets = {}
+        self.sessions = {}
+        self.listeners = []
+        METRICS.gauge('ids_live_sessions', 'Connected clients known to the sessionizer',
+                      function=lambda: len(self.sessions))
+
+    @beartype
+    def add_listener(self, listener: Callable[[SessionEvent], None]):
+        """Registers a function which gets every opened and closed session.
+
+        Args:
+            listener (Callable[[SessionEvent], None]): e.g. a downstream stage
+        """
+        self.listeners.append(listener)
+
+    @beartype
+    def process_line(self, current_line: str) -> Optional[SessionEvent]:
+        """Applies one log line to the session table.
+
+        Args:
+            current_line (str): one row of the log file
+
+        Returns:
+            SessionEvent: the opened or closed session or None for other lines
+        """
+        if ' New c' in current_line:
+            match = NEW_CONNECTION.match(current_line)
+            if match is not None:
+                address = ip_key(match.group(2))
+                # Inserted again, so the dictonary is ordered by the last socket of the address
+                sockets = self.pending_sockets.pop(address, None)
+                if sockets is None:
+                    sockets = deque(maxlen=MAX_PENDING_SOCKETS)
+                    if len(self.pending_sockets) >= MAX_PENDING_ADDRESSES:
+                        PENDING_SOCKETS_DROPPED.inc(len(self.pending_sockets.pop(next(iter(self.pending_sockets)))))
+                self.pending_sockets[address] = sockets
+                sockets.append((int(match.group(1)), int(match.group(3))))
+                return None
+            match = CLIENT_CONNECTED.match(current_line)
+            if match is not None:
+                return self._open(int(match.group(1)), ip_key(match.group(2)), match.group(3))
+            return None
+        if 'connect' in current_line:
+            match = CLIENT_DISCONNECTED.match(current_line)
+            if match is not None:
+                client_id = match.group(2) or match.group(4) or match.group(7)
+                reason = match.group(3) or match.group(5) or match.group(6)
+                return self._close(client_id, int(match.group(1)), DISCONNECT_REASONS[reason])
+            match = ALREADY_CONNECTED.match(current_line)
+            if match is not None:
+                return self._close(match.group(2), int(match.group(1)), 'taken_over')
+        return None
+
+    @beartype
+    def session(self, client_id: str) -> Optional[Session]:
+        """Returns the live session of a client.
+
+        Args:
+            client_id (str): id the client connected with
+
+        Returns:
+            Session: the session or None if the client is not connected
+        """
+        return self.sessions.get(client_id)
+
+    def _open(self, connected: int, address: Union[int, str], client_id: str) -> SessionEvent:
+        """Moves the oldest open socket of the ip address into a new session.
+        """
+        sockets = self.pending_sockets.get(address)
+        if sockets:
+            opened, port = sockets.popleft()
+            if not sockets:
+                del self.pending_sockets[address]
+        else:
+            opened, port = connected, None
+        # The broker closes the old connection of a reused client id
+        self._close(client_id, connected, 'taken_over')
+        session = self.sessions[client_id] = Session(client_id, address, port, opened, connected)
+        return self._emit(SessionEvent('opened', session))
+
+    def _close(self, client_id: str, closed: int, reason: str) -> Optional[SessionEvent]:
+        """Removes the session of the client.
+        """
+        session = self.sessions.pop(client_id, None)
+        if session is None:
+            return None
+        SESSION_DURATION.observe(max(0, closed - session.opened), reason)
+        return self._emit(SessionEvent('closed', session, closed, reason))
+
+    def _emit(self, event: SessionEvent) -> SessionEvent:
+        """Passes the event to all listeners.
+        """
+        for listener in self.listeners:
+            listener(event)
+        return event
+
+
+if __name__ == '__main__':
+    example_sessionizer = ConnectionSessionizer()
+    example_sessionizer.add_listener(lambda event: print(event.kind, event.session.client_id,
+                                                         event.session.ip_address, event.duration, event.reason))
+    for example_line in ('1635015162: New connection from 10.244.0.12 on port 1883.\n',
+                         '1635015162: New client connected from 10.244.0.12 as nodered_3f2a9c1e (p2, c1, k60).\n',
+                         '1635015170: Client nodered_3f2a9c1e disconnected.\n'):
+        example_sessionizer.process_line(example_line)
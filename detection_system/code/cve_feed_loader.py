@@ -0,0 +1,403 @@
+"""This module loads vulnerabilities from offline NVD json feed files into the graph.
+    The feeds are streamed item by item so files with hundreds of thousands of CVEs never
+    have to be loaded into memory at once. The affected version ranges are collected in
+    an interval index by product, afterwards each service node is matched against the
+    index with a single lookup. Only vulnerabilities and HAS_VULNERABILITY edges which
+    changed since the last run are written. Only the edges of the vulnerabilities in
+    the loaded feeds are deleted, so loading one yearly or modified feed keeps the
+    edges of the feeds which were loaded before.
+
+    Supports the legacy 1.1 feeds (CVE_Items) and the 2.0 feeds (vulnerabilities), plain
+    or gzip compressed.
+    Feeds: https://nvd.nist.gov/vuln/data-feeds [last accessed March 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import re
+import sys
+import gzip
+import json
+import hashlib
+import logging
+from bisect import bisect_right
+from typing import List, Set, Tuple
+
+from beartype import beartype
+
+from neo4j_database_access import Neo4jDatabaseAccess
+
+NEO4J_URI = 'bolt://localhost:30687'
+NEO4J_USER = 'neo4j'
+NEO4J_PASS = '1234'
+FEED_ARRAY_KEYS = ('"CVE_Items"', '"vulnerabilities"')
+READ_CHUNK_SIZE = 1024 * 1024
+DEFAULT_BATCH_SIZE = 1000
+FEED_SOURCE = 'nvd'
+# Maps the names used for service nodes to the product names used in CPE strings
+SERVICE_PRODUCTS = {'apache web server': 'http_server',
+                    'mosquitto': 'mosquitto',
+                    'neo4j': 'neo4j'
+                    }
+UUID_SUFFIX = re.compile(r'-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+VERSION_NUMBERS = re.compile(r'\d+')
+UNBOUNDED_END = (float('inf'),)
+
+
+@beartype
+def parse_version(version: str) -> tuple:
+    """Converts a version string to a tuple of numbers which compares in version order.
+    Text after the numeric part is ignored e.g. 4.3.6-enterprise -> (4, 3, 6) and
+    trailing zeros are removed so 2.4 and 2.4.0 are equal.
+
+    Args:
+        version (str): version string
+
+    Returns:
+        tuple: the version numbers
+    """
+    numeric_part = re.match(r'[\d.]*', version).group(0)
+    numbers = [int(number) for number in VERSION_NUMBERS.findall(numeric_part)]
+    while numbers and numbers[-1] == 0:
+        numbers.pop()
+    return tuple(numbers)
+
+
+class VersionIntervalIndex:
+    """Index of affected version ranges by product. The intervals of a product are sorted
+    by their start and store the running maximum of the end, so a lookup only visits
+    intervals which start before the version and stops as soon as no earlier interval
+    can reach the version anymore.
+    """
+
+    def __init__(self):
+        """Creates an empty index.
+        """
+        self._intervals = {}
+        self._starts = {}
+        self._max_ends = {}
+
+    @beartype
+    def add(self, product: str, start: tuple, start_inclusive: bool,
+            end: tuple, end_inclusive: bool, cve_code: str):
+        """Adds an affected version range. Use () as start and UNBOUNDED_END as end for
+        open ranges.
+
+        Args:
+            product (str): product name from the CPE string
+            start (tuple): first affected version
+            start_inclusive (bool): True if the start version itself is affected
+            end (tuple): last affected version
+            end_inclusive (bool): True if the end version itself is affected
+            cve_code (str): the vulnerability
+        """
+        self._intervals.setdefault(product, []).append(
+            (start, start_inclusive, end, end_inclusive, cve_code))
+        self._starts.pop(product, None)
+
+    def _build(self, product: str):
+        """Sorts the intervals of a product and computes the running maximum of the end.
+        """
+        intervals = sorted(self._intervals[product], key=lambda interval: interval[0])
+        self._intervals[product] = intervals
+        self._starts[product] = [interval[0] for interval in intervals]
+        max_ends = []
+        max_end = ()
+        for interval in intervals:
+            max_end = max(max_end, interval[2])
+            max_ends.append(max_end)
+        self._max_ends[product] = max_ends
+
+    @beartype
+    def lookup(self, product: str, version: tuple) -> Set[str]:
+        """Returns all vulnerabilities which affect the version of a product.
+
+        Args:
+            product (str): product name from the CPE string
+            version (tuple): parsed version of the service
+
+        Returns:
+            Set[str]: cve codes
+        """
+        if product not in self._intervals:
+            return set()
+        if product not in self._starts:
+            self._build(product)
+        intervals = self._intervals[product]
+        max_ends = self._max_ends[product]
+
+        cve_codes = set()
+        position = bisect_right(self._starts[product], version) - 1
+        while position >= 0 and max_ends[position] >= version:
+            start, start_inclusive, end, end_inclusive, cve_code = intervals[position]
+            if ((start < version or (start_inclusive and start == version))
+                    and (version < end or (end_inclusive and end == version))):
+                cve_codes.add(cve_code)
+            position -= 1
+        return cve_codes
+
+    def __len__(self) -> int:
+        return sum(len(intervals) for intervals in self._intervals.values())
+
+
+class CveFeedLoader:
+    """Streams NVD feeds into the graph and links vulnerable services.
+    """
+
+    @beartype
+    def __init__(self, neo4j_driver: Neo4jDatabaseAccess, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Initializes the loader with a database connection.
+
+        Args:
+            neo4j_driver (Neo4jDatabaseAccess): connection to the graph database
+            batch_size (int): maximum number of nodes or edges written in one transaction
+        """
+        self.neo4j_driver = neo4j_driver
+        self.batch_size = batch_size
+        self.version_index = VersionIntervalIndex()
+        self.changed_services = set()
+        # Vulnerabilities of the loaded feeds, only their edges can be stale
+        self.cve_codes = set()
+
+    @beartype
+    def load_feeds(self, file_paths: List[str]) -> dict:
+        """Loads the feed files and updates the HAS_VULNERABILITY edges of all services.
+
+        Args:
+            file_paths (List[str]): paths to the feed files
+
+        Returns:
+            dict: number of written vulnerabilities and created or deleted edges
+        """
+        query = ('MATCH (v:Vulnerability) '
+                'RETURN v.cve_code AS cve_code, v.feed_hash AS feed_hash, '
+                'v.topology_managed AS topology_managed')
+        known_hashes = {}
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            # Vulnerabilities of the topology file are owned by the topology sync
+            known_hashes[row['cve_code']] = 'managed' if row['topology_managed'] == 'True' else row['feed_hash']
+
+        written = 0
+        batch = []
+        for file_path in file_paths:
+            for item in self.stream_feed_items(file_path):
+                vulnerability, ranges = self.parse_item(item)
+                self.cve_codes.add(vulnerability['cve_code'])
+                for product, start, start_inclusive, end, end_inclusive in ranges:
+                    self.version_index.add(product, start, start_inclusive, end, end_inclusive,
+                                           vulnerability['cve_code'])
+                known_hash = known_hashes.get(vulnerability['cve_code'])
+                if known_hash in ('managed', vulnerability['feed_hash']):
+                    continue
+                batch.append(vulnerability)
+                if len(batch) >= self.batch_size:
+                    self.neo4j_driver.merge_nodes('Vulnerability', ['cve_code'], batch)
+                    written += len(batch)
+                    batch = []
+        if batch:
+            self.neo4j_driver.merge_nodes('Vulnerability', ['cve_code'], batch)
+            written += len(batch)
+
+        created, deleted = self.link_services()
+        summary = {'vulnerabilities': written, 'created_edges': created, 'deleted_edges': deleted,
+                   'version_ranges': len(self.version_index)}
+        print(f'CVE feed loaded: {summary}')
+        return summary
+
+    def link_services(self) -> Tuple[int, int]:
+        """Matches every service against the version index and writes the difference to
+        the HAS_VULNERABILITY edges created by a previous run. Edges of vulnerabilities
+        which are not in the loaded feeds are kept.
+
+        Returns:
+            Tuple[int, int]: number of created and deleted edges
+        """
+        query = 'MATCH (s:Service) RETURN s.name AS name, s.version AS version'
+        desired = set()
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            if row['name'] is None or row['version'] is None:
+                continue
+            product = self.product_of_service(row['name'])
+            for cve_code in self.version_index.lookup(product, parse_version(row['version'])):
+                desired.add((row['name'], cve_code))
+
+        query = ('MATCH (s:Service)-[r:HAS_VULNERABILITY]->(v:Vulnerability) '
+                'RETURN s.name AS name, v.cve_code AS cve_code, r.source AS source')
+        loaded = set()
+        other = set()
+        for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+            key = (row['name'], row['cve_code'])
+            (loaded if row['source'] == FEED_SOURCE else other).add(key)
+
+        service = {'name': 'Service', 'property_names': ['name']}
+        vulnerability = {'name': 'Vulnerability', 'property_names': ['cve_code']}
+        create_rows = [{'node1': {'name': name}, 'node2': {'cve_code': cve_code},
+                        'properties': {'source': FEED_SOURCE}}
+                       for name, cve_code in desired - loaded - other]
+        delete_rows = [{'node1': {'name': name}, 'node2': {'cve_code': cve_code}}
+                       for name, cve_code in loaded - desired if cve_code in self.cve_codes]
+        self.changed_services = {row['node1']['name'] for row in create_rows + delete_rows}
+        for start in range(0, len(delete_rows), self.batch_size):
+            self.neo4j_driver.delete_edges('HAS_VULNERABILITY', service, vulnerability,
+                                           delete_rows[start:start + self.batch_size])
+        for start in range(0, len(create_rows), self.batch_size):
+            self.neo4j_driver.merge_edges('HAS_VULNERABILITY', service, vulnerability,
+                                          create_rows[start:start + self.batch_size])
+        return len(create_rows), len(delete_rows)
+
+    @staticmethod
+    @beartype
+    def product_of_service(service_name: str) -> str:
+        """Converts the name of a service node to the CPE product name.
+
+        Args:
+            service_name (str): name of the service e.g. Apache Web Server
+
+        Returns:
+            str: product name e.g. http_server
+        """
+        name = UUID_SUFFIX.sub('', service_name).lower()
+        return SERVICE_PRODUCTS.get(name, name.replace(' ', '_'))
+
+    @staticmethod
+    @beartype
+    def stream_feed_items(file_path: str):
+        """Yields the CVE items of a feed file one by one. The file is read in chunks and
+        each item is decoded as soon as it is complete.
+
+        Args:
+            file_path (str): path to a .json or .json.gz feed
+
+        Yields:
+            dict: one CVE item
+        """
+        opener = gzip.open if file_path.endswith('.gz') else open
+        decoder = json.JSONDecoder()
+        with opener(file_path, 'rt', encoding='utf-8') as feed_file:
+            buffer = ''
+            position = -1
+            while position < 0:
+                chunk = feed_file.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    logging.error('No CVE items found in: %s', file_path)
+                    return
+                buffer += chunk
+                for key in FEED_ARRAY_KEYS:
+                    found = buffer.find(key)
+                    if found >= 0:
+                        position = buffer.index('[', found) if '[' in buffer[found:] else -1
+                        break
+            buffer = buffer[position + 1:]
+            position = 0
+            end_of_file = False
+
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer) and buffer[position] == ']':
+                    return
+                try:
+                    if position >= len(buffer):
+                        raise ValueError('buffer empty')
+                    item, position = decoder.raw_decode(buffer, position)
+                    yield item
+                except ValueError:
+                    if end_of_file:
+                        logging.error('Feed file is truncated: %s', file_path)
+                        raise
+                    chunk = feed_file.read(READ_CHUNK_SIZE)
+                    end_of_file = not chunk
+                    buffer = buffer[position:] + chunk
+                    position = 0
+
+    @staticmethod
+    @beartype
+    def parse_item(item: dict) -> Tuple[dict, List[tuple]]:
+        """Converts a CVE item to the properties of a vulnerability node and the affected
+        version ranges. All vulnerable CPE matches of a configuration are used, combined
+        configurations (e.g. application running on a specific os) are not evaluated.
+
+        Args:
+            item (dict): a CVE item of a 1.1 or 2.0 feed
+
+        Returns:
+            Tuple[dict, List[tuple]]: node properties and (product, start, start inclusive,
+            end, end inclusive) ranges
+        """
+        if 'cve' in item and 'id' in item['cve']:
+            cve = item['cve']
+            cve_code = cve['id']
+            descriptions = cve.get('descriptions', [])
+            nodes = [node for configuration in cve.get('configurations', [])
+                     for node in configuration.get('nodes', [])]
+            match_key, uri_key = 'cpeMatch', 'criteria'
+        else:
+            cve_code = item['cve']['CVE_data_meta']['ID']
+            descriptions = item['cve'].get('description', {}).get('description_data', [])
+            nodes = item.get('configurations', {}).get('nodes', [])
+            match_key, uri_key = 'cpe_match', 'cpe23Uri'
+        description = next((entry['value'] for entry in descriptions
+                            if entry.get('lang') == 'en'), '')
+
+        ranges = []
+        range_texts = []
+        products = []
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('children', []))
+            for cpe_match in node.get(match_key, []):
+                if not cpe_match.get('vulnerable', False):
+                    continue
+                parts = cpe_match[uri_key].split(':')
+                product, version = parts[4], parts[5]
+                start, start_inclusive, end, end_inclusive = (), True, UNBOUNDED_END, True
+                if 'versionStartIncluding' in cpe_match:
+                    start = parse_version(cpe_match['versionStartIncluding'])
+                if 'versionStartExcluding' in cpe_match:
+                    start, start_inclusive = parse_version(cpe_match['versionStartExcluding']), False
+                if 'versionEndIncluding' in cpe_match:
+                    end = parse_version(cpe_match['versionEndIncluding'])
+                if 'versionEndExcluding' in cpe_match:
+                    end, end_inclusive = parse_version(cpe_match['versionEndExcluding']), False
+                if start == () and end == UNBOUNDED_END and version not in ('*', '-'):
+                    start = end = parse_version(version)
+                ranges.append((product, start, start_inclusive, end, end_inclusive))
+                range_texts.append(CveFeedLoader._format_range(cpe_match, version))
+                if product not in products:
+                    products.append(product)
+
+        vulnerability = {'name': cve_code,
+                         'cve_code': cve_code,
+                         'description': description,
+                         'effected_protocol': '-',
+                         'effected_version': '-',
+                         'effected_app': ', '.join(products),
+                         'effected_app_version': ', '.join(range_texts),
+                         'source': FEED_SOURCE}
+        vulnerability['feed_hash'] = hashlib.sha1(
+            json.dumps(vulnerability, sort_keys=True).encode('utf-8')).hexdigest()
+        return vulnerability, ranges
+
+    @staticmethod
+    def _format_range(cpe_match: dict, version: str) -> str:
+        """Formats a version range for the effected_app_version property.
+        """
+        bounds = []
+        if 'versionStartIncluding' in cpe_match:
+            bounds.append('>=' + cpe_match['versionStartIncluding'])
+        if 'versionStartExcluding' in cpe_match:
+            bounds.append('>' + cpe_match['versionStartExcluding'])
+        if 'versionEndIncluding' in cpe_match:
+            bounds.append('<=' + cpe_match['versionEndIncluding'])
+        if 'versionEndExcluding' in cpe_match:
+            bounds.append('<' + cpe_match['versionEndExcluding'])
+        if not bounds:
+            return 'all' if version in ('*', '-') else version
+        return ' '.join(bounds)
+
+
+if __name__ == '__main__':
+    neo4j_driver = Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+    loader = CveFeedLoader(neo4j_driver)
+    loader.load_feeds(sys.argv[1:])
+    neo4j_driver.close()
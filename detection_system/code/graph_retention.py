@@ -0,0 +1,216 @@
+"""This module keeps the graph small by removing old data in fixed size batches.
+    Inactive connections which were not updated for longer than a time to live are
+    deleted or archived to a json lines file, and the whole graph can be purged for a
+    full reset. Every batch is its own transaction so the memory needed per transaction
+    is bounded. The expiry writes its cutoff to a checkpoint file after each batch so an
+    interrupted job continues with the same connections. The purge needs no checkpoint,
+    each batch deletes what is left, so a purge is resumed by running it again.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import os
+import sys
+import json
+import logging
+import time
+import threading
+from typing import Optional
+
+from beartype import beartype
+
+from neo4j_database_access import Neo4jDatabaseAccess
+
+NEO4J_URI = 'bolt://localhost:30687'
+NEO4J_USER = 'neo4j'
+NEO4J_PASS = '1234'
+CHECKPOINT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retention_checkpoint.json')
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CONNECTION_TTL = 24 * 60 * 60
+DEFAULT_INTERVAL = 10 * 60
+# A failed expiry is retried after this, doubled on every further failure up to the interval
+RETRY_SECONDS = 5
+
+
+class GraphRetention:
+    """Deletes old connections and purges the graph in batches.
+    """
+
+    @beartype
+    def __init__(self, neo4j_driver: Neo4jDatabaseAccess, batch_size: int = DEFAULT_BATCH_SIZE,
+                 checkpoint_file: str = CHECKPOINT_FILE):
+        """Initializes the retention jobs with a database connection.
+
+        Args:
+            neo4j_driver (Neo4jDatabaseAccess): connection to the graph database
+            batch_size (int): maximum number of nodes or edges removed in one transaction
+            checkpoint_file (str): file to store the progress of a running job
+        """
+        self.neo4j_driver = neo4j_driver
+        self.batch_size = batch_size
+        self.checkpoint_file = checkpoint_file
+        self.retention_status = False
+
+    def create_retention_index(self):
+        """Creates an index on the last update time of a connection so old connections
+        are found without scanning all connections. Timestamps are stored as strings of
+        seconds which compare in the same order as the numbers.
+        """
+        query = ('CREATE INDEX connection_last_update_time IF NOT EXISTS '
+                'FOR (c:Connection) ON (c.last_update_time)')
+        self.neo4j_driver.execute_and_return_query_result(query)
+
+    @beartype
+    def expire_connections(self, ttl_seconds: int, archive_file: Optional[str] = None) -> int:
+        """Deletes inactive connections which were last updated before now - ttl_seconds.
+        If an archive file is given the connection and its host are appended as json lines
+        before a batch is deleted. A batch which was archived but not deleted when the job
+        was interrupted is archived a second time on resume.
+
+        Args:
+            ttl_seconds (int): time to live of an inactive connection in seconds
+            archive_file (str, optional): json lines file to archive deleted connections
+
+        Returns:
+            int: number of deleted connections
+        """
+        checkpoint = self._load_checkpoint('expire_connections')
+        if checkpoint is None:
+            checkpoint = {'job': 'expire_connections',
+                          'cutoff': str(int(time.time()) - ttl_seconds),
+                          'deleted': 0}
+        parameters = {'cutoff': checkpoint['cutoff'], 'batch_size': self.batch_size}
+        match = ('MATCH (c:Connection) '
+                'WHERE c.last_update_time < $cutoff AND c.status = "inactive" '
+                'WITH c LIMIT $batch_size ')
+
+        while True:
+            if archive_file is None:
+                query = match + 'DETACH DELETE c RETURN count(*) AS count'
+                result = self.neo4j_driver.execute_and_return_query_result(query, parameters)
+                count = result[0]['count'] if result else 0
+            else:
+                query = (match +
+                        'OPTIONAL MATCH (h:Host)-[:STARTS_CONNECTION]->(c) '
+                        'RETURN properties(c) AS connection, h.ip_address AS ip_address')
+                rows = self.neo4j_driver.execute_and_return_query_result(query, parameters) or []
+                self._archive(archive_file, rows)
+                query = ('UNWIND $names AS name '
+                        'MATCH (c:Connection {name: name}) '
+                        'DETACH DELETE c')
+                names = list({row['connection']['name'] for row in rows})
+                self.neo4j_driver.execute_and_return_query_result(query, {'names': names})
+                count = len(names)
+
+            if count == 0:
+                break
+            checkpoint['deleted'] += count
+            self._save_checkpoint(checkpoint)
+
+        self._remove_checkpoint()
+        print(f'Expired connections: {checkpoint["deleted"]}')
+        return checkpoint['deleted']
+
+    def purge_graph(self) -> int:
+        """Deletes all edges and afterwards all nodes of the graph. Edges are removed first
+        so a node with many relations does not have to be detached in one transaction.
+        An interrupted purge is continued by calling it again.
+
+        Returns:
+            int: number of deleted nodes and edges of this call
+        """
+        queries = ('MATCH ()-[r]->() WITH r LIMIT $batch_size DELETE r RETURN count(*) AS count',
+                   'MATCH (n) WITH n LIMIT $batch_size DETACH DELETE n RETURN count(*) AS count')
+        parameters = {'batch_size': self.batch_size}
+        deleted = 0
+        for query in queries:
+            while True:
+                result = self.neo4j_driver.execute_and_return_query_result(query, parameters)
+                count = result[0]['count'] if result else 0
+                if count == 0:
+                    break
+                deleted += count
+
+        print(f'Purged nodes and edges: {deleted}')
+        return deleted
+
+    def _start(self, ttl_seconds: int, interval: int, archive_file: Optional[str]):
+        """Runs the connection expiry periodically until stop is called. A failed run is
+        retried with a back off, its checkpoint keeps the progress.
+        """
+        failures = 0
+        while self.retention_status is True:
+            try:
+                self.expire_connections(ttl_seconds, archive_file)
+                failures = 0
+                wait = interval
+            # The database may be down for a while, the expiry must not end with it
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Expiring the connections raised an error: \n %s', exception)
+                wait = min(RETRY_SECONDS * 2 ** failures, interval)
+                failures += 1
+            time.sleep(wait)
+
+    @beartype
+    def start(self, ttl_seconds: int = DEFAULT_CONNECTION_TTL, interval: int = DEFAULT_INTERVAL,
+              archive_file: Optional[str] = None):
+        """Starts the connection expiry in a background thread.
+
+        Args:
+            ttl_seconds (int): time to live of an inactive connection in seconds
+            interval (int): seconds to wait between two runs
+            archive_file (str, optional): json lines file to archive deleted connections
+        """
+        self.retention_status = True
+        threading.Thread(target=self._start, args=(ttl_seconds, interval, archive_file),
+                         daemon=True).start()
+
+    def stop(self):
+        """Stops the background expiry after the current run.
+        """
+        self.retention_status = False
+
+    @staticmethod
+    def _archive(archive_file: str, rows: list):
+        """Appends the rows as json lines to the archive file.
+        """
+        with open(archive_file, 'a', encoding='utf-8') as archive:
+            for row in rows:
+                archive.write(json.dumps(row) + '\n')
+
+    def _load_checkpoint(self, job: str) -> Optional[dict]:
+        """Returns the checkpoint of an interrupted run of the job if there is one.
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file, 'r', encoding='utf-8') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('job') != job:
+            return None
+        print(f'Resuming {job} from checkpoint: {checkpoint}')
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint: dict):
+        """Writes the checkpoint atomically so a crash never leaves a partial file.
+        """
+        temp_file = self.checkpoint_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def _remove_checkpoint(self):
+        """Removes the checkpoint once a job is finished.
+        """
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+
+if __name__ == '__main__':
+    neo4j_driver = Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+    retention = GraphRetention(neo4j_driver)
+    if len(sys.argv) > 1 and sys.argv[1] == 'purge':
+        retention.purge_graph()
+    else:
+        retention.create_retention_index()
+        retention.expire_connections(DEFAULT_CONNECTION_TTL)
+    neo4j_driver.close()
@@ -0,0 +1,190 @@
+"""This module defines the operations the log transformation and the network monitoring
+    need from the graph storage, so they can run against different backends:
+
+    neo4j   Neo4jDatabaseAccess, the graph database of the monitoring system
+    memory  InMemoryDatabaseAccess, dictonary and array indexes in the process
+    sqlite  SqliteDatabaseAccess, an embedded database file for single node deployments
+
+    The backend is selected with the environment variable IDS_STORAGE_BACKEND and
+    defaults to neo4j, the file of the sqlite backend is set with IDS_SQLITE_PATH.
+    Topology, vulnerability feeds, attack paths and the retention run cypher queries
+    and still need neo4j.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import os
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+from beartype import beartype
+
+NEO4J_URI = 'bolt://localhost:30687'
+NEO4J_USER = 'neo4j'
+NEO4J_PASS = '1234'
+STORAGE_BACKEND_VARIABLE = 'IDS_STORAGE_BACKEND'
+SQLITE_PATH_VARIABLE = 'IDS_SQLITE_PATH'
+STORAGE_BACKENDS = ('neo4j', 'memory', 'sqlite')
+
+
+class GraphStorage(ABC):
+    """Operations on hosts, connections, services and their edges. Booleans are passed
+    as the strings True and False like they are stored in neo4j.
+    """
+
+    @abstractmethod
+    def close(self):
+        """Releases the connection to the storage.
+        """
+
+    @abstractmethod
+    def create_host(self, host_json: str):
+        """Creates a host node from json with ip_address, creation_time,
+        notification_sent and is_blocked.
+        """
+
+    @abstractmethod
+    def upsert_host(self, host_json: str):
+        """Creates a host node like create_host if no host has the ip address, an
+        existing host is not changed.
+        """
+
+    @abstractmethod
+    def create_connection(self, connection_json: str):
+        """Creates a connection node from json with status, name and last_update_time.
+        """
+
+    @abstractmethod
+    def upsert_connection(self, connection_json: str):
+        """Creates a connection node like create_connection if no connection has the
+        name, an existing connection is not changed.
+        """
+
+    @abstractmethod
+    def create_service(self, service_json: str):
+        """Creates a service node from json with name, port, protocol and version.
+        """
+
+    @abstractmethod
+    def create_edge(self, edge_data: str):
+        """Creates an edge between the nodes matching the node1 and node2 descriptions
+        of the json, each with name, property_names and property_values.
+        """
+
+    @abstractmethod
+    def merge_edge(self, edge_data: str):
+        """Creates an edge like create_edge unless the nodes are connected by an edge
+        of the same type already, so it can be applied repeatedly.
+        """
+
+    @abstractmethod
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Makes the properties a key of the nodes with the label.
+        """
+
+    @abstractmethod
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Returns True if a node with the label has the property value.
+        """
+
+    @abstractmethod
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Returns True if the key constraint was created before.
+        """
+
+    @abstractmethod
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """Returns True if the host is blocked.
+        """
+
+    @abstractmethod
+    def update_connection_status(self, connection_name: str, status: str):
+        """Sets the status of a connection to active or inactive.
+        """
+
+    @abstractmethod
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Sets the time a connection was last updated.
+        """
+
+    @abstractmethod
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Sets the block status of a host.
+        """
+
+    @abstractmethod
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Sets if the notification for a host was sent.
+        """
+
+    @abstractmethod
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Changes the ip address of a host.
+        """
+
+    @abstractmethod
+    def update_service_version(self, service_name: str, version: str):
+        """Sets the version of a service.
+        """
+
+    @abstractmethod
+    def update_service_port(self, service_name: str, port: str):
+        """Sets the port of a service.
+        """
+
+    @abstractmethod
+    def count_active_connections_per_host(self) -> list:
+        """Returns a dictonary with the host properties as h and the number of its
+        active connections as count for each host which is neither blocked nor notified.
+        """
+
+    @abstractmethod
+    def get_blocked_hosts(self) -> List[str]:
+        """Returns the ip addresses of all blocked hosts.
+        """
+
+    def write_batch(self, mutations: List[Tuple[str, tuple]]):
+        """Applies mutations in their order, e.g. the ones collected by a batched
+        storage. Backends which can apply them together override it.
+
+        Args:
+            mutations (List[Tuple[str, tuple]]): name of the method and its arguments
+        """
+        for method_name, args in mutations:
+            getattr(self, method_name)(*args)
+
+
+@beartype
+def create_graph_storage(backend: Optional[str] = None, uri: str = NEO4J_URI, user: str = NEO4J_USER,
+                         password: str = NEO4J_PASS) -> GraphStorage:
+    """Creates the storage of the configured backend.
+
+    Args:
+        backend (str, optional): name of the backend, IDS_STORAGE_BACKEND or neo4j if not set
+        uri (str): uri of the neo4j instance
+        user (str): neo4j user
+        password (str): neo4j password
+
+    Returns:
+        GraphStorage: the storage
+    """
+    backend = backend or os.environ.get(STORAGE_BACKEND_VARIABLE, 'neo4j')
+    if backend == 'memory':
+        from in_memory_database_access import InMemoryDatabaseAccess
+
+        return InMemoryDatabaseAccess()
+    if backend == 'sqlite':
+        from sqlite_database_access import SqliteDatabaseAccess, SQLITE_PATH
+
+        return SqliteDatabaseAccess(os.environ.get(SQLITE_PATH_VARIABLE, SQLITE_PATH))
+    if backend == 'neo4j':
+        from neo4j_database_access import Neo4jDatabaseAccess
+
+        return Neo4jDatabaseAccess(uri, user, password)
+    raise ValueError('Unknown storage backend ' + backend + ', use one of ' + ', '.join(STORAGE_BACKENDS))
+
+
+if __name__ == '__main__':
+    graph_storage = create_graph_storage()
+    print(type(graph_storage).__name__, graph_storage.count_active_connections_per_host())
+    graph_storage.close()
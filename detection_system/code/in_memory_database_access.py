@@ -0,0 +1,457 @@
+"""This module provides an in memory implementation of the graph storage. It implements
+    the methods which are used by the log transformation and the network monitoring
+    with the same arguments and the same semantics as the cypher queries, so both can
+    run and be benchmarked without a neo4j instance.
+
+    Hosts and connections, the nodes of the hot path, are numbered in the order they
+    are created. A dictonary maps the key (ip address or name) to the number and every
+    property is a compact column indexed by it: ip addresses and timestamps are
+    integers, flags, status and client ids are numbers of symbol tables. Each
+    connection keeps the hosts which started it and each host counts its active
+    connections. The count is updated whenever a STARTS_CONNECTION edge is created or
+    the status of a connection changes, so the detection pass only visits the hosts
+    with active connections instead of all edges.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import logging
+from array import array
+from typing import List
+
+from beartype import beartype
+
+from compact_state import AddressColumn, IntegerColumn, SymbolColumn, SymbolTable, ip_key
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+from stage_timing import STAGE_TIMING
+from topology_sync import NODE_KEYS
+
+HOST_PROPERTIES = ('ip_address', 'creation_time', 'notification_sent', 'is_blocked')
+CONNECTION_PROPERTIES = ('status', 'port', 'name', 'last_update_time')
+SERVICE_PROPERTIES = ('name', 'port', 'protocol', 'version')
+
+
+class InMemoryDatabaseAccess(GraphStorage):
+    """Keeps hosts and connections in indexed lists, other nodes, edges and constraints
+    in dictonaries. Like the CREATE queries of the neo4j class edges are not
+    deduplicated.
+    """
+
+    def __init__(self):
+        """Creates an empty graph.
+        """
+        flags = SymbolTable()
+        # Keyed by ip_key, the integer of the address
+        self.host_index = {}
+        self.hosts = {'ip_address': AddressColumn(), 'creation_time': IntegerColumn(),
+                      'notification_sent': SymbolColumn(flags), 'is_blocked': SymbolColumn(flags)}
+        self.host_active_connections = array('l')
+        # Hosts with at least one active connection, the candidates of the detection
+        self.active_hosts = set()
+        # Every client id is stored once, the index and the name column share it
+        self.client_ids = SymbolTable()
+        self.connection_index = {}
+        self.connections = {'status': SymbolColumn(), 'port': SymbolColumn(),
+                            'name': SymbolColumn(self.client_ids), 'last_update_time': IntegerColumn()}
+        self.connection_hosts = []
+        self.nodes = {}
+        self.edges = {}
+        self.constraints = set()
+        STAGE_TIMING.instrument(self, 'memory.')
+        METRICS.instrument(self, 'ids_db')
+
+    def close(self):
+        """Nothing to close, exists for compatibility with Neo4jDatabaseAccess.
+        """
+
+    @beartype
+    def create_host(self, host_json: str):
+        """Creates a host node.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._add_host(json.loads(host_json))
+
+    @beartype
+    def upsert_host(self, host_json: str):
+        """Creates a host node if no host has the ip address.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        host_data = json.loads(host_json)
+        if ip_key(host_data.get('ip_address')) not in self.host_index:
+            self._add_host(host_data)
+
+    @beartype
+    def create_connection(self, connection_json: str):
+        """Creates a connection node.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._add_connection(json.loads(connection_json))
+
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        """Creates a connection node if no connection has the name.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        connection_data = json.loads(connection_json)
+        if connection_data.get('name') not in self.connection_index:
+            self._add_connection(connection_data)
+
+    @beartype
+    def create_service(self, service_json: str):
+        """Creates a service node.
+
+        Args:
+            service_json (str): data of the service in json format.
+        """
+        service_data = json.loads(service_json)
+        properties = {name: service_data.get(name) for name in SERVICE_PROPERTIES}
+        key = tuple(properties.get(name) for name in NODE_KEYS['Service'])
+        self.nodes.setdefault('Service', {})[key] = properties
+
+    @beartype
+    def create_edge(self, edge_data: str):
+        """Creates an edge between all pairs of nodes matching the two node descriptions.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        edge_data = json.loads(edge_data)
+        node1, node2 = edge_data['node1'], edge_data['node2']
+        if (edge_data['edge_name'] == 'STARTS_CONNECTION' and node1['name'] == 'Host'
+                and node2['name'] == 'Connection'):
+            for connection in self._match_connections(node2):
+                for host in self._match_hosts(node1):
+                    self._add_starts_connection(host, connection)
+            return
+        edges = self.edges.setdefault(edge_data['edge_name'], [])
+        for first in self._match_nodes(node1):
+            for second in self._match_nodes(node2):
+                edges.append((first, second))
+
+    @beartype
+    def merge_edge(self, edge_data: str):
+        """Creates an edge between all pairs of matching nodes which are not connected
+        by an edge of the same type yet.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        edge_data = json.loads(edge_data)
+        node1, node2 = edge_data['node1'], edge_data['node2']
+        if (edge_data['edge_name'] == 'STARTS_CONNECTION' and node1['name'] == 'Host'
+                and node2['name'] == 'Connection'):
+            for connection in self._match_connections(node2):
+                for host in self._match_hosts(node1):
+                    if host not in self.connection_hosts[connection]:
+                        self._add_starts_connection(host, connection)
+            return
+        edges = self.edges.setdefault(edge_data['edge_name'], [])
+        for first in self._match_nodes(node1):
+            for second in self._match_nodes(node2):
+                if (first, second) not in edges:
+                    edges.append((first, second))
+
+    @beartype
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Stores a constraint, uniqueness is not enforced.
+
+        Args:
+            node_name (str): name of the node the constraint should be applied on.
+            property_names (List[str]): names of the properties of the constraint.
+        """
+        self.constraints.add((node_name, tuple(property_names)))
+
+    @beartype
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Check if a node with the given property value exists.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_name (str): name of the property.
+            property_value ([type]): value of the property.
+
+        Returns:
+            bool: True if node exists False otherwise.
+        """
+        if node_name == 'Host' and property_name == 'ip_address':
+            return ip_key(property_value) in self.host_index
+        if node_name == 'Connection' and property_name == 'name':
+            return property_value in self.connection_index
+        description = {'name': node_name, 'property_names': [property_name],
+                       'property_values': [property_value]}
+        return bool(self._match_nodes(description))
+
+    @beartype
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Checks if a constraint was created before.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_names (List[str]): names of the properties of the constraint.
+
+        Returns:
+            bool: True if the constraint exists False otherwise
+        """
+        return (node_name, tuple(property_names)) in self.constraints
+
+    @beartype
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """Checks if a host is blocked for new incoming connection or not.
+
+        Args:
+            ip_address (str): ip address of host to verify
+
+        Returns:
+            bool: True if host is currently blocked
+        """
+        host = self.host_index.get(ip_key(ip_address))
+        return host is not None and self.hosts['is_blocked'][host] == 'True'
+
+    @beartype
+    def update_connection_status(self, connection_name: str, status: str):
+        """Updates the status of a connection to active or inactive and moves its
+        hosts between the active counts.
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            status (str): status to be set for the connection
+        """
+        connection = self.connection_index.get(connection_name)
+        if connection is None:
+            return
+        statuses = self.connections['status']
+        was_active = statuses[connection] == 'active'
+        statuses[connection] = status
+        if was_active != (status == 'active'):
+            change = 1 if status == 'active' else -1
+            for host in self.connection_hosts[connection]:
+                self._count_active(host, change)
+
+    @beartype
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Updates the timestamp when the connection was last updated.
+
+        Args:
+            connection_name (str): name of the connection
+            time (str): the timestamp to set
+        """
+        connection = self.connection_index.get(connection_name)
+        if connection is not None:
+            self.connections['last_update_time'][connection] = time
+
+    @beartype
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Updates the block status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host to be blocked
+            is_blocked (str): state of the block status (True/False)
+        """
+        self._set_host_property(ip_address, 'is_blocked', is_blocked)
+
+    @beartype
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Updates the notification status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host
+            sent (str): state of the notification status (True/False)
+        """
+        self._set_host_property(ip_address, 'notification_sent', sent)
+
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Updates the ip address of a host, unless another host has the new ip address.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+        """
+        if ip_key(new_ip_address) in self.host_index:
+            logging.error('The host %s was not moved to %s, a host with this ip address exists',
+                          old_ip_address, new_ip_address)
+            return
+        host = self.host_index.pop(ip_key(old_ip_address), None)
+        if host is not None:
+            self.hosts['ip_address'][host] = new_ip_address
+            self.host_index[ip_key(new_ip_address)] = host
+
+    @beartype
+    def update_service_version(self, service_name: str, version: str):
+        """Updates the version of a service.
+
+        Args:
+            service_name (str): name of the service
+            version (str): version of the service
+        """
+        self._set_property('Service', service_name, 'version', version)
+
+    @beartype
+    def update_service_port(self, service_name: str, port: str):
+        """Updates the port of a service.
+
+        Args:
+            service_name (str): name of the service
+            port (str): port of the service
+        """
+        self._set_property('Service', service_name, 'port', port)
+
+    def count_active_connections_per_host(self):
+        """Counts the active connections of every host which is neither blocked nor
+        already notified.
+
+        Returns:
+            result (list): a list of dictonaries with the host properties as h and the
+            number of active connections as count
+        """
+        # The flags are compared as symbol numbers, only reported hosts are decoded
+        false = self.hosts['is_blocked'].code('False')
+        notification_sent = self.hosts['notification_sent'].numbers
+        is_blocked = self.hosts['is_blocked'].numbers
+        counts = self.host_active_connections
+        return [{'h': self._host_properties(host), 'count': counts[host]}
+                for host in list(self.active_hosts)
+                if notification_sent[host] == false and is_blocked[host] == false]
+
+    def get_blocked_hosts(self):
+        """Returns the ip addresses of all blocked hosts.
+
+        Returns:
+            List[str]: the ip addresses
+        """
+        ip_addresses = self.hosts['ip_address']
+        true = self.hosts['is_blocked'].code('True')
+        return [ip_addresses[host] for host, is_blocked in enumerate(self.hosts['is_blocked'].numbers)
+                if is_blocked == true and self.host_index.get(ip_key(ip_addresses[host])) == host]
+
+    def _add_host(self, host_data: dict):
+        """Appends a host to the lists and indexes it by its ip address.
+        """
+        host = len(self.host_active_connections)
+        for name in HOST_PROPERTIES:
+            self.hosts[name].append(host_data.get(name))
+        self.host_active_connections.append(0)
+        self.host_index[ip_key(host_data.get('ip_address'))] = host
+
+    def _add_connection(self, connection_data: dict):
+        """Appends a connection to the lists and indexes it by its name.
+        """
+        connection = len(self.connection_hosts)
+        for name in CONNECTION_PROPERTIES:
+            self.connections[name].append(connection_data.get(name))
+        self.connection_hosts.append([])
+        # The interned string of the name column, so the index holds no copy
+        self.connection_index[self.connections['name'][connection]] = connection
+
+    def _add_starts_connection(self, host: int, connection: int):
+        """Stores a STARTS_CONNECTION edge and counts it if the connection is active.
+        """
+        self.connection_hosts[connection].append(host)
+        if self.connections['status'][connection] == 'active':
+            self._count_active(host, 1)
+
+    def _count_active(self, host: int, change: int):
+        """Changes the number of active connections of a host.
+        """
+        count = self.host_active_connections[host] + change
+        self.host_active_connections[host] = count
+        if count > 0:
+            self.active_hosts.add(host)
+        else:
+            self.active_hosts.discard(host)
+
+    def _host_properties(self, host: int) -> dict:
+        """Returns the properties of a host like a neo4j node.
+        """
+        hosts = self.hosts
+        flags = hosts['is_blocked'].symbols.names
+        return {'ip_address': hosts['ip_address'][host], 'creation_time': hosts['creation_time'][host],
+                'notification_sent': flags[hosts['notification_sent'].numbers[host]],
+                'is_blocked': flags[hosts['is_blocked'].numbers[host]]}
+
+    def _set_host_property(self, ip_address: str, property_name: str, value: str):
+        """Sets a property of the host with the ip address.
+        """
+        host = self.host_index.get(ip_key(ip_address))
+        if host is not None:
+            self.hosts[property_name][host] = value
+
+    def _set_property(self, node_name: str, key_value: str, property_name: str, value: str):
+        """Sets a property of the node with the given single key value.
+        """
+        node = self.nodes.get(node_name, {}).get((key_value,))
+        if node is not None:
+            node[property_name] = value
+
+    @staticmethod
+    def _matching(description: dict, key_name: str, index: dict, properties: dict, key=None) -> list:
+        """Returns the numbers of the hosts or connections whose properties equal all
+        given values. Uses the index if the description contains the key, key converts
+        the value to the key of the index.
+        """
+        expected = dict(zip(description['property_names'], description['property_values']))
+        if key_name in expected:
+            value = expected[key_name]
+            number = index.get(key(value) if key is not None else value)
+            candidates = [] if number is None else [number]
+        else:
+            candidates = index.values()
+        return [number for number in candidates
+                if all(name in properties and properties[name][number] == value
+                       for name, value in expected.items())]
+
+    def _match_hosts(self, description: dict) -> list:
+        """Returns the numbers of the hosts matching a node description.
+        """
+        return self._matching(description, 'ip_address', self.host_index, self.hosts, ip_key)
+
+    def _match_connections(self, description: dict) -> list:
+        """Returns the numbers of the connections matching a node description.
+        """
+        return self._matching(description, 'name', self.connection_index, self.connections)
+
+    def _match_nodes(self, description: dict) -> list:
+        """Returns the nodes of a label whose properties equal all given values. Uses the
+        key lookup if the description contains the key properties.
+        """
+        if description['name'] == 'Host':
+            return [self._host_properties(host) for host in self._match_hosts(description)]
+        if description['name'] == 'Connection':
+            return [{name: self.connections[name][connection] for name in CONNECTION_PROPERTIES}
+                    for connection in self._match_connections(description)]
+        nodes = self.nodes.get(description['name'], {})
+        expected = dict(zip(description['property_names'], description['property_values']))
+        key_names = NODE_KEYS[description['name']]
+        if all(name in expected for name in key_names):
+            node = nodes.get(tuple(expected[name] for name in key_names))
+            candidates = [] if node is None else [node]
+        else:
+            candidates = nodes.values()
+        return [node for node in candidates
+                if all(node.get(name) == value for name, value in expected.items())]
+
+
+if __name__ == '__main__':
+    in_memory_driver = InMemoryDatabaseAccess()
+    in_memory_driver.create_host(json.dumps({'ip_address': '127.0.0.1', 'creation_time': '1635015162',
+                                             'is_blocked': 'False', 'notification_sent': 'False'}))
+    in_memory_driver.create_connection(json.dumps({'status': 'active', 'name': 'mqtt-explorer-0a61e6f1',
+                                                   'last_update_time': '1635015162'}))
+    in_memory_driver.create_edge(json.dumps({'edge_name': 'STARTS_CONNECTION',
+                                             'node1': {'name': 'Host', 'property_names': ['ip_address'],
+                                                       'property_values': ['127.0.0.1']},
+                                             'node2': {'name': 'Connection', 'property_names': ['name'],
+                                                       'property_values': ['mqtt-explorer-0a61e6f1']}}))
+    print(in_memory_driver.count_active_connections_per_host())
+    in_memory_driver.update_connection_status('mqtt-explorer-0a61e6f1', 'inactive')
+    print(in_memory_driver.count_active_connections_per_host())
@@ -0,0 +1,340 @@
+"""This module keeps the blocked hosts and networks of the detection system in the
+    process, so the log transformation drops the lines of a blocked source before it
+    does any database work instead of asking the graph for every line.
+
+    The addresses are stored in a radix tree (PATRICIA tree) per address family. A node
+    is a prefix of the binary address, the tree only has nodes where two stored
+    prefixes differ, so a lookup visits at most one node per stored prefix on the path
+    of the address and at most 32 (128 for IPv6). Single hosts are /32 prefixes and
+    whole networks, e.g. 10.244.1.0/24, can be blocked as well.
+
+    The blocked hosts are read from the graph at startup and reloaded periodically, the
+    hosts the network monitoring of the process blocks are added at once by its block
+    listener, see NetworkMonitoring.add_block_listener. Networks are set with the
+    environment variable IDS_BLOCKED_NETWORKS, e.g. IDS_BLOCKED_NETWORKS=10.244.1.0/24.
+
+    Adapted from:
+    https://en.wikipedia.org/wiki/Radix_tree
+    [last accessed May 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import ipaddress
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from beartype import beartype
+
+from compact_state import IPV6_FLAG, ip_key
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+
+BLOCKED_NETWORKS_VARIABLE = 'IDS_BLOCKED_NETWORKS'
+# The graph is read again periodically to see blocks made by other processes
+DEFAULT_RELOAD_SECONDS = 30
+
+
+class RadixNode:
+    """A prefix of the tree, blocked if a host or network with this prefix is stored.
+    """
+    __slots__ = ('network', 'length', 'children', 'blocked')
+
+    def __init__(self, network: int, length: int, blocked: bool = False):
+        self.network = network
+        self.length = length
+        self.children = [None, None]
+        self.blocked = blocked
+
+
+class RadixTree:
+    """Path compressed binary tree of the prefixes of addresses with a fixed width.
+    """
+
+    def __init__(self, width: int):
+        """Creates an empty tree.
+
+        Args:
+            width (int): bits of an address, 32 for IPv4 and 128 for IPv6
+        """
+        self.width = width
+        self.root = RadixNode(0, 0)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def insert(self, network: int, length: int):
+        """Stores a prefix.
+
+        Args:
+            network (int): address of the network, the host bits are ignored
+            length (int): number of leading bits of the prefix
+        """
+        network = self._mask(network, length)
+        node = self.root
+        while node.length < length:
+            bit = self._bit(network, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = RadixNode(network, length, True)
+                self.size += 1
+                return
+            common = min(self._common_length(child.network, network), child.length, length)
+            if common == child.length:
+                node = child
+                continue
+            # The new prefix branches off within the edge to the child
+            fork = RadixNode(self._mask(network, common), common, common == length)
+            fork.children[self._bit(child.network, common)] = child
+            if common < length:
+                fork.children[self._bit(network, common)] = RadixNode(network, length, True)
+            node.children[bit] = fork
+            self.size += 1
+            return
+        if not node.blocked:
+            node.blocked = True
+            self.size += 1
+
+    def remove(self, network: int, length: int) -> bool:
+        """Removes a prefix, the prefixes containing it are kept.
+
+        Args:
+            network (int): address of the network, the host bits are ignored
+            length (int): number of leading bits of the prefix
+
+        Returns:
+            bool: True if the prefix was stored
+        """
+        network = self._mask(network, length)
+        path = [self.root]
+        node = self.root
+        while node.length < length:
+            node = node.children[self._bit(network, node.length)]
+            if node is None or node.length > length or self._mask(network, node.length) != node.network:
+                return False
+            path.append(node)
+        if node.network != network or not node.blocked:
+            return False
+        node.blocked = False
+        self.size -= 1
+        # Nodes without a prefix and with less than two children are not needed anymore
+        while len(path) > 1:
+            node = path.pop()
+            if node.blocked or None not in node.children:
+                break
+            parent = path[-1]
+            parent.children[parent.children.index(node)] = node.children[0] or node.children[1]
+        return True
+
+    def match(self, address: int) -> Optional[Tuple[int, int]]:
+        """Returns the shortest stored prefix which contains an address.
+
+        Args:
+            address (int): the address
+
+        Returns:
+            Tuple[int, int]: network and length of the prefix or None
+        """
+        node = self.root
+        width = self.width
+        while node is not None:
+            if (address ^ node.network) >> (width - node.length):
+                return None
+            if node.blocked:
+                return node.network, node.length
+            if node.length == width:
+                return None
+            node = node.children[(address >> (width - 1 - node.length)) & 1]
+        return None
+
+    def prefixes(self) -> List[Tuple[int, int]]:
+        """Returns all stored prefixes.
+
+        Returns:
+            List[Tuple[int, int]]: network and length of every prefix
+        """
+        prefixes = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.blocked:
+                prefixes.append((node.network, node.length))
+            nodes.extend(child for child in node.children if child is not None)
+        return sorted(prefixes)
+
+    def _mask(self, network: int, length: int) -> int:
+        """Clears the bits after the prefix.
+        """
+        return (network >> (self.width - length)) << (self.width - length)
+
+    def _bit(self, network: int, position: int) -> int:
+        """Returns the bit of the network at the position, 0 is the leading bit.
+        """
+        return (network >> (self.width - 1 - position)) & 1
+
+    def _common_length(self, first: int, second: int) -> int:
+        """Returns the number of leading bits which are equal.
+        """
+        return self.width - (first ^ second).bit_length()
+
+
+class IpBlocklist:
+    """The blocked hosts and networks, IPv4 and IPv6 in a tree each. Strings which are
+    no ip address in the usual notation are kept in a set.
+    """
+
+    def __init__(self, networks: Optional[List[str]] = None):
+        """Creates the blocklist.
+
+        Args:
+            networks (List[str], optional): networks which are always blocked, e.g.
+            10.244.1.0/24, read from IDS_BLOCKED_NETWORKS if not set
+        """
+        if networks is None:
+            networks = [network.strip() for network in os.environ.get(BLOCKED_NETWORKS_VARIABLE, '').split(',')
+                        if network.strip()]
+        self.networks = networks
+        self.reload_status = True
+        self._lock = threading.Lock()
+        self._trees, self._other = self._build([])
+        METRICS.gauge('ids_blocklist_entries', 'Blocked hosts and networks of the blocklist',
+                      function=lambda: len(self))
+
+    def __len__(self) -> int:
+        trees = self._trees
+        return len(trees[0]) + len(trees[1]) + len(self._other)
+
+    @beartype
+    def is_blocked(self, ip_address: str) -> bool:
+        """Checks if the address is blocked itself or is in a blocked network.
+
+        Args:
+            ip_address (str): ip address of a host
+
+        Returns:
+            bool: True if lines of the address are dropped
+        """
+        key = ip_key(ip_address)
+        if isinstance(key, str):
+            return key in self._other
+        if key & IPV6_FLAG:
+            return self._trees[1].match(key ^ IPV6_FLAG) is not None
+        return self._trees[0].match(key) is not None
+
+    @beartype
+    def block(self, ip_address: str):
+        """Blocks a host or a network.
+
+        Args:
+            ip_address (str): an address or a network in CIDR notation
+        """
+        with self._lock:
+            self._apply(self._trees, self._other, ip_address, True)
+
+    @beartype
+    def unblock(self, ip_address: str):
+        """Removes the block of a host or a network, a blocked network containing the
+        host still blocks it.
+
+        Args:
+            ip_address (str): an address or a network in CIDR notation
+        """
+        with self._lock:
+            self._apply(self._trees, self._other, ip_address, False)
+
+    def entries(self) -> List[str]:
+        """Returns the blocked hosts and networks.
+
+        Returns:
+            List[str]: single hosts as address, networks in CIDR notation
+        """
+        entries = sorted(self._other)
+        for network_type, tree in zip((ipaddress.IPv4Network, ipaddress.IPv6Network), self._trees):
+            for network, length in tree.prefixes():
+                network = network_type((network, length))
+                entries.append(str(network.network_address) if length == tree.width else str(network))
+        return entries
+
+    @beartype
+    def load(self, graph_storage: GraphStorage):
+        """Replaces the blocked hosts with the ones of the graph, the networks stay.
+
+        Args:
+            graph_storage (GraphStorage): storage of the graph
+        """
+        with self._lock:
+            self._trees, self._other = self._build(graph_storage.get_blocked_hosts())
+
+    @beartype
+    def start(self, graph_storage: GraphStorage, interval: int = DEFAULT_RELOAD_SECONDS):
+        """Reloads the blocked hosts from the graph periodically in a background thread.
+
+        Args:
+            graph_storage (GraphStorage): storage of the graph
+            interval (int): seconds to wait between two reloads
+        """
+        self.reload_status = True
+        threading.Thread(target=self._start, args=(graph_storage, interval), daemon=True).start()
+
+    def stop(self):
+        """Stops the background reload after the current run.
+        """
+        self.reload_status = False
+
+    def _start(self, graph_storage: GraphStorage, interval: int):
+        """Reloads the blocked hosts until stop is called.
+        """
+        while self.reload_status is True:
+            time.sleep(interval)
+            try:
+                self.load(graph_storage)
+            # The storage may be unavailable for a while, the last blocklist is kept
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Reloading the blocklist raised an error: \n %s', exception)
+
+    def _build(self, ip_addresses: List[str]) -> tuple:
+        """Returns new trees and the set of other strings with the networks and hosts.
+        """
+        trees, other = (RadixTree(32), RadixTree(128)), set()
+        for ip_address in self.networks + list(ip_addresses):
+            self._apply(trees, other, ip_address, True)
+        return trees, other
+
+    @staticmethod
+    def _apply(trees: tuple, other: set, ip_address: str, blocked: bool):
+        """Inserts or removes the host or network of the string.
+        """
+        prefix = None
+        key = ip_key(ip_address)
+        if isinstance(key, int):
+            tree = trees[1] if key & IPV6_FLAG else trees[0]
+            prefix = (tree, key & ~IPV6_FLAG, tree.width)
+        elif '/' in ip_address:
+            try:
+                network = ipaddress.ip_network(ip_address, strict=False)
+                prefix = (trees[0] if network.version == 4 else trees[1], int(network.network_address),
+                          network.prefixlen)
+            except ValueError:
+                logging.error('%s is no network, it is blocked as host', ip_address)
+        if prefix is None:
+            if blocked:
+                other.add(ip_address)
+            else:
+                other.discard(ip_address)
+        elif blocked:
+            prefix[0].insert(prefix[1], prefix[2])
+        else:
+            prefix[0].remove(prefix[1], prefix[2])
+
+
+if __name__ == '__main__':
+    example_blocklist = IpBlocklist(['10.244.1.0/24'])
+    example_blocklist.block('10.244.0.12')
+    example_blocklist.block('2001:db8::/32')
+    for example_address in ('10.244.0.12', '10.244.0.13', '10.244.1.77', '2001:db8::1', '2001:db9::1'):
+        print(example_address, example_blocklist.is_blocked(example_address))
+    print(example_blocklist.entries())
@@ -0,0 +1,223 @@
+"""This module traces how long it takes from mosquitto writing a "New client connected"
+    line until the detection has evaluated the connection and an alert was sent. A
+    sampled event carries the timestamp of the log line and the monotonic time when it
+    was ingested. Each stage adds the time when it finished with the event:
+
+    ingest -> parsed -> written -> detected -> alerted
+
+    Written events wait per host until the next detection pass which started after
+    they were written, that pass completes them. The durations between the stages and
+    end to end are recorded in histograms, the report is printed on SIGUSR2 and the
+    durations are exported as the ids_event_latency_seconds metric.
+
+    The sample rate is set with IDS_TRACE_SAMPLE_RATE (0 to 1, disabled by default) and
+    an optional latency objective with IDS_LATENCY_SLO_SECONDS.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import os
+import random
+import signal
+import threading
+import time
+from typing import Dict, Optional
+
+from beartype import beartype
+
+from metrics_endpoint import METRICS
+from stage_timing import LogLinearHistogram, PERCENTILES, run_on_signal
+
+STAGES = ('ingest', 'parsed', 'written', 'detected', 'alerted')
+# Events of a host which are kept until a detection pass completes them
+MAX_PENDING_PER_HOST = 1000
+
+EVENT_LATENCY = METRICS.histogram('ids_event_latency_seconds',
+                                  'Latency of sampled log events by stage transition', 'stage',
+                                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+class TraceEvent:
+    """A sampled log event with the monotonic time each stage finished.
+    """
+    __slots__ = ('marks', 'log_time', 'ip_address')
+
+    def __init__(self):
+        self.marks = {'ingest': time.monotonic()}
+        self.log_time = None
+        self.ip_address = None
+
+    def mark(self, stage: str):
+        """Records that a stage finished with the event.
+
+        Args:
+            stage (str): one of STAGES
+        """
+        self.marks[stage] = time.monotonic()
+
+
+class LatencyTracer:
+    """Samples events, keeps the written ones per host and records the latencies once
+    a detection pass completed them.
+    """
+
+    @beartype
+    def __init__(self, sample_rate: float = 0.0, slo_seconds: Optional[float] = None):
+        """Initializes the tracer.
+
+        Args:
+            sample_rate (float): fraction of the lines which are traced, 0 disables tracing
+            slo_seconds (float, optional): ingest to detection latency objective, events
+            above it are counted
+        """
+        self.sample_rate = sample_rate
+        self.enabled = sample_rate > 0
+        self.slo_seconds = slo_seconds
+        self.pending = {}
+        self.histograms = {}
+        self.events_completed = 0
+        self.events_over_slo = 0
+        self._lock = threading.Lock()
+
+    def sample(self) -> Optional[TraceEvent]:
+        """Decides if the current line is traced.
+
+        Returns:
+            TraceEvent: a new event or None if the line is not sampled
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return TraceEvent()
+
+    @beartype
+    def written(self, event: TraceEvent, ip_address: str, log_time: Optional[str]):
+        """Marks the event as written to the graph and queues it for the next detection
+        pass of the host.
+
+        Args:
+            event (TraceEvent): the sampled event
+            ip_address (str): host which started the connection
+            log_time (str, optional): timestamp of the log line in seconds
+        """
+        event.mark('written')
+        event.ip_address = ip_address
+        try:
+            event.log_time = float(log_time)
+        except (TypeError, ValueError):
+            event.log_time = None
+        with self._lock:
+            events = self.pending.setdefault(ip_address, [])
+            events.append(event)
+            if len(events) > MAX_PENDING_PER_HOST:
+                del events[0]
+
+    @beartype
+    def complete_pass(self, pass_start: float, detected: float, alert_times: Dict[str, float]):
+        """Completes every event which was written before the detection pass started,
+        the pass has evaluated its connection.
+
+        Args:
+            pass_start (float): monotonic time when the detection pass queried the graph
+            detected (float): monotonic time when the result of the query was read
+            alert_times (Dict[str, float]): monotonic time of the alert by host ip address
+        """
+        if not self.pending:
+            return
+        now = time.time()
+        completed = []
+        with self._lock:
+            for ip_address in list(self.pending):
+                events = self.pending[ip_address]
+                ready = [event for event in events if event.marks['written'] <= pass_start]
+                if not ready:
+                    continue
+                remaining = [event for event in events if event.marks['written'] > pass_start]
+                if remaining:
+                    self.pending[ip_address] = remaining
+                else:
+                    del self.pending[ip_address]
+                completed.extend(ready)
+        for event in completed:
+            event.marks['detected'] = detected
+            if event.ip_address in alert_times:
+                event.marks['alerted'] = alert_times[event.ip_address]
+            self._record(event, now - (time.monotonic() - event.marks['ingest']))
+
+    def _record(self, event: TraceEvent, ingest_wall_time: float):
+        """Records the durations between the stages of a completed event.
+        """
+        previous = 'ingest'
+        for stage in STAGES[1:]:
+            if stage not in event.marks:
+                continue
+            self._observe(previous + '_to_' + stage, event.marks[stage] - event.marks[previous])
+            previous = stage
+        self._observe('ingest_to_' + previous, event.marks[previous] - event.marks['ingest'])
+        if event.log_time is not None:
+            # The log has a resolution of seconds, the lag is never negative
+            self._observe('log_to_ingest', max(0.0, ingest_wall_time - event.log_time))
+            self._observe('log_to_' + previous, max(0.0, ingest_wall_time - event.log_time)
+                          + event.marks[previous] - event.marks['ingest'])
+        with self._lock:
+            self.events_completed += 1
+            if self.slo_seconds is not None and event.marks['detected'] - event.marks['ingest'] > self.slo_seconds:
+                self.events_over_slo += 1
+
+    def _observe(self, transition: str, seconds: float):
+        """Adds a duration to the histogram of a stage transition.
+        """
+        seconds = max(0.0, seconds)
+        EVENT_LATENCY.observe(seconds, transition)
+        with self._lock:
+            histogram = self.histograms.get(transition)
+            if histogram is None:
+                histogram = self.histograms[transition] = LogLinearHistogram()
+            histogram.record(int(seconds * 1000000))
+
+    def report(self) -> str:
+        """Formats the latency of each stage transition as a table in ms.
+
+        Returns:
+            str: one line per transition
+        """
+        with self._lock:
+            lines = [f'Completed events: {self.events_completed}']
+            if self.slo_seconds is not None:
+                lines.append(f'Events over the objective of {self.slo_seconds}s: {self.events_over_slo}')
+            lines.append(f"{'transition':<24} {'count':>9} {'mean':>11}"
+                         + ''.join(f" {'p' + format(fraction * 100, 'g'):>11}" for fraction in PERCENTILES))
+            for transition, histogram in sorted(self.histograms.items()):
+                line = f'{transition:<24} {histogram.total_count:>9} {histogram.mean() / 1000:>11.3f}'
+                for fraction in PERCENTILES:
+                    line = line + f' {histogram.value_at_percentile(fraction) / 1000:>11.3f}'
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def dump(self):
+        """Prints the report.
+        """
+        print(self.report(), flush=True)
+
+    def install_signal_handler(self):
+        """Prints the report in a reporter thread on SIGUSR2 if tracing is enabled, see
+        stage_timing.run_on_signal. Must be called from the main thread.
+        """
+        if self.enabled and hasattr(signal, 'SIGUSR2'):
+            run_on_signal(signal.SIGUSR2, self.dump)
+
+
+TRACER = LatencyTracer(float(os.environ.get('IDS_TRACE_SAMPLE_RATE', '0')),
+                       float(os.environ['IDS_LATENCY_SLO_SECONDS']) if os.environ.get('IDS_LATENCY_SLO_SECONDS') else None)
+
+
+if __name__ == '__main__':
+    example_tracer = LatencyTracer(1.0, slo_seconds=0.01)
+    for host in range(3):
+        example_event = example_tracer.sample()
+        example_event.mark('parsed')
+        example_tracer.written(example_event, '10.244.0.' + str(host), str(int(time.time())))
+    time.sleep(0.02)
+    example_pass_start = time.monotonic()
+    example_detected = time.monotonic()
+    example_tracer.complete_pass(example_pass_start, example_detected, {'10.244.0.1': time.monotonic()})
+    example_tracer.dump()
@@ -0,0 +1,241 @@
+"""This module keeps the detection in real time while the log grows faster than it is
+    transformed, e.g. during a flood of connections. The ingest measures how far it is
+    behind the tail of the log, in bytes of the file and in seconds between the clock
+    and the timestamp of the last processed line.
+
+    When one of the lags passes its threshold the transformation sheds load until both
+    are below half of their threshold again:
+
+    - lifecycle lines (new connections, connects and disconnects) are processed fully,
+      so the sessionizer and the active connections of the graph stay exact
+    - other lines, e.g. the saving of the broker database, are sampled, the first line
+      of a message and every SAMPLE_RATE-th line are kept, the others are only counted
+    - enrichment which the detection does not need, like the edge to the service and
+      the times of the connections, is deferred and written in order after the lag
+      recovered
+
+    The lag is measured every CHECK_LINES lines and by a timer, so the deferred writes
+    are applied even if the log goes quiet. A caught up ingest of a quiet log is not
+    behind, however old its last line is. With the partitioned ingest the dispatcher
+    samples the lines, the workers process every line they get fully.
+
+    The thresholds are set with IDS_SHED_LAG_BYTES and IDS_SHED_LAG_SECONDS, 0 disables
+    a threshold.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from beartype import beartype
+
+from metrics_endpoint import METRICS
+
+SHED_LAG_BYTES_VARIABLE = 'IDS_SHED_LAG_BYTES'
+SHED_LAG_SECONDS_VARIABLE = 'IDS_SHED_LAG_SECONDS'
+DEFAULT_LAG_BYTES = 8 * 1024 * 1024
+DEFAULT_LAG_SECONDS = 60
+# The lag is measured every CHECK_LINES lines, so the file size is not read for every line
+CHECK_LINES = 256
+# ... and at this interval, so the deferred writes of a quiet log are applied as well
+CHECK_INTERVAL_SECONDS = 1.0
+SAMPLE_RATE = 100
+# Deferred writes above this are dropped, the oldest first
+MAX_DEFERRED = 100000
+DRAIN_BATCH_SIZE = 500
+# Distinct messages counted while shedding, others are only in the metric
+MAX_MESSAGES = 1024
+
+LINES_SHED = METRICS.counter('ids_shed_lines_total', 'Log lines which were counted but not processed', 'kind')
+WRITES_DEFERRED = METRICS.counter('ids_deferred_writes_total', 'Graph writes deferred while shedding load', 'state')
+
+
+class LoadShedder:
+    """Decides per line if it is processed and keeps the deferred writes.
+    """
+
+    def __init__(self, bytes_behind: Callable[[], int], last_log_timestamp: Callable[[], float],
+                 lag_bytes: Optional[int] = None, lag_seconds: Optional[float] = None,
+                 sample_rate: int = SAMPLE_RATE) -> None:
+        """Creates the shedder, it starts with full processing.
+
+        Args:
+            bytes_behind (Callable[[], int]): returns the unread bytes of the log, e.g.
+            LocalFileAccess.bytes_behind_tail
+            last_log_timestamp (Callable[[], float]): returns the timestamp of the last
+            processed line, 0 if there is none
+            lag_bytes (int, optional): threshold of the unread bytes, read from
+            IDS_SHED_LAG_BYTES if not set
+            lag_seconds (float, optional): threshold of the seconds behind the clock,
+            read from IDS_SHED_LAG_SECONDS if not set
+            sample_rate (int): every n-th repeated informational line is kept
+        """
+        if lag_bytes is None:
+            lag_bytes = int(os.environ.get(SHED_LAG_BYTES_VARIABLE, DEFAULT_LAG_BYTES))
+        if lag_seconds is None:
+            lag_seconds = float(os.environ.get(SHED_LAG_SECONDS_VARIABLE, DEFAULT_LAG_SECONDS))
+        self.bytes_behind = bytes_behind
+        self.last_log_timestamp = last_log_timestamp
+        self.lag_bytes = lag_bytes
+        self.lag_seconds = lag_seconds
+        self.sample_rate = sample_rate
+        self.shedding = False
+        self.shedding_status = True
+        self.lines_until_check = CHECK_LINES
+        self.messages = {}
+        self.deferred = deque()
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        METRICS.gauge('ids_ingest_lag_seconds', 'Seconds the last processed line is behind the clock',
+                      function=self.seconds_behind)
+        METRICS.gauge('ids_load_shedding', '1 while the ingest sheds load', function=lambda: int(self.shedding))
+        METRICS.gauge('ids_deferred_writes', 'Deferred graph writes which were not applied yet',
+                      function=lambda: len(self.deferred))
+
+    def start(self):
+        """Measures the lag and applies the deferred writes in a daemon thread.
+        """
+        self.shedding_status = True
+        threading.Thread(target=self._start, daemon=True).start()
+
+    def stop(self):
+        """Stops the daemon thread.
+        """
+        self.shedding_status = False
+
+    def _start(self):
+        """Checks the lag every CHECK_INTERVAL_SECONDS until stop is called.
+        """
+        while self.shedding_status is True:
+            time.sleep(CHECK_INTERVAL_SECONDS)
+            try:
+                self.check()
+            # The ingest continues without the timer, the lines still check the lag
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Checking the ingest lag raised an error: \n %s', exception)
+
+    @property
+    def deferring(self) -> bool:
+        """True if writes are deferred, also while the deferred writes are drained so
+        they keep their order.
+        """
+        return self.shedding or bool(self.deferred)
+
+    def seconds_behind(self) -> float:
+        """Returns the seconds between the clock and the last processed line.
+
+        Returns:
+            float: the lag, 0 if no line with a timestamp was processed
+        """
+        timestamp = self.last_log_timestamp()
+        return max(0.0, time.time() - timestamp) if timestamp else 0.0
+
+    @beartype
+    def admit(self, current_line: str) -> bool:
+        """Checks if a line is processed, the lines which are not are counted.
+
+        Args:
+            current_line (str): one row of the log file
+
+        Returns:
+            bool: True if the line has to be processed
+        """
+        self.lines_until_check -= 1
+        if self.lines_until_check <= 0:
+            self.lines_until_check = CHECK_LINES
+            self.check()
+        # The same lines the sessionizer reacts to
+        if not self.shedding or ' New c' in current_line or 'connect' in current_line:
+            return True
+        message = current_line.split(': ', 1)[-1].strip()
+        count = self.messages.get(message, 0) + 1
+        if count == 1 and len(self.messages) >= MAX_MESSAGES:
+            message = 'other'
+            count = self.messages.get(message, 0) + 1
+        self.messages[message] = count
+        if count == 1 or count % self.sample_rate == 0:
+            return True
+        LINES_SHED.inc(label_value='repeated' if count > 1 else 'informational')
+        return False
+
+    def check(self):
+        """Measures the lag, starts or ends the shedding and applies deferred writes if
+        it is not shedding.
+        """
+        with self._check_lock:
+            unread_bytes = self.bytes_behind()
+            lag_bytes = unread_bytes if self.lag_bytes else 0
+            # Without unread bytes the last line is old because the log is quiet
+            lag_seconds = self.seconds_behind() if self.lag_seconds and unread_bytes else 0.0
+            if not self.shedding:
+                if ((self.lag_bytes and lag_bytes > self.lag_bytes)
+                        or (self.lag_seconds and lag_seconds > self.lag_seconds)):
+                    self.shedding = True
+                    print(f'Shedding load, {lag_bytes} bytes and {lag_seconds:.0f} seconds behind the log')
+            elif lag_bytes <= self.lag_bytes / 2 and lag_seconds <= self.lag_seconds / 2:
+                self.shedding = False
+                print(f'Stopped shedding load, sampled {sum(self.messages.values())} lines of '
+                      f'{len(self.messages)} messages')
+                self.messages = {}
+            if not self.shedding and self.deferred:
+                self.drain(DRAIN_BATCH_SIZE)
+
+    def defer(self, function: Callable, *args):
+        """Keeps a write until the lag recovered.
+
+        Args:
+            function (Callable): e.g. a method of the graph storage
+            args: the arguments of the write
+        """
+        with self._lock:
+            if len(self.deferred) >= MAX_DEFERRED:
+                self.deferred.popleft()
+                WRITES_DEFERRED.inc(label_value='dropped')
+            self.deferred.append((function, args))
+        WRITES_DEFERRED.inc(label_value='deferred')
+
+    def drain(self, max_writes: Optional[int] = None) -> int:
+        """Applies the deferred writes in their order.
+
+        Args:
+            max_writes (int, optional): number of writes to apply, all if not set
+
+        Returns:
+            int: number of applied writes
+        """
+        applied = 0
+        while self.deferred and (max_writes is None or applied < max_writes):
+            with self._lock:
+                function, args = self.deferred.popleft()
+            try:
+                function(*args)
+            # A write which fails is dropped, the following ones are still applied
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Applying a deferred write raised an error: \n %s', exception)
+            applied += 1
+        WRITES_DEFERRED.inc(amount=applied, label_value='applied')
+        return applied
+
+    def summary(self) -> Dict[str, int]:
+        """Returns the informational messages of the current shedding and their count.
+
+        Returns:
+            Dict[str, int]: lines per message, the timestamp removed
+        """
+        return dict(self.messages)
+
+
+if __name__ == '__main__':
+    from log_generator import MosquittoLogGenerator
+
+    example_lag = [0]
+    example_shedder = LoadShedder(lambda: example_lag[0], lambda: 0.0, lag_bytes=1000, lag_seconds=0)
+    example_lag[0] = 5000
+    example_admitted = [example_line for example_line in MosquittoLogGenerator(seed=0).lines('normal', 20000)
+                        if example_shedder.admit(example_line)]
+    print(f'{len(example_admitted)} of 20000 lines processed', example_shedder.summary())
@@ -13,6 +13,8 @@ import time
 
 from beartype import beartype
 
+from stage_timing import STAGE_TIMING
+
 class LocalFileAccess:
     """This class defines how local files can be accessed.
     """
@@ -28,6 +30,7 @@ class LocalFileAccess:
         self.local_file = open(self.local_file_path, "r", encoding="utf-8")
         self.list_of_lines = self.local_file.readlines()
         self.local_file.seek(0)
+        self.read_offset = 0
 
     def close(self):
         """Closes the file when called
@@ -70,6 +73,18 @@ class LocalFileAccess:
         """
         return len(self.list_of_lines)
 
+    def bytes_behind_tail(self) -> int:
+        """Returns how many bytes were written to the file which the tail did not read
+        yet. The offset counts characters, which equals bytes for the ascii mosquitto log.
+
+        Returns:
+            int: size of the unread part of the file
+        """
+        try:
+            return max(0, os.path.getsize(self.local_file_path) - self.read_offset)
+        except FileNotFoundError:
+            return 0
+
     def tail_file(self, ):
         """Follows a file like the unix comand tail. Also works if logrotate is enabled.
 
@@ -81,8 +96,11 @@ class LocalFileAccess:
             with self.local_file as file:
                 if seek_end:
                     file.seek(0, 2)
+                self.read_offset = file.tell()
+                read_line = STAGE_TIMING.wrap(file.readline, 'read')
                 while True:
-                    line = file.readline()
+                    line = read_line()
+                    self.read_offset += len(line)
                     if not line:
                         try:
                             if file.tell() > os.path.getsize(self.local_file_path):
@@ -93,6 +111,8 @@ class LocalFileAccess:
                             pass
                         time.sleep(1)
                     yield line
+            # The file was rotated, continue with the new file from its beginning
+            self.local_file = open(self.local_file_path, "r", encoding="utf-8")
 
 
 if __name__ == "__main__":
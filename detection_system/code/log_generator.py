@@ -0,0 +1,253 @@
+"""This module generates synthetic mosquitto log files to test the detection system
+    without a broker and without the mqttsa attack pods. The lines use the same formats
+    the broker writes and FormatLog parses e.g.
+
+    1635015162: New connection from 10.244.0.12 on port 1883.
+    1635015162: New client connected from 10.244.0.12 as nodered_3f2a9c1e (p2, c1, k60).
+    1635015170: Client nodered_3f2a9c1e disconnected.
+
+    A replayer appends generated or recorded lines to a log file with a fixed rate or as
+    fast as possible, so the tailer, the parser and the detection can be measured end to end.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import argparse
+import random
+import time
+from typing import Iterable, Iterator, Optional
+
+from beartype import beartype
+
+SCENARIOS = ('normal', 'slow_dos', 'idle_hold', 'disconnect_storm', 'mixed', 'distributed_dos')
+BROKER_PORT = '1883'
+BROKER_VERSION = '1.6.9'
+KEEP_ALIVE = 60
+# Connections per ip address of the distributed slow dos, just below the host threshold
+DISTRIBUTED_CONNECTIONS_PER_IP = 49
+# Fraction of lines which are not connection events, like the periodic database save
+SAVE_LINE_PROBABILITY = 0.01
+
+
+class MosquittoLogGenerator:
+    """Generates mosquitto log lines for different traffic scenarios. The generator keeps
+    track of the connected clients by their client id prefix, so disconnects always refer
+    to a connected client of the right kind and attackers keep their connections open.
+    """
+
+    @beartype
+    def __init__(self, lines_per_second: float = 100.0, start_time: Optional[int] = None,
+                 seed: int = 0, attacker_ips: int = 2, normal_ips: int = 50, distributed_ips: int = 100):
+        """Initializes the generator.
+
+        Args:
+            lines_per_second (float): rate used to advance the timestamps of the log
+            start_time (int, optional): timestamp of the first line, defaults to now
+            seed (int): seed of the random generator to reproduce a log
+            attacker_ips (int): number of different attacker ip addresses
+            normal_ips (int): number of different ip addresses of benign clients
+            distributed_ips (int): number of ip addresses of the distributed slow dos
+        """
+        self.lines_per_second = lines_per_second
+        self.start_time = int(time.time()) if start_time is None else start_time
+        self.random = random.Random(seed)
+        self.attacker_ips = ['10.244.1.' + str(host) for host in range(10, 10 + attacker_ips)]
+        self.normal_ips = ['10.244.0.' + str(host) for host in range(10, 10 + normal_ips)]
+        self.distributed_ips = ['10.244.2.' + str(host) for host in range(10, 10 + distributed_ips)]
+        self.distributed_connections = {}
+        self.connected = {'nodered_': [], 'mqttsa-': [], 'idle-': []}
+        self.line_count = 0
+
+    @beartype
+    def lines(self, scenario: str, n_lines: int) -> Iterator[str]:
+        """Yields log lines of a scenario.
+
+        Args:
+            scenario (str): one of normal, slow_dos, idle_hold, disconnect_storm, mixed or
+            distributed_dos
+            n_lines (int): number of lines to generate
+
+        Yields:
+            str: one log line including the newline character
+        """
+        if scenario not in SCENARIOS:
+            raise ValueError('Unknown scenario ' + scenario + ', use one of ' + ', '.join(SCENARIOS))
+        yield from self._startup()
+        generated = 0
+        while generated < n_lines:
+            current = scenario
+            if scenario == 'mixed':
+                current = self.random.choices(SCENARIOS[:4], weights=(70, 15, 10, 5))[0]
+            for line in getattr(self, '_' + current)():
+                yield line
+                generated += 1
+                if generated >= n_lines:
+                    return
+
+    def _timestamp(self) -> str:
+        """Returns the log timestamp of the next line.
+        """
+        timestamp = self.start_time + int(self.line_count / self.lines_per_second)
+        self.line_count += 1
+        return str(timestamp)
+
+    def _startup(self) -> Iterator[str]:
+        """Lines written when the broker starts.
+        """
+        yield self._timestamp() + ': mosquitto version ' + BROKER_VERSION + ' starting\n'
+        yield self._timestamp() + ': Config loaded from /mosquitto/config/mosquitto.conf.\n'
+        yield self._timestamp() + ': Opening ipv4 listen socket on port ' + BROKER_PORT + '.\n'
+
+    def _connect(self, ip_address: str, prefix: str, keep_alive: int = KEEP_ALIVE) -> Iterator[str]:
+        """Lines of a new client.
+        """
+        client_id = prefix + '%08x' % self.random.getrandbits(32)
+        self.connected[prefix].append(client_id)
+        yield self._timestamp() + ': New connection from ' + ip_address + ' on port ' + BROKER_PORT + '.\n'
+        yield (self._timestamp() + ': New client connected from ' + ip_address + ' as ' + client_id
+               + ' (p2, c1, k' + str(keep_alive) + ').\n')
+
+    def _disconnect(self, prefix: str, reason: str = 'disconnected') -> Iterator[str]:
+        """Lines of a client leaving, reason is disconnected, timeout or socket_error.
+        """
+        clients = self.connected[prefix]
+        if not clients:
+            return
+        client_id = clients.pop(self.random.randrange(len(clients)))
+        if reason == 'timeout':
+            yield self._timestamp() + ': Client ' + client_id + ' has exceeded timeout, disconnecting.\n'
+        elif reason == 'socket_error':
+            yield self._timestamp() + ': Socket error on client ' + client_id + ', disconnecting.\n'
+        else:
+            yield self._timestamp() + ': Client ' + client_id + ' disconnected.\n'
+
+    def _maintenance(self) -> Iterator[str]:
+        """Informational lines which are not related to a client.
+        """
+        if self.random.random() < SAVE_LINE_PROBABILITY:
+            yield self._timestamp() + ': Saving in-memory database to /var/lib/mosquitto/mosquitto.db.\n'
+
+    def _normal(self) -> Iterator[str]:
+        """Benign clients which connect and disconnect at about the same rate.
+        """
+        yield from self._maintenance()
+        if len(self.connected['nodered_']) < 20 or self.random.random() < 0.5:
+            yield from self._connect(self.random.choice(self.normal_ips), 'nodered_')
+        else:
+            yield from self._disconnect('nodered_')
+
+    def _slow_dos(self) -> Iterator[str]:
+        """A few attacker ips open many connections and never close them.
+        """
+        yield from self._maintenance()
+        yield from self._connect(self.random.choice(self.attacker_ips), 'mqttsa-', keep_alive=65535)
+
+    def _idle_hold(self) -> Iterator[str]:
+        """Clients which connect with a long keep alive and only rarely time out.
+        """
+        yield from self._maintenance()
+        if self.random.random() < 0.9:
+            yield from self._connect(self.random.choice(self.attacker_ips + self.normal_ips),
+                                     'idle-', keep_alive=3600)
+        else:
+            yield from self._disconnect('idle-', 'timeout')
+
+    def _distributed_dos(self) -> Iterator[str]:
+        """Attackers of one network which keep their connections open, each ip address
+        stays below the threshold of a single host.
+        """
+        yield from self._maintenance()
+        ip_addresses = [ip_address for ip_address in self.distributed_ips
+                        if self.distributed_connections.get(ip_address, 0) < DISTRIBUTED_CONNECTIONS_PER_IP]
+        if not ip_addresses:
+            yield from self._normal()
+            return
+        ip_address = self.random.choice(ip_addresses)
+        self.distributed_connections[ip_address] = self.distributed_connections.get(ip_address, 0) + 1
+        yield from self._connect(ip_address, 'mqttsa-', keep_alive=65535)
+
+    def _disconnect_storm(self) -> Iterator[str]:
+        """Many clients leave at once, e.g. after a network failure.
+        """
+        prefixes = [prefix for prefix, clients in self.connected.items() if clients]
+        if not prefixes:
+            yield from self._normal()
+            return
+        for _ in range(10):
+            yield from self._disconnect(self.random.choice(prefixes),
+                                        self.random.choice(('disconnected', 'socket_error', 'timeout')))
+
+
+class LogReplayer:
+    """Appends log lines to a file like the broker does.
+    """
+
+    @beartype
+    def __init__(self, file_path: str):
+        """Initializes the replayer.
+
+        Args:
+            file_path (str): log file the lines are appended to
+        """
+        self.file_path = file_path
+
+    @beartype
+    def replay(self, lines: Iterable[str], lines_per_second: Optional[float] = None) -> int:
+        """Appends the lines to the log file. Each line is flushed so a tailer sees it
+        immediately.
+
+        Args:
+            lines (Iterable[str]): lines including the newline character
+            lines_per_second (float, optional): target rate, as fast as possible if None
+
+        Returns:
+            int: number of written lines
+        """
+        written = 0
+        start = time.perf_counter()
+        with open(self.file_path, 'a', encoding='utf-8') as log_file:
+            for line in lines:
+                if lines_per_second is not None:
+                    delay = start + written / lines_per_second - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                log_file.write(line)
+                log_file.flush()
+                written += 1
+        return written
+
+    @beartype
+    def replay_file(self, source_path: str, lines_per_second: Optional[float] = None) -> int:
+        """Appends the lines of a recorded log file.
+
+        Args:
+            source_path (str): recorded mosquitto log
+            lines_per_second (float, optional): target rate, as fast as possible if None
+
+        Returns:
+            int: number of written lines
+        """
+        with open(source_path, 'r', encoding='utf-8') as source_file:
+            return self.replay(source_file, lines_per_second)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate or replay mosquitto log lines.')
+    parser.add_argument('output', help='log file the lines are appended to')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='lines per second written to the file, as fast as possible if not set')
+    parser.add_argument('--source', default=None, help='replay a recorded log instead of generating one')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    replayer = LogReplayer(arguments.output)
+    begin = time.perf_counter()
+    if arguments.source is not None:
+        count = replayer.replay_file(arguments.source, arguments.rate)
+    else:
+        generator = MosquittoLogGenerator(lines_per_second=arguments.rate or 100.0, seed=arguments.seed)
+        count = replayer.replay(generator.lines(arguments.scenario, arguments.lines), arguments.rate)
+    elapsed = time.perf_counter() - begin
+    print(f'Wrote {count} lines in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} lines/s)')
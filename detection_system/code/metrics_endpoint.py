@@ -0,0 +1,375 @@
+"""This module exposes metrics of the detection system in the prometheus text format on
+    an http /metrics endpoint, e.g. lines per second, ingest lag, database latency and
+    alerts sent. The server runs in a daemon thread and is only started if the
+    environment variable IDS_METRICS_PORT is set.
+
+    The hot path never takes a lock: every thread increments its own cell of a metric
+    and the cells are only summed up when the endpoint is scraped. Values which are
+    expensive to compute, like the ingest lag, are read by a function at scrape time.
+    So are the depths of the queues, e.g. the backlog of the spool, the lines waiting
+    for an ingest worker and the deferred writes of the load shedder. The caches count
+    their lookups by result, hit or miss. The worker processes of the partitioned
+    ingest have their own metrics which are not served.
+
+    Adapted from:
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+    [last accessed April 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+from bisect import bisect_left
+import functools
+import logging
+import os
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+from beartype import beartype
+
+METRICS_PORT_VARIABLE = 'IDS_METRICS_PORT'
+# Bucket bounds in seconds, from a fast in memory call to a slow neo4j transaction
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class _ThreadCells:
+    """Gives every thread its own dictonary so updates need no lock. The list of all
+    cells is only locked when a thread uses a metric for the first time.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _new_cell(self) -> dict:
+        """Creates the cell of the calling thread.
+        """
+        cell = self._local.cell = {}
+        with self._lock:
+            self._cells.append(cell)
+        return cell
+
+    def _snapshot(self) -> list:
+        """Returns a copy of all cells.
+        """
+        with self._lock:
+            cells = list(self._cells)
+        return [dict(cell) for cell in cells]
+
+
+class Counter(_ThreadCells):
+    """A value which only increases, optionally split by the value of one label.
+    """
+
+    def __init__(self, name: str, documentation: str, label_name: Optional[str] = None):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+
+    def inc(self, amount: float = 1, label_value: str = ''):
+        """Adds the amount to the counter of the calling thread.
+
+        Args:
+            amount (float): value to add
+            label_value (str): value of the label if the counter has one
+        """
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        cell[label_value] = cell.get(label_value, 0) + amount
+
+    def samples(self) -> Dict[str, float]:
+        """Returns the sum of all threads by label value.
+        """
+        totals = {}
+        for cell in self._snapshot():
+            for label_value, value in cell.items():
+                totals[label_value] = totals.get(label_value, 0) + value
+        return totals
+
+    def exposition(self) -> str:
+        """Formats the counter in the prometheus text format.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_value, value in sorted(self.samples().items()):
+            lines.append(f'{self.name}{_labels(self.label_name, label_value)} {value}')
+        return '\n'.join(lines)
+
+
+class Gauge:
+    """A value which can go up and down. It is either set by the code or read from a
+    function whenever the endpoint is scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, label_name: Optional[str] = None,
+                 function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.function = function
+        self._values = {}
+
+    def set(self, value: float, label_value: str = ''):
+        """Sets the value, a single dictonary assignment which needs no lock.
+
+        Args:
+            value (float): the new value
+            label_value (str): value of the label if the gauge has one
+        """
+        self._values[label_value] = value
+
+    def replace(self, values: Dict[str, float]):
+        """Replaces the values of all labels at once, labels which are missing vanish.
+
+        Args:
+            values (Dict[str, float]): value by label value
+        """
+        self._values = dict(values)
+
+    def samples(self) -> Dict[str, float]:
+        """Returns the current values by label value.
+        """
+        if self.function is not None:
+            try:
+                return {'': self.function()}
+            # A failing function must not break the whole scrape
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Gauge %s raised an error: \n %s', self.name, exception)
+                return {}
+        return dict(self._values)
+
+    def exposition(self) -> str:
+        """Formats the gauge in the prometheus text format.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for label_value, value in sorted(self.samples().items()):
+            lines.append(f'{self.name}{_labels(self.label_name, label_value)} {value}')
+        return '\n'.join(lines)
+
+
+class Histogram(_ThreadCells):
+    """Counts observations in buckets with fixed upper bounds.
+    """
+
+    def __init__(self, name: str, documentation: str, label_name: Optional[str] = None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.buckets = buckets
+
+    def observe(self, value: float, label_value: str = ''):
+        """Adds an observation to the cell of the calling thread.
+
+        Args:
+            value (float): e.g. a duration in seconds
+            label_value (str): value of the label if the histogram has one
+        """
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        counts = cell.get(label_value)
+        if counts is None:
+            # One count per bucket, the +Inf bucket and the sum of all values
+            counts = cell[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def exposition(self) -> str:
+        """Formats the histogram with cumulative buckets in the prometheus text format.
+        """
+        totals = {}
+        for cell in self._snapshot():
+            for label_value, counts in cell.items():
+                total = totals.setdefault(label_value, [0] * len(counts[:-1]) + [0.0])
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_value, total in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), total[:-1]):
+                cumulative += count
+                bound_label = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.label_name, label_value, bound_label)} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_name, label_value)} {total[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.label_name, label_value)} {cumulative}')
+        return '\n'.join(lines)
+
+
+def _labels(label_name: Optional[str], label_value: str, bucket: Optional[str] = None) -> str:
+    """Formats the label set of a sample e.g. {method="create_host",le="0.5"}.
+    """
+    labels = []
+    if label_name is not None:
+        escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labels.append(f'{label_name}="{escaped}"')
+    if bucket is not None:
+        labels.append(f'le="{bucket}"')
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class MetricsRegistry:
+    """Holds all metrics of the process and serves them over http.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.server = None
+        # Instances which were created before the server, they are wrapped by start.
+        # Instances which are garbage collected drop out, so it does not grow without a server
+        self._instances = weakref.WeakKeyDictionary()
+
+    @property
+    def enabled(self) -> bool:
+        """True once the http server was started.
+        """
+        return self.server is not None
+
+    def counter(self, name: str, documentation: str, label_name: Optional[str] = None) -> Counter:
+        """Creates a counter or returns the existing one with the same name.
+        """
+        return self.metrics.setdefault(name, Counter(name, documentation, label_name))
+
+    def gauge(self, name: str, documentation: str, label_name: Optional[str] = None,
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        """Creates a gauge or returns the existing one with the same name. A function
+        replaces the function of an existing gauge, e.g. of a new file access object.
+        """
+        gauge = self.metrics.setdefault(name, Gauge(name, documentation, label_name))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, documentation: str, label_name: Optional[str] = None,
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Creates a histogram or returns the existing one with the same name.
+        """
+        return self.metrics.setdefault(name, Histogram(name, documentation, label_name, buckets))
+
+    @beartype
+    def instrument(self, instance: object, name: str):
+        """Wraps every public method of an instance to observe its duration in a
+        histogram and to count its errors, both labeled with the method name. Until
+        the server is started the instance is only remembered, so there is no overhead
+        without metrics and storages created before the server are wrapped by start.
+
+        Args:
+            instance (object): e.g. a Neo4jDatabaseAccess
+            name (str): prefix of the metric names
+        """
+        if not self.enabled:
+            self._instances[instance] = name
+            return
+        durations = self.histogram(name + '_call_seconds', 'Duration of database calls', 'method')
+        errors = self.counter(name + '_errors_total', 'Database calls which raised an error', 'method')
+        for method_name in dir(type(instance)):
+            if method_name.startswith('_') or not callable(getattr(type(instance), method_name)):
+                continue
+            method = getattr(instance, method_name)
+            setattr(instance, method_name, _observed(method, method_name, durations, errors))
+
+    def exposition(self) -> str:
+        """Returns all metrics in the prometheus text format.
+        """
+        return '\n'.join(metric.exposition() for metric in list(self.metrics.values())) + '\n'
+
+    @beartype
+    def start(self, port: int, address: str = ''):
+        """Serves the metrics on http://address:port/metrics in a daemon thread.
+
+        Args:
+            port (int): tcp port of the endpoint
+            address (str): interface to bind, all interfaces by default
+        """
+        if self.server is not None:
+            return
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """Answers scrapes of the /metrics path.
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Writes the exposition or 404 for other paths.
+                """
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Scrapes are not logged.
+                """
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        instances, self._instances = list(self._instances.items()), weakref.WeakKeyDictionary()
+        for instance, name in instances:
+            self.instrument(instance, name)
+        print(f'Serving metrics on port {port}')
+
+    def start_from_environment(self) -> bool:
+        """Starts the server if IDS_METRICS_PORT is set.
+
+        Returns:
+            bool: True if the server is running
+        """
+        port = os.environ.get(METRICS_PORT_VARIABLE)
+        if port:
+            self.start(int(port))
+        return self.enabled
+
+    def stop(self):
+        """Stops the server.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _observed(method: Callable, method_name: str, durations: Histogram, errors: Counter) -> Callable:
+    """Returns the method with duration and error recording.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            errors.inc(1, method_name)
+            raise
+        finally:
+            durations.observe(time.perf_counter() - start, method_name)
+    return wrapper
+
+
+METRICS = MetricsRegistry()
+
+
+if __name__ == '__main__':
+    import urllib.request
+
+    example_counter = METRICS.counter('ids_example_total', 'Example counter', 'kind')
+    example_counter.inc(1, 'a')
+    example_counter.inc(2, 'b')
+    METRICS.histogram('ids_example_seconds', 'Example histogram').observe(0.003)
+    METRICS.start(9464, '127.0.0.1')
+    with urllib.request.urlopen('http://127.0.0.1:9464/metrics') as response:
+        print(response.read().decode('utf-8'))
+    METRICS.stop()
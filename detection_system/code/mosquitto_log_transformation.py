@@ -3,151 +3,328 @@
     Licence: Apache 2.0
 """
 import json
+import logging
+from typing import Optional
 
-# Was used for performance testing
-# import time
-# from statistics import median, mean, stdev
-
+from beartype import beartype
 
+from client_allowlist import ClientAllowlist
+from connection_sessionizer import ConnectionSessionizer
 from local_file_access import LocalFileAccess
 from format_log import FormatLog
+from graph_storage import GraphStorage, create_graph_storage
 from neo4j_database_access import Neo4jDatabaseAccess
 from network_monitoring import NetworkMonitoring
 from initialize_system import InitializeSystem
+from graph_retention import GraphRetention
+from ip_blocklist import IpBlocklist
+from latency_tracing import TRACER
+from load_shedding import LoadShedder
+from metrics_endpoint import METRICS
+from query_profiler import PROFILER
+from stage_timing import STAGE_TIMING
+from subnet_monitoring import SubnetMonitoring
+from write_ahead_spool import spool_from_environment
 
 LOCAL_PATH = 'C:/kind_persistent_volume/pvc-0dd93242-6f2a-44bf-b4ee-b9879850159d_monitoring-system_mosquitto-log-pvc'
 FILE_NAME = 'mosquitto.log'
 NEO4J_URI = 'bolt://localhost:30687'
 NEO4J_USER = 'neo4j'
 NEO4J_PASS = '1234'
+# Inactive connections older than this are removed so detection only scans recent data
+CONNECTION_TTL_SECONDS = 24 * 60 * 60
+RETENTION_INTERVAL_SECONDS = 10 * 60
+# A known client which reconnects within this time writes no edge to the service, the
+# retention only deletes connections which were inactive for CONNECTION_TTL_SECONDS
+KNOWN_EDGE_SECONDS = 10 * 60
+# Known clients whose edge is remembered, all are forgotten when there are more
+MAX_KNOWN_EDGES = 100000
 
-if __name__ == "__main__":
-    local_file = LocalFileAccess(LOCAL_PATH, FILE_NAME)
-    log_formatter = FormatLog()
-    neo4j_driver = Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
-    network_monitoring = NetworkMonitoring(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
-    initialize_system = InitializeSystem()
-    initialize_system.demo_setup()
-    network_monitoring.start()
+LINES_PROCESSED = METRICS.counter('ids_log_lines_total', 'Log lines processed by the transformation')
+LINES_BLOCKED = METRICS.counter('ids_blocked_lines_total', 'Log lines of blocked hosts which were dropped')
 
-    # Was used for performance testing
-    #all_execution_times = []
-    #i = 1
 
-    loglines =  local_file.tail_file()
-    for current_line in loglines:
+class MosquittoLogTransformation:
+    """Transforms the lines of the mosquitto log to nodes and edges in the graph.
+    """
+
+    def __init__(self, neo4j_driver: GraphStorage, log_formatter: Optional[FormatLog] = None,
+                 sessionizer: Optional[ConnectionSessionizer] = None, blocklist: Optional[IpBlocklist] = None,
+                 load_shedder: Optional[LoadShedder] = None, allowlist: Optional[ClientAllowlist] = None):
+        """Initializes the transformation with the graph the lines are written to.
+
+        Args:
+            neo4j_driver (GraphStorage): storage of the graph, e.g. Neo4jDatabaseAccess
+            log_formatter (FormatLog, optional): extracts the data of a line, a new one is
+            created if not set
+            sessionizer (ConnectionSessionizer, optional): correlates the lines of a client,
+            a new one is created if not set
+            blocklist (IpBlocklist, optional): blocked hosts and networks whose lines are
+            dropped, if not set one is loaded from the graph
+            load_shedder (LoadShedder, optional): samples lines and defers enrichment while
+            the ingest lags behind the log, every line is processed fully if not set
+            allowlist (ClientAllowlist, optional): expected clients, their edge to the
+            service is merged once and not written again on every reconnect
+        """
+        self.neo4j_driver = neo4j_driver
+        self.log_formatter = log_formatter if log_formatter is not None else FormatLog()
+        self.sessionizer = sessionizer if sessionizer is not None else ConnectionSessionizer()
+        if blocklist is None:
+            blocklist = IpBlocklist()
+            try:
+                blocklist.load(neo4j_driver)
+            # The storage may be down at startup, the hosts are read again by the reload
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Loading the blocklist raised an error: \n %s', exception)
+        self.blocklist = blocklist
+        self.load_shedder = load_shedder
+        self.allowlist = allowlist
+        # Client id of a known client -> port, version and log time its edge was written
+        self.known_edges = {}
+        self.last_log_time = None
+        self.trace_event = None
+        METRICS.gauge('ids_last_log_timestamp_seconds', 'Timestamp of the last processed log line',
+                      function=self.last_log_timestamp)
+
+    def last_log_timestamp(self) -> float:
+        """Returns the timestamp of the last processed line. The ingest lag in seconds is
+        the current time minus this value.
+
+        Returns:
+            float: unix timestamp or 0 if no line with a timestamp was processed
+        """
+        try:
+            return float(self.last_log_time)
+        except (TypeError, ValueError):
+            return 0.0
 
-        # Was used for performance testing
-        #start_time = time.time() * 1000
+    @beartype
+    def process_line(self, current_line: str):
+        """Extracts the data of one log line and creates or updates the host, the
+        connection and their edges.
 
+        Args:
+            current_line (str): one row of the log file
+        """
+        if self.load_shedder is not None and not self.load_shedder.admit(current_line):
+            return
+        self.trace_event = TRACER.sample()
+        with STAGE_TIMING.time('process_line'):
+            self._process_line(current_line)
+        LINES_PROCESSED.inc()
+
+    def _process_line(self, current_line: str):
+        """Writes the data of one log line to the graph.
+
+        Args:
+            current_line (str): one row of the log file
+        """
         if current_line != "Socket error on client <unknown>, disconnecting.":
-            log_formatter.extract_ip_address_by_row(current_line)
-            log_formatter.extract_port_number_by_row(current_line)
-            # Extracts time for host an connection
-            log_formatter.extract_time_in_seconds_by_row(current_line)
-            log_formatter.extract_connection_name_by_row(current_line)
-            log_formatter.extract_version_by_row(current_line)
-
-            if None not in log_formatter.host_data.values():
-                if not neo4j_driver.check_if_node_exists('Host',
-                                                        'ip_address',
-                                                        log_formatter.host_data['ip_address']):
-                    neo4j_driver.create_host(json.dumps(log_formatter.host_data))
+            with STAGE_TIMING.time('parse'):
+                self.log_formatter.extract_ip_address_by_row(current_line)
+                self.log_formatter.extract_port_number_by_row(current_line)
+                # Extracts time for host an connection
+                self.log_formatter.extract_time_in_seconds_by_row(current_line)
+                self.log_formatter.extract_connection_name_by_row(current_line)
+                self.log_formatter.extract_version_by_row(current_line)
+                session_event = self.sessionizer.process_line(current_line)
+            # Disconnects only name the client, the session knows its ip address
+            if session_event is not None and session_event.kind == 'closed':
+                self.log_formatter.set_host_ip_address(session_event.session.ip_address)
+                self.log_formatter.set_connection_name(session_event.session.client_id)
+            self.last_log_time = self.log_formatter.connection_data['last_update_time']
+            if self.trace_event is not None:
+                self.trace_event.mark('parsed')
+
+            # Lines of blocked hosts and networks are dropped before any database work
+            if (self.log_formatter.host_data['ip_address'] is not None
+                    and self.blocklist.is_blocked(self.log_formatter.host_data['ip_address'])):
+                LINES_BLOCKED.inc()
+                self._reset_line_data()
+                return
+
+            if None not in self.log_formatter.host_data.values():
+                self.neo4j_driver.upsert_host(json.dumps(self.log_formatter.host_data))
 
             # Not sure anymore why this line is needed?
             if "/var/lib/mosquitto/mosquitto.db." in current_line:
-                log_formatter.reset_connection_data()
-                log_formatter.set_connection_status("active")
-
-            if log_formatter.service_data["port"] is not None and log_formatter.service_data["version"] is not None :
-                neo4j_driver.update_service_port("Mosquitto", log_formatter.service_data["port"])
-                neo4j_driver.update_service_version("Mosquitto", log_formatter.service_data["version"])
-                mosquitto_version = log_formatter.service_data["version"]
-                mosquitto_port = log_formatter.service_data["port"]
-                log_formatter.reset_service_data()
-
-            if log_formatter.connection_data['name'] is not None and log_formatter.host_data['ip_address'] is not None:
-  
-                if not neo4j_driver.check_if_host_is_blocked(log_formatter.host_data['ip_address']):
-
-                    if None not in log_formatter.connection_data.values():
-
-                        if not neo4j_driver.check_if_node_exists('Connection',
-                                                                'name',
-                                                                log_formatter.connection_data['name']):
-                            neo4j_driver.create_connection(json.dumps(log_formatter.connection_data))
-
-                        if not neo4j_driver.check_if_constraint_exists('Connection', ['name']):
-                            neo4j_driver.create_unique_property_constraint('Connection', ['name'])
-
-                    if "New client connected" in current_line:
-                        log_formatter.set_connection_status("active")
-                        neo4j_driver.update_connection_status(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['status'])
-                        neo4j_driver.update_connnection_time(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['last_update_time'])
-                        starts_connection_data = ('{'
-                                                    '"edge_name": "STARTS_CONNECTION",'
-                                                    '"node1": {  "name":"Host",'
-                                                                '"property_names": ["ip_address"],'
-                                                                '"property_values": ["' + log_formatter.host_data['ip_address'] + '"]},'
-                                                    '"node2": {  "name":"Connection",'
-                                                                '"property_names": ["name"],'
-                                                                '"property_values": ["' + log_formatter.connection_data['name'] + '"]}'
-                                                    '}'
-                                                )
-                        neo4j_driver.create_edge(starts_connection_data)
-
-                    if "New client connected" in current_line:
-
-                        #Default values if nothing could be read from log file
-                        if log_formatter.service_data['port'] is None or log_formatter.service_data['version'] is None:
-                            log_formatter.set_service_version("1.6.9")
-                            log_formatter.set_service_port("1883")
-
-                        connects_to_data = ('{'
-                                                    '"edge_name": "CONNECTS_TO",'
-                                                    '"node1": { "name":"Connection",'
+                self.log_formatter.reset_connection_data()
+                self.log_formatter.set_connection_status("active")
+
+            if self.log_formatter.service_data["port"] is not None and self.log_formatter.service_data["version"] is not None :
+                self._enrich(self.neo4j_driver.update_service_port, "Mosquitto",
+                             self.log_formatter.service_data["port"])
+                self._enrich(self.neo4j_driver.update_service_version, "Mosquitto",
+                             self.log_formatter.service_data["version"])
+                self.log_formatter.reset_service_data()
+
+            if self.log_formatter.connection_data['name'] is not None and self.log_formatter.host_data['ip_address'] is not None:
+
+                if None not in self.log_formatter.connection_data.values():
+
+                    self.neo4j_driver.upsert_connection(json.dumps(self.log_formatter.connection_data))
+
+                    if not self.neo4j_driver.check_if_constraint_exists('Connection', ['name']):
+                        self.neo4j_driver.create_unique_property_constraint('Connection', ['name'])
+
+                if "New client connected" in current_line:
+                    self.log_formatter.set_connection_status("active")
+                    self.neo4j_driver.update_connection_status(self.log_formatter.connection_data['name'],
+                                                             self.log_formatter.connection_data['status'])
+                    self._enrich(self.neo4j_driver.update_connnection_time, self.log_formatter.connection_data['name'],
+                                 self.log_formatter.connection_data['last_update_time'])
+                    starts_connection_data = ('{'
+                                                '"edge_name": "STARTS_CONNECTION",'
+                                                '"node1": {  "name":"Host",'
+                                                            '"property_names": ["ip_address"],'
+                                                            '"property_values": ["' + self.log_formatter.host_data['ip_address'] + '"]},'
+                                                '"node2": {  "name":"Connection",'
                                                             '"property_names": ["name"],'
-                                                            '"property_values": ["' + log_formatter.connection_data['name'] + '"]},'
-                                                    '"node2": {"name":"Service",'
-                                                            '"property_names": ["name", "port", "version"],'
-                                                            '"property_values": ["Mosquitto",'
-                                                                                '"'+ log_formatter.service_data['port'] +'",'
-                                                                                '"'+ log_formatter.service_data['version'] +'"]}'
-                                                    '}'
-                                                )
-                        neo4j_driver.create_edge(connects_to_data)
-                        log_formatter.reset_service_data()
-
-                    if 'disconnected' in current_line:
-                        log_formatter.set_connection_status("inactive")
-                        neo4j_driver.update_connection_status(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['status'])
-                        neo4j_driver.update_connnection_time(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['last_update_time'])
-
-                    if 'disconnecting' in current_line:
-                        log_formatter.set_connection_status("inactive")
-                        neo4j_driver.update_connection_status(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['status'])
-                        neo4j_driver.update_connnection_time(log_formatter.connection_data['name'],
-                                                            log_formatter.connection_data['last_update_time'])
-
-            log_formatter.reset_host_data()
-            log_formatter.reset_connection_data()
-            # Keep this here so the default value of the connection is set again
-            log_formatter.set_connection_status("active")
-
-            # Was used for performance testing
-            #end_time = time.time() * 1000
-            #execution_time = end_time - start_time
-            #all_execution_times.append(execution_time)
-            #if i == 100:
-            #    all_execution_times = list(filter(lambda num: num != 0.0, all_execution_times))
-            #    print(all_execution_times)
-            #    print(median(all_execution_times))
-            #    print(mean(all_execution_times))
-            #    print(stdev(all_execution_times))
-            #i = i+1
+                                                            '"property_values": ["' + self.log_formatter.connection_data['name'] + '"]}'
+                                                '}'
+                                            )
+                    self.neo4j_driver.create_edge(starts_connection_data)
+                    if self.trace_event is not None:
+                        TRACER.written(self.trace_event, self.log_formatter.host_data['ip_address'],
+                                       self.log_formatter.connection_data['last_update_time'])
 
+                if "New client connected" in current_line:
+                    # A client of the flows reconnects all the time, it keeps one edge to the broker
+                    is_known = self.allowlist is not None and self.allowlist.is_known(
+                        self.log_formatter.connection_data['name'])
+
+                    #Default values if nothing could be read from log file
+                    if self.log_formatter.service_data['port'] is None or self.log_formatter.service_data['version'] is None:
+                        self.log_formatter.set_service_version("1.6.9")
+                        self.log_formatter.set_service_port("1883")
+
+                    connects_to_data = ('{'
+                                                '"edge_name": "CONNECTS_TO",'
+                                                '"node1": { "name":"Connection",'
+                                                        '"property_names": ["name"],'
+                                                        '"property_values": ["' + self.log_formatter.connection_data['name'] + '"]},'
+                                                '"node2": {"name":"Service",'
+                                                        '"property_names": ["name", "port", "version"],'
+                                                        '"property_values": ["Mosquitto",'
+                                                                            '"'+ self.log_formatter.service_data['port'] +'",'
+                                                                            '"'+ self.log_formatter.service_data['version'] +'"]}'
+                                                '}'
+                                            )
+                    if not is_known:
+                        self._enrich(self.neo4j_driver.create_edge, connects_to_data)
+                    elif not self._has_known_edge():
+                        self._enrich(self.neo4j_driver.merge_edge, connects_to_data)
+                        self._add_known_edge()
+                    self.log_formatter.reset_service_data()
+
+                if 'disconnected' in current_line:
+                    self.log_formatter.set_connection_status("inactive")
+                    self.neo4j_driver.update_connection_status(self.log_formatter.connection_data['name'],
+                                                             self.log_formatter.connection_data['status'])
+                    self._enrich(self.neo4j_driver.update_connnection_time, self.log_formatter.connection_data['name'],
+                                 self.log_formatter.connection_data['last_update_time'])
+
+                if 'disconnecting' in current_line:
+                    self.log_formatter.set_connection_status("inactive")
+                    self.neo4j_driver.update_connection_status(self.log_formatter.connection_data['name'],
+                                                             self.log_formatter.connection_data['status'])
+                    self._enrich(self.neo4j_driver.update_connnection_time, self.log_formatter.connection_data['name'],
+                                 self.log_formatter.connection_data['last_update_time'])
+
+            self._reset_line_data()
+
+    def _has_known_edge(self) -> bool:
+        """Checks if the edge of the known client of the line to the service was written
+        within KNOWN_EDGE_SECONDS, so the connection and the edge still exist.
+        """
+        written = self.known_edges.get(self.log_formatter.connection_data['name'])
+        if written is None:
+            return False
+        port, version, log_time = written
+        try:
+            return (port == self.log_formatter.service_data['port']
+                    and version == self.log_formatter.service_data['version']
+                    and int(self.last_log_time) - log_time < KNOWN_EDGE_SECONDS)
+        except (TypeError, ValueError):
+            return False
+
+    def _add_known_edge(self):
+        """Remembers that the edge of the known client of the line was written.
+        """
+        try:
+            log_time = int(self.last_log_time)
+        except (TypeError, ValueError):
+            return
+        if len(self.known_edges) >= MAX_KNOWN_EDGES:
+            self.known_edges.clear()
+        self.known_edges[self.log_formatter.connection_data['name']] = (
+            self.log_formatter.service_data['port'], self.log_formatter.service_data['version'], log_time)
+
+    def _enrich(self, function, *args):
+        """Writes data the detection does not need, deferred while load is shed.
+        """
+        if self.load_shedder is not None and self.load_shedder.deferring:
+            self.load_shedder.defer(function, *args)
+        else:
+            function(*args)
+
+    def _reset_line_data(self):
+        """Resets the data of the line before the next one is read.
+        """
+        self.log_formatter.reset_host_data()
+        self.log_formatter.reset_connection_data()
+        # Keep this here so the default value of the connection is set again
+        self.log_formatter.set_connection_status("active")
+
+
+if __name__ == "__main__":
+    from partitioned_ingest import PartitionedIngest, partitioned_ingest_from_environment
+
+    METRICS.start_from_environment()
+    local_file = LocalFileAccess(LOCAL_PATH, FILE_NAME)
+    METRICS.gauge('ids_ingest_lag_bytes', 'Bytes of the log file which were not read yet',
+                  function=local_file.bytes_behind_tail)
+    neo4j_driver = create_graph_storage(uri=NEO4J_URI, user=NEO4J_USER, password=NEO4J_PASS)
+    allowlist = ClientAllowlist.from_flows()
+    if isinstance(neo4j_driver, Neo4jDatabaseAccess):
+        initialize_system = InitializeSystem()
+        initialize_system.demo_setup()
+        network_monitoring = NetworkMonitoring(NEO4J_URI, NEO4J_USER, NEO4J_PASS,
+                                               initialize_system.attack_path_cache)
+        graph_retention = GraphRetention(Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS))
+        graph_retention.create_retention_index()
+        graph_retention.start(CONNECTION_TTL_SECONDS, RETENTION_INTERVAL_SECONDS)
+    else:
+        # Topology, attack paths and retention need cypher, only the detection runs
+        neo4j_driver.create_service(json.dumps({'name': 'Mosquitto', 'port': '1883',
+                                                'version': '1.6.9', 'protocol': 'MQTT'}))
+        network_monitoring = NetworkMonitoring(NEO4J_URI, NEO4J_USER, NEO4J_PASS, neo4j_driver=neo4j_driver)
+    # With IDS_INGEST_WORKERS the lines are transformed by worker processes instead
+    line_processor = partitioned_ingest_from_environment(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+    if line_processor is None:
+        line_processor = MosquittoLogTransformation(spool_from_environment(neo4j_driver), allowlist=allowlist)
+        # Blocks of the detection drop the lines of the host at once, others after the reload
+        network_monitoring.add_block_listener(line_processor.blocklist.block)
+        line_processor.blocklist.start(neo4j_driver)
+    # Keeps the detection in real time if the log grows faster than it is transformed
+    line_processor.load_shedder = LoadShedder(local_file.bytes_behind_tail, line_processor.last_log_timestamp)
+    line_processor.load_shedder.start()
+    if isinstance(line_processor, PartitionedIngest) and (line_processor.load_shedder.lag_bytes
+                                                           or line_processor.load_shedder.lag_seconds):
+        logging.warning('Load shedding and ingest workers are both configured, the dispatcher samples the lines '
+                        'but the workers do not defer their enrichment')
+    network_monitoring.rule_engine.observe(line_processor.sessionizer)
+    # Clients which are not in the flows of the rooms are reported when they connect
+    allowlist.observe(line_processor.sessionizer)
+    network_monitoring.start()
+    # Only alerts, blocking a whole network would also block its benign clients
+    subnet_monitoring = SubnetMonitoring(line_processor.sessionizer)
+    subnet_monitoring.start()
+
+    STAGE_TIMING.install_signal_handler()
+    TRACER.install_signal_handler()
+    PROFILER.install_signal_handler()
+
+    loglines =  local_file.tail_file()
+    for current_line in loglines:
+        line_processor.process_line(current_line)
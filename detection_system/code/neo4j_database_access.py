@@ -7,15 +7,33 @@
     Licence: Apache 2.0
 '''
 import logging
-from typing import List
+from typing import List, Optional, Tuple
 import json
 
 from neo4j import GraphDatabase
 from neo4j.exceptions import ServiceUnavailable
 from beartype import beartype
 
-
-class Neo4jDatabaseAccess:
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+from query_profiler import PROFILER
+from stage_timing import STAGE_TIMING
+
+# Transaction function of each mutation which can be part of a batch
+BATCH_TRANSACTIONS = {'create_host': '_create_and_return_host',
+                      'upsert_host': '_upsert_and_return_host',
+                      'create_connection': '_create_and_return_connection',
+                      'upsert_connection': '_upsert_and_return_connection',
+                      'create_edge': '_create_and_return_edge',
+                      'merge_edge': '_merge_and_return_edge',
+                      'update_connection_status': '_update_and_return_connection_status',
+                      'update_connnection_time': '_update_and_return_connection_time',
+                      'update_host_ip_address': '_update_and_return_host_ip_address',
+                      'update_service_version': '_update_and_return_service_version',
+                      'update_service_port': '_update_and_return_service_port'}
+
+
+class Neo4jDatabaseAccess(GraphStorage):
     '''This class is initialies with a neo4j database driver to communicate
     with the neo4j database instance.
     '''
@@ -29,12 +47,30 @@ class Neo4jDatabaseAccess:
             password (str): [description]
         '''
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        STAGE_TIMING.instrument(self, 'neo4j.')
+        METRICS.instrument(self, 'ids_db')
 
     def close(self):
         '''Closes the driver object.
         '''
         self.driver.close()
 
+    @staticmethod
+    def _write_transaction(session, work, *args):
+        '''Runs a transaction function in a write transaction. If query profiling is
+        enabled the function is wrapped to record the summaries of its queries.
+
+        Args:
+            session (driver.session): session to run the transaction in
+            work (Callable): transaction function which gets the transaction and args
+
+        Returns:
+            The return value of the transaction function.
+        '''
+        if PROFILER.enabled:
+            work = PROFILER.wrap(work)
+        return session.write_transaction(work, *args)
+
     @beartype
     def create_host(self, host_json: str):
         '''Creates a host node in the database.
@@ -43,8 +79,8 @@ class Neo4jDatabaseAccess:
             host_json (str): data of the host in json format
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_host, host_json)
+            result = self._write_transaction(
+                session, self._create_and_return_host, host_json)
             for record in result:
                 print(f'Created host node: {record["h1"]}')
 
@@ -76,6 +112,50 @@ class Neo4jDatabaseAccess:
             logging.error('%s raised an error: \n %s', query, exception)
             raise
 
+    @beartype
+    def upsert_host(self, host_json: str):
+        '''Creates a host node in the database if no host has the ip address. Saves the
+        round trip of checking the existence first.
+
+        Args:
+            host_json (str): data of the host in json format
+        '''
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._upsert_and_return_host, host_json)
+            for record in result:
+                if record['created']:
+                    print(f'Created host node: {record["h1"]}')
+
+    @staticmethod
+    def _upsert_and_return_host(transax, host_json: str):
+        '''Executes a merge statement on the ip address and loads in json data.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            host_json (str): data of the host in json format
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        '''
+        query = (
+            'WITH apoc.convert.fromJsonMap(\''+ host_json +'\') as host_data '
+            'MERGE (h1:Host { ip_address: host_data.ip_address }) '
+            'ON CREATE SET h1.creation_time = host_data.creation_time, '
+                          'h1.notification_sent = host_data.notification_sent, '
+                          'h1.is_blocked = host_data.is_blocked '
+            'RETURN h1'
+        )
+        result = transax.run(query)
+        try:
+            records = [record['h1']['ip_address'] for record in result]
+            created = result.consume().counters.nodes_created > 0
+            return [{'h1': value, 'created': created} for value in records]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
     @beartype
     def create_connection(self, connection_json: str):
         '''Creates a connection node in the database.
@@ -84,8 +164,8 @@ class Neo4jDatabaseAccess:
             connection_json (str): data of the connection in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_connection, connection_json)
+            result = self._write_transaction(
+                session, self._create_and_return_connection, connection_json)
             for record in result:
                 print(f'Created connection: {record["c1"]}')
 
@@ -117,6 +197,50 @@ class Neo4jDatabaseAccess:
             logging.error('%s raised an error: \n %s', query, exception)
             raise
 
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        '''Creates a connection node in the database if no connection has the name.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        '''
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._upsert_and_return_connection, connection_json)
+            for record in result:
+                if record['created']:
+                    print(f'Created connection: {record["c1"]}')
+
+    @staticmethod
+    def _upsert_and_return_connection(transax, connection_json: str):
+        '''Executes a merge statement on the name and loads in json data for a new
+        connection.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            connection_json (str): data of the connection in json format
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        '''
+        query = (
+            'WITH apoc.convert.fromJsonMap(\''+ connection_json +'\') as connection_data '
+            'MERGE (c1:Connection { name: connection_data.name }) '
+            'ON CREATE SET c1.status = connection_data.status, '
+                          'c1.port = connection_data.port, '
+                          'c1.last_update_time = connection_data.last_update_time '
+            'RETURN c1'
+        )
+        result = transax.run(query)
+        try:
+            records = [record['c1']['name'] for record in result]
+            created = result.consume().counters.nodes_created > 0
+            return [{'c1': value, 'created': created} for value in records]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
     @beartype
     def create_service(self, service_json: str):
         '''Creates a service node in the database.
@@ -125,8 +249,8 @@ class Neo4jDatabaseAccess:
             service_json (str): data of the service in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_service, service_json)
+            result = self._write_transaction(
+                session, self._create_and_return_service, service_json)
             for record in result:
                 print(f'Created service node: {record["s"]}')
 
@@ -166,8 +290,8 @@ class Neo4jDatabaseAccess:
             vulnerability_json (str): data of the vulnerability in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_vulnerability, vulnerability_json)
+            result = self._write_transaction(
+                session, self._create_and_return_vulnerability, vulnerability_json)
             for record in result:
                 print(f'Created vulnerability node: {record["v"]}')
 
@@ -210,8 +334,8 @@ class Neo4jDatabaseAccess:
             attack_json (str): data of the attack in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_attack, attack_json)
+            result = self._write_transaction(
+                session, self._create_and_return_attack, attack_json)
             for record in result:
                 print(f'Created attack node: {record["a"]}')
 
@@ -250,8 +374,8 @@ class Neo4jDatabaseAccess:
             precondition_json (str): data of the precondition in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_precondition, precondition_json)
+            result = self._write_transaction(
+                session, self._create_and_return_precondition, precondition_json)
             for record in result:
                 print(f'Created precondition node: {record["p"]}')
 
@@ -292,8 +416,8 @@ class Neo4jDatabaseAccess:
             connection_json (str): data of the edge in json format.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_and_return_edge, edge_data)
+            result = self._write_transaction(
+                session, self._create_and_return_edge, edge_data)
             for record in result:
                 print(f'Created edge: {record["e1"]}')
 
@@ -328,6 +452,47 @@ class Neo4jDatabaseAccess:
             raise
 
 
+    @beartype
+    def merge_edge(self, edge_data: str):
+        '''Creates a edge between two nodes in the database if they are not connected
+        by an edge of the same type yet.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        '''
+        with self.driver.session() as session:
+            self._write_transaction(session, self._merge_and_return_edge, edge_data)
+
+    def _merge_and_return_edge(self, transax, edge_data: str):
+        '''Executes a merge statement and loads in json data.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            edge_data (str): data of the edge in json format
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        '''
+        edge_data = json.loads(edge_data)
+        where_clause = self._format_json_array_to_where_clause(edge_data['node1'],
+                                                               edge_data['node2'])
+        query = (
+                'MATCH'
+                '   (a: ' + edge_data['node1']['name'] + '), '
+                '   (b: ' + edge_data['node2']['name'] + ') '
+                '' + where_clause + ' '
+                'MERGE (a)-[r:' + edge_data['edge_name'] + ']->(b) '
+                'RETURN type(r) '
+            )
+        result = transax.run(query)
+        try:
+            return [{'e1': record['type(r)']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
     @beartype
     def create_unique_property_constraint(self, node_name: str, property_names: List [str]):
         '''Create a unqiue property constraits for a node property.
@@ -337,8 +502,8 @@ class Neo4jDatabaseAccess:
             property_name (str): name of property the constraint should be applied on.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._create_unique_property_constraint, node_name, property_names)
+            result = self._write_transaction(
+                session, self._create_unique_property_constraint, node_name, property_names)
             if result is None:
                 property_names_str = ''.join(property_names)
                 print(f'Created unique property for node: {node_name} property: {property_names_str}')
@@ -387,8 +552,8 @@ class Neo4jDatabaseAccess:
             bool: Ture if node exists False otherwise.
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._check_if_node_exists, node_name, property_name, property_value)
+            result = self._write_transaction(
+                session, self._check_if_node_exists, node_name, property_name, property_value)
         return result
 
     @staticmethod
@@ -435,8 +600,8 @@ class Neo4jDatabaseAccess:
             bool: Ture if node exists False otherwise
         '''
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._check_if_constraint_exists, node_name, property_names)
+            result = self._write_transaction(
+                session, self._check_if_constraint_exists, node_name, property_names)
         return result
 
     def _check_if_constraint_exists(self, transax, node_name: str, property_names: str):
@@ -484,8 +649,8 @@ class Neo4jDatabaseAccess:
             bool: Ture if host is currently blocked
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self. _check_if_host_is_blocked, ip_address)
+            result = self._write_transaction(
+                session, self. _check_if_host_is_blocked, ip_address)
         return result
 
     def _check_if_host_is_blocked(self, transax, ip_address: str):
@@ -529,8 +694,8 @@ class Neo4jDatabaseAccess:
             status (str): status to be set for the connection
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_connection_status, connection_name, status)
+            result = self._write_transaction(
+                session, self._update_and_return_connection_status, connection_name, status)
         for record in result:
             print(f'Updated Connection Status: {record}')
 
@@ -571,8 +736,8 @@ class Neo4jDatabaseAccess:
             is_blocked (bool): state of the block status (True/False)
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_host_block, ip_address, is_blocked)
+            result = self._write_transaction(
+                session, self._update_and_return_host_block, ip_address, is_blocked)
         for record in result:
             print(f'Updated block status of host: {record}')
 
@@ -613,8 +778,8 @@ class Neo4jDatabaseAccess:
             sent (bool): state of the notification status (True/False)
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_host_notification_sent, ip_address, sent)
+            result = self._write_transaction(
+                session, self._update_and_return_host_notification_sent, ip_address, sent)
         for record in result:
             print(f'Updated notification sent of host: {record}')
 
@@ -645,6 +810,56 @@ class Neo4jDatabaseAccess:
             logging.error('%s raised an error: \n %s', query, exception)
             raise
 
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Updates the ip address of a host e.g. when a pod was restarted with a new ip.
+        If a host with the new ip address exists already, e.g. the ingest created it
+        from the log, the host is not moved, so there are never two hosts with one ip
+        address.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._update_and_return_host_ip_address, old_ip_address, new_ip_address)
+        for record in result:
+            if record['taken']:
+                logging.error('The host %s was not moved to %s, a host with this ip address exists',
+                              old_ip_address, new_ip_address)
+            elif record['h'] is not None:
+                print(f'Updated ip address of host: {record}')
+
+    @staticmethod
+    @beartype
+    def _update_and_return_host_ip_address(transax, old_ip_address: str, new_ip_address: str):
+        """Execute the query to update the ip address of the host.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        query = (
+                'OPTIONAL MATCH (h:Host {ip_address: $old_ip_address}) '
+                'OPTIONAL MATCH (other:Host {ip_address: $new_ip_address}) '
+                'FOREACH (unused IN CASE WHEN h IS NOT NULL AND other IS NULL THEN [1] ELSE [] END | '
+                'SET h.ip_address = $new_ip_address) '
+                'RETURN h.ip_address AS h, other IS NOT NULL AND h IS NOT NULL AS taken'
+                )
+        result = transax.run(query, old_ip_address=old_ip_address, new_ip_address=new_ip_address)
+        try:
+            return [{'h': record['h'], 'taken': record['taken']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
     @beartype
     def update_connnection_time(self, connection_name: str, time: str):
         """Updates the connection node with the latest timestamp when it was
@@ -655,8 +870,8 @@ class Neo4jDatabaseAccess:
             time (str): the timestamp to set
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_connection_time, connection_name, time)
+            result = self._write_transaction(
+                session, self._update_and_return_connection_time, connection_name, time)
         for record in result:
             print(f'Updated Connection Time: {record}')
 
@@ -696,8 +911,8 @@ class Neo4jDatabaseAccess:
             version (str): version of the service
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_service_version, service_name, version)
+            result = self._write_transaction(
+                session, self._update_and_return_service_version, service_name, version)
         for record in result:
             print(f'Updated service version: {record}')
 
@@ -737,8 +952,8 @@ class Neo4jDatabaseAccess:
             port (str): port of the service
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._update_and_return_service_port, service_name, port)
+            result = self._write_transaction(
+                session, self._update_and_return_service_port, service_name, port)
         for record in result:
             print(f'Updated service port: {record}')
 
@@ -770,33 +985,347 @@ class Neo4jDatabaseAccess:
             raise
 
     @beartype
-    def execute_and_return_query_result(self, query: str):
+    def write_batch(self, mutations: List[Tuple[str, tuple]]):
+        """Applies the mutations in one write transaction, so the batch costs one commit
+        instead of one per mutation.
+
+        Args:
+            mutations (List[Tuple[str, tuple]]): name of the method and its arguments
+        """
+        with self.driver.session() as session:
+            self._write_transaction(session, self._apply_and_return_batch, mutations)
+
+    def _apply_and_return_batch(self, transax, mutations: List[Tuple[str, tuple]]):
+        """Executes the transaction function of every mutation.
+
+        Args:
+            transax (driver.session): seesion object to execute the queries
+            mutations (List[Tuple[str, tuple]]): name of the method and its arguments
+
+        Returns:
+            int: number of applied mutations
+        """
+        for method_name, args in mutations:
+            getattr(self, BATCH_TRANSACTIONS[method_name])(transax, *args)
+        return len(mutations)
+
+    @beartype
+    def merge_nodes(self, node_name: str, key_names: List[str], rows: List[dict],
+                    create_rows: Optional[List[dict]] = None):
+        """Creates or updates a batch of nodes in a single transaction. Nodes are
+        matched by their key properties, all other properties of a row are set on
+        the node.
+
+        Args:
+            node_name (str): label of the nodes e.g. Host
+            key_names (List[str]): names of the properties which identify a node
+            rows (List[dict]): one dictonary with the properties for each node
+            create_rows (List[dict], optional): one dictonary for each node with the
+            properties which are only set if the node is created
+        """
+        if create_rows is None:
+            create_rows = [{}] * len(rows)
+        rows = [{'properties': row, 'create_properties': create_row} for row, create_row in zip(rows, create_rows)]
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._merge_and_return_nodes, node_name, key_names, rows)
+        for record in result:
+            print(f'Merged {node_name} nodes: {record["count"]}')
+
+    def _merge_and_return_nodes(self, transax, node_name: str, key_names: List[str], rows: List[dict]):
+        """Executes the merge query for a batch of nodes.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            node_name (str): label of the nodes e.g. Host
+            key_names (List[str]): names of the properties which identify a node
+            rows (List[dict]): the properties and the properties set on create for
+            each node
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        query = (
+                'UNWIND $rows AS row '
+                'MERGE (n:' + node_name + ' ' + self._format_property_map(key_names, 'row.properties') + ') '
+                'ON CREATE SET n += row.create_properties '
+                'SET n += row.properties '
+                'RETURN count(n) AS count'
+                )
+        result = transax.run(query, rows=rows)
+        try:
+            return [{'count': record['count']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    @beartype
+    def delete_nodes(self, node_name: str, key_names: List[str], rows: List[dict],
+                     managed_property: Optional[str] = None):
+        """Deletes a batch of nodes together with their relations in a single transaction.
+
+        Args:
+            node_name (str): label of the nodes e.g. Host
+            key_names (List[str]): names of the properties which identify a node
+            rows (List[dict]): one dictonary with the key properties for each node
+            managed_property (str, optional): marks the nodes and relations of the
+            caller, a node which still has a relation without it is not deleted, it
+            only loses the property
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._delete_and_return_nodes, node_name, key_names, rows, managed_property)
+        for record in result:
+            print(f'Deleted {node_name} nodes: {record["count"]}')
+
+    def _delete_and_return_nodes(self, transax, node_name: str, key_names: List[str], rows: List[dict],
+                                 managed_property: Optional[str] = None):
+        """Executes the delete query for a batch of nodes.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            node_name (str): label of the nodes e.g. Host
+            key_names (List[str]): names of the properties which identify a node
+            rows (List[dict]): one dictonary with the key properties for each node
+            managed_property (str, optional): nodes with a relation without it are kept
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        if managed_property is None:
+            query = (
+                    'UNWIND $rows AS row '
+                    'MATCH (n:' + node_name + ' ' + self._format_property_map(key_names, 'row') + ') '
+                    'DETACH DELETE n '
+                    'RETURN count(*) AS count'
+                    )
+        else:
+            query = (
+                    'UNWIND $rows AS row '
+                    'MATCH (n:' + node_name + ' ' + self._format_property_map(key_names, 'row') + ') '
+                    'WITH n, size([(n)-[r]-() WHERE coalesce(r.' + managed_property + ', "False") <> "True" | r]) '
+                    'AS unmanaged '
+                    'FOREACH (unused IN CASE WHEN unmanaged > 0 THEN [1] ELSE [] END | REMOVE n.' + managed_property + ') '
+                    'WITH n, unmanaged WHERE unmanaged = 0 '
+                    'DETACH DELETE n '
+                    'RETURN count(*) AS count'
+                    )
+        result = transax.run(query, rows=rows)
+        try:
+            return [{'count': record['count']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    @beartype
+    def merge_edges(self, edge_name: str, node1: dict, node2: dict, rows: List[dict]):
+        """Creates or updates a batch of edges of the same type in a single transaction.
+        The node descriptions use the same format as create_edge but without values,
+        the values are taken from each row.
+        e.g. node1 = {"name": "Service", "property_names": ["name"]}
+             row = {"node1": {"name": "Mosquitto"}, "node2": {...}, "properties": {...}}
+        The properties in create_properties of a row are only set if the edge is
+        created.
+
+        Args:
+            edge_name (str): type of the edges e.g. HOSTED_AT
+            node1 (dict): label and key property names of the start nodes
+            node2 (dict): label and key property names of the end nodes
+            rows (List[dict]): key values of both nodes and the edge properties
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._merge_and_return_edges, edge_name, node1, node2, rows)
+        for record in result:
+            print(f'Merged {edge_name} edges: {record["count"]}')
+
+    def _merge_and_return_edges(self, transax, edge_name: str, node1: dict, node2: dict, rows: List[dict]):
+        """Executes the merge query for a batch of edges.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            edge_name (str): type of the edges e.g. HOSTED_AT
+            node1 (dict): label and key property names of the start nodes
+            node2 (dict): label and key property names of the end nodes
+            rows (List[dict]): key values of both nodes and the edge properties
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        query = (
+                'UNWIND $rows AS row '
+                'MATCH (a:' + node1['name'] + ' '
+                    + self._format_property_map(node1['property_names'], 'row.node1') + ') '
+                'MATCH (b:' + node2['name'] + ' '
+                    + self._format_property_map(node2['property_names'], 'row.node2') + ') '
+                'MERGE (a)-[r:' + edge_name + ']->(b) '
+                'ON CREATE SET r += coalesce(row.create_properties, {}) '
+                'SET r += row.properties '
+                'RETURN count(r) AS count'
+                )
+        result = transax.run(query, rows=rows)
+        try:
+            return [{'count': record['count']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    @beartype
+    def delete_edges(self, edge_name: str, node1: dict, node2: dict, rows: List[dict]):
+        """Deletes a batch of edges of the same type in a single transaction. The
+        nodes stay untouched.
+
+        Args:
+            edge_name (str): type of the edges e.g. HOSTED_AT
+            node1 (dict): label and key property names of the start nodes
+            node2 (dict): label and key property names of the end nodes
+            rows (List[dict]): key values of both nodes
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._delete_and_return_edges, edge_name, node1, node2, rows)
+        for record in result:
+            print(f'Deleted {edge_name} edges: {record["count"]}')
+
+    def _delete_and_return_edges(self, transax, edge_name: str, node1: dict, node2: dict, rows: List[dict]):
+        """Executes the delete query for a batch of edges.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+            edge_name (str): type of the edges e.g. HOSTED_AT
+            node1 (dict): label and key property names of the start nodes
+            node2 (dict): label and key property names of the end nodes
+            rows (List[dict]): key values of both nodes
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        query = (
+                'UNWIND $rows AS row '
+                'MATCH (a:' + node1['name'] + ' '
+                    + self._format_property_map(node1['property_names'], 'row.node1') + ')'
+                '-[r:' + edge_name + ']->'
+                '(b:' + node2['name'] + ' '
+                    + self._format_property_map(node2['property_names'], 'row.node2') + ') '
+                'DELETE r '
+                'RETURN count(*) AS count'
+                )
+        result = transax.run(query, rows=rows)
+        try:
+            return [{'count': record['count']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    def count_active_connections_per_host(self):
+        """Counts the active connections of every host which is neither blocked nor
+        already notified. This is the query of the detection loop.
+
+        Returns:
+            result (list): a list of dictonaries with the host properties as h and the
+            number of active connections as count
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._count_and_return_active_connections_per_host)
+            return result
+
+    @staticmethod
+    def _count_and_return_active_connections_per_host(transax):
+        """Executes the query counting the active connections of each host.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+
+        Returns:
+            Iteratable: A list of dictonaries with the data from the query.
+        """
+        query = (
+                'MATCH (h:Host)-[r:STARTS_CONNECTION]->(c:Connection) '
+                'WHERE c.status = "active" AND h.notification_sent = "False" AND h.is_blocked = "False" '
+                'RETURN h, count(r) as count'
+                )
+        result = transax.run(query)
+        try:
+            return [{'h': dict(record['h']), 'count': record['count']}
+                    for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    def get_blocked_hosts(self):
+        """Returns the ip addresses of all blocked hosts.
+
+        Returns:
+            List[str]: the ip addresses
+        """
+        with self.driver.session() as session:
+            result = self._write_transaction(
+                session, self._get_and_return_blocked_hosts)
+            return result
+
+    @staticmethod
+    def _get_and_return_blocked_hosts(transax):
+        """Executes the query returning the blocked hosts.
+
+        Args:
+            transax (driver.session): seesion object to execute the query
+
+        Returns:
+            Iteratable: A list of ip addresses.
+        """
+        query = (
+                'MATCH (h:Host) '
+                'WHERE h.is_blocked = "True" '
+                'RETURN h.ip_address as ip_address'
+                )
+        result = transax.run(query)
+        try:
+            return [record['ip_address'] for record in result]
+        # Capture any errors along with the query and data for traceability
+        except ServiceUnavailable as exception:
+            logging.error('%s raised an error: \n %s', query, exception)
+            raise
+
+    @beartype
+    def execute_and_return_query_result(self, query: str, parameters: Optional[dict] = None):
         """Execute a query based on the chyper string provided
 
         Args:
             query (str): a chyper query
+            parameters (dict, optional): query parameters referenced as $name in the query
 
         Returns:
             result (list): a list of dictonary each row of the result a dict
         """
         with self.driver.session() as session:
-            result = session.write_transaction(
-                self._execute_and_return_query_result, query)
+            result = self._write_transaction(
+                session, self._execute_and_return_query_result, query, parameters)
             return result
 
     @staticmethod
     @beartype
-    def _execute_and_return_query_result(transax, query):
+    def _execute_and_return_query_result(transax, query, parameters: Optional[dict] = None):
         """Exectues a query provided by the query parameter
 
         Args:
             transax (driver.session): seesion object to execute the query
             query (str): a chyper query
+            parameters (dict, optional): query parameters referenced as $name in the query
 
         Returns:
             [type]: [description]
         """
-        result = transax.run(query)
+        result = transax.run(query, parameters)
         try:
             return result.data()
         # Capture any errors along with the query and data for traceability
@@ -827,6 +1356,23 @@ class Neo4jDatabaseAccess:
             formated_entries = '(' + formated_entries + ')'
             return formated_entries
 
+    @staticmethod
+    @beartype
+    def _format_property_map(key_names: List[str], row_name: str):
+        """Format property names to a chyper map which takes the values from a row
+        of an UNWIND statement.
+        e.g. ['name', 'port'] and 'row' -> {name: row.name, port: row.port}
+
+        Args:
+            key_names (List[str]): a list of property name strings
+            row_name (str): the variable the values are read from
+
+        Returns:
+            [str]: a string containing the property map in the proper chyper format
+        """
+        entries = [name + ': ' + row_name + '.' + name for name in key_names]
+        return '{' + ', '.join(entries) + '}'
+
     @staticmethod
     @beartype
     def _format_json_array_to_where_clause(node1: dict, node2: dict):
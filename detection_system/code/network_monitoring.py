@@ -2,70 +2,111 @@
     Author: Thorsten Steuer
     Licence: Apache 2.0
 """
-#from statistics import median, mean, stdev
-import time
+import heapq
 import threading
+import time
 import sys
+from typing import Callable, List, Optional
 
 from alarm_notification import AlarmNotification
-from neo4j_database_access import Neo4jDatabaseAccess
+from graph_storage import GraphStorage, create_graph_storage
+from attack_path_cache import AttackPathCache
+from latency_tracing import TRACER
+from metrics_endpoint import METRICS
+from rule_engine import create_rule_engine
+from stage_timing import STAGE_TIMING
+
+DETECTION_PASS_SECONDS = METRICS.histogram('ids_detection_pass_seconds', 'Duration of a detection pass')
+ALERTS_SENT = METRICS.counter('ids_alerts_sent_total', 'Alerts sent for hosts with too many connections')
+# Only the hosts with the most connections get a label, so the number of series is bounded
+TOP_HOSTS = 10
+ACTIVE_CONNECTIONS = METRICS.gauge('ids_active_connections', 'Active connections of hosts which are not blocked yet')
+TOP_HOST_CONNECTIONS = METRICS.gauge('ids_top_host_active_connections',
+                                     'Active connections of the hosts with the most which are not blocked yet',
+                                     'host')
 
 class NetworkMonitoring:
 
-    def __init__(self, uri: str, user: str, password: str) -> None:
-        self.neo4j_driver = Neo4jDatabaseAccess(uri, user, password)
-        self.email_notification = AlarmNotification()
+    def __init__(self, uri: str, user: str, password: str,
+                 attack_path_cache: Optional[AttackPathCache] = None,
+                 neo4j_driver: Optional[GraphStorage] = None, email_notification=None,
+                 rule_engine=None) -> None:
+        self.neo4j_driver = (neo4j_driver if neo4j_driver is not None
+                             else create_graph_storage(uri=uri, user=user, password=password))
+        self.email_notification = email_notification if email_notification is not None else AlarmNotification()
+        # The rules of config/detection_rules.json in the mode of IDS_DETECTION_MODE if not set
+        self.rule_engine = rule_engine if rule_engine is not None else create_rule_engine()
         self.monitoring_status = True
+        self.attack_path_cache = attack_path_cache
+        self.block_listeners = []
+
+    def add_block_listener(self, listener: Callable[[str], None]):
+        """Registers a function which gets the ip address of every host the detection
+        blocks, e.g. IpBlocklist.block of the log transformation.
+
+        Args:
+            listener (Callable[[str], None]): called after the block is written
+        """
+        self.block_listeners.append(listener)
+
+    def run_detection_pass(self) -> List[str]:
+        """Counts the active connections of each host once, evaluates all rules of the
+        rule engine and reports the findings. Hosts of blocking rules are blocked.
+
+        Returns:
+            List[str]: ip addresses of the hosts and networks which were reported
+        """
+        start = time.perf_counter()
+        with STAGE_TIMING.time('detection_pass'):
+            reported_hosts = self._run_detection_pass()
+        DETECTION_PASS_SECONDS.observe(time.perf_counter() - start)
+        return reported_hosts
+
+    def _run_detection_pass(self) -> List[str]:
+        """Executes the detection pass.
+
+        Returns:
+            List[str]: ip addresses of the hosts and networks which were reported
+        """
+        reported_hosts = []
+        alert_times = {}
+        pass_start = time.monotonic()
+        result = self.neo4j_driver.count_active_connections_per_host()
+        detected = time.monotonic()
+        ACTIVE_CONNECTIONS.set(sum(row['count'] for row in result or []))
+        TOP_HOST_CONNECTIONS.replace({row['h']['ip_address']: row['count']
+                                      for row in heapq.nlargest(TOP_HOSTS, result or [], key=lambda row: row['count'])})
+
+        for finding in self.rule_engine.evaluate(result):
+            message = finding.message
+            if finding.is_host and self.attack_path_cache is not None:
+                attacks = self.attack_path_cache.exposed_attacks(finding.subject)
+                if attacks:
+                    message = message + '. This host is exposed to ' + ', '.join(attacks)
+            if finding.rule.block:
+                self.neo4j_driver.update_and_return_host_block(finding.subject, "True")
+                for listener in self.block_listeners:
+                    listener(finding.subject)
+
+            with STAGE_TIMING.time('alert_send'):
+                self.email_notification.connect_to_smtp_server()
+                self.email_notification.send_email(message)
+                self.email_notification.stop_smtp()
+            ALERTS_SENT.inc()
+            if finding.is_host:
+                alert_times[finding.subject] = time.monotonic()
+            # Hosts which are only reported stay in the counts, so a blocking rule still sees them
+            if finding.rule.block:
+                self.neo4j_driver.update_and_return_host_notification_sent(finding.subject, "True")
+            reported_hosts.append(finding.subject)
+        if TRACER.enabled:
+            TRACER.complete_pass(pass_start, detected, alert_times)
+        return reported_hosts
 
     def _start(self):
 
         while self.monitoring_status is True:
-
-            # Was used for perfromance test
-            #all_execution_times = []
-            #for i in range(0, 100):
-
-            start_time = time.time() * 1000
-            query = (
-                    'MATCH (h:Host)-[r:STARTS_CONNECTION]->(c:Connection) '
-                    'WHERE c.status = "active" AND h.notification_sent = "False" AND h.is_blocked = "False"'
-                    'RETURN h,count(r) as count'
-                    )
-            result = self.neo4j_driver.execute_and_return_query_result(query)
-
-            # Was used for perfromance test
-            #end_time = time.time() * 1000
-            #execution_time = end_time - start_time
-            #all_execution_times.append(execution_time)
-            #i=i+1
-            
-            if result is not None:
-                message = ""
-                for row in result:
-                    if row['count'] > 50:
-                        
-                        message = 'Host ' + row['h']['ip_address'] + ' has ' +  str(row['count']) + ' active connections'
-                        self.neo4j_driver.update_and_return_host_block(row['h']['ip_address'], "True")
-
-                        self.email_notification.connect_to_smtp_server()
-                        self.email_notification.send_email(message)
-                        self.email_notification.stop_smtp()
-                        self.neo4j_driver.update_and_return_host_notification_sent(row['h']['ip_address'], "True")
-                        message = ""
-                        
-                        # Was used for perfromance test
-                        #end_time = time.time() * 1000
-                        #execution_time = end_time - start_time
-                        #all_execution_times.append(execution_time)
-                        #i=i+1
-                
-            # Was used for perfromance test   
-            #all_execution_times = list(filter(lambda num: num != 0.0, all_execution_times))
-            #print(all_execution_times)
-            #print(median(all_execution_times))
-            #print(mean(all_execution_times))
-            #print(stdev(all_execution_times))
-            #time.sleep(1)
+            self.run_detection_pass()
 
         if self.monitoring_status is False:
             sys.exit()
@@ -0,0 +1,315 @@
+"""This module spreads the ingest of the mosquitto log over several worker processes,
+    so parsing and writing the lines scales with the cores instead of running in one
+    thread.
+
+    A dispatcher reads the log and sends every line to the worker which owns its client.
+    The owner is chosen by the hash of the ip address of the client: the lines with the
+    ip address are routed by it and a sessionizer in the dispatcher knows the address
+    of the client of a disconnect. So all lines of a client are processed by one worker
+    in the order of the log, only the order between clients is lost. Lines without a
+    client, e.g. the start of the broker, go to the first worker. If a client id
+    connects again from an address of another worker, the old worker gets the line
+    mosquitto writes for a taken over client id, so it closes the old session.
+
+    Each worker runs its own log transformation with its own storage session and
+    writes through a batched storage, see batched_graph_storage. With IDS_SPOOL_DIR a
+    worker spools its writes to its own subdirectory instead, see write_ahead_spool,
+    the batched storage drops a batch the storage does not take after its retries. The sessionizer of the
+    dispatcher passes the sessions to the detection like the one of the transformation.
+    A load shedder of the dispatcher samples the lines before they are routed, see
+    load_shedding, the workers do not defer their enrichment.
+    The number of workers is set with the environment variable IDS_INGEST_WORKERS.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from beartype import beartype
+
+from batched_graph_storage import BatchedGraphStorage
+from compact_state import ip_key
+from connection_sessionizer import NEW_CONNECTION, ConnectionSessionizer, SessionEvent
+from graph_storage import NEO4J_PASS, NEO4J_URI, NEO4J_USER, STORAGE_BACKEND_VARIABLE, create_graph_storage
+from load_shedding import LoadShedder
+from metrics_endpoint import METRICS
+from write_ahead_spool import spool_from_environment
+
+INGEST_WORKERS_VARIABLE = 'IDS_INGEST_WORKERS'
+# Lines are sent to a worker when this many are waiting or they are older than the interval
+LINE_BATCH_SIZE = 256
+FLUSH_INTERVAL_SECONDS = 0.2
+
+LINES_ROUTED = METRICS.counter('ids_ingest_lines_routed_total', 'Log lines routed to an ingest worker', 'worker')
+
+
+def _run_worker(index: int, storage_factory: Callable, lines):
+    """Main loop of a worker, transforms the batches of lines until it gets None.
+
+    Args:
+        index (int): number of the worker, names its spool
+        storage_factory (Callable): creates the storage session of the worker
+        lines: queue of the batches of the worker
+    """
+    # The transformation imports the whole detection, it is only needed in the workers
+    from client_allowlist import ClientAllowlist
+    from mosquitto_log_transformation import MosquittoLogTransformation
+
+    storage = storage_factory()
+    graph_storage = spool_from_environment(storage, 'worker-' + str(index))
+    if graph_storage is storage:
+        graph_storage = BatchedGraphStorage(storage)
+        graph_storage.start()
+    log_transformation = MosquittoLogTransformation(graph_storage, allowlist=ClientAllowlist.from_flows())
+    log_transformation.blocklist.start(graph_storage)
+    while True:
+        batch = lines.get()
+        if batch is None:
+            break
+        for current_line in batch:
+            try:
+                log_transformation.process_line(current_line)
+            # One broken line must not stop the worker and the lines of its clients
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Processing the line %s raised an error: \n %s', current_line, exception)
+    log_transformation.blocklist.stop()
+    graph_storage.close()
+
+
+class PartitionedIngest:
+    """Routes the lines of the log to the ingest workers by the ip address of their
+    client.
+    """
+
+    def __init__(self, workers: Optional[int] = None, storage_factory: Optional[Callable] = None,
+                 use_processes: bool = True, load_shedder: Optional[LoadShedder] = None) -> None:
+        """Starts the workers.
+
+        Args:
+            workers (int, optional): number of workers, IDS_INGEST_WORKERS or the number
+            of cores if not set
+            storage_factory (Callable, optional): creates the storage of a worker, it has
+            to be picklable for processes, create_graph_storage if not set
+            use_processes (bool): workers are processes, threads share the GIL and only
+            help while the storage is waited for
+            load_shedder (LoadShedder, optional): samples the lines while the dispatcher
+            lags behind the log, every line is routed if not set
+        """
+        if workers is None:
+            workers = int(os.environ.get(INGEST_WORKERS_VARIABLE) or os.cpu_count() or 1)
+        self.storage_factory = storage_factory if storage_factory is not None else create_graph_storage
+        self.sessionizer = ConnectionSessionizer()
+        self.sessionizer.add_listener(self._take_over)
+        self.load_shedder = load_shedder
+        self.last_log_time = None
+        self.flush_status = True
+        self.batches = [[] for _ in range(workers)]
+        self.queues = []
+        self.workers = []
+        self._taken_over = []
+        self._batch_start = None
+        self._lock = threading.Lock()
+        METRICS.gauge('ids_ingest_batched_lines', 'Lines the dispatcher did not send to a worker yet',
+                      function=lambda: sum(len(batch) for batch in self.batches))
+        METRICS.gauge('ids_ingest_queued_batches', 'Batches the workers did not take from their queue yet',
+                      function=self.queued_batches)
+        if use_processes:
+            context = multiprocessing.get_context('spawn')
+            queue_type, worker_type = context.Queue, context.Process
+        else:
+            import queue
+
+            queue_type, worker_type = queue.Queue, threading.Thread
+        for index in range(workers):
+            lines = queue_type()
+            worker = worker_type(target=_run_worker, args=(index, self.storage_factory, lines), daemon=True)
+            worker.start()
+            self.queues.append(lines)
+            self.workers.append(worker)
+
+    @beartype
+    def route(self, current_line: str) -> int:
+        """Returns the worker which owns the client of a line. The line is applied to the
+        sessionizer of the dispatcher, so it has to be called once per line in order.
+
+        Args:
+            current_line (str): one row of the log file
+
+        Returns:
+            int: index of the worker
+        """
+        session_event = self.sessionizer.process_line(current_line)
+        if session_event is not None:
+            worker = self._worker(session_event.session.address)
+            self._send_taken_over(worker)
+            return worker
+        if ' New connection from ' in current_line:
+            match = NEW_CONNECTION.match(current_line)
+            if match is not None:
+                return self._worker(ip_key(match.group(2)))
+        return 0
+
+    def last_log_timestamp(self) -> float:
+        """Returns the timestamp of the last routed line.
+
+        Returns:
+            float: unix timestamp or 0 if no line with a timestamp was routed
+        """
+        try:
+            return float(self.last_log_time)
+        except (TypeError, ValueError):
+            return 0.0
+
+    @beartype
+    def process_line(self, current_line: str):
+        """Adds a line to the batch of its worker.
+
+        Args:
+            current_line (str): one row of the log file
+        """
+        if self.load_shedder is not None and not self.load_shedder.admit(current_line):
+            return
+        timestamp = current_line.partition(':')[0]
+        if timestamp.isdigit():
+            self.last_log_time = timestamp
+        with self._lock:
+            worker = self.route(current_line)
+            self._add(worker, current_line)
+
+    def flush(self):
+        """Sends all waiting lines to their workers.
+        """
+        with self._lock:
+            for worker in range(len(self.batches)):
+                self._send_batch(worker)
+            self._batch_start = None
+
+    def queued_batches(self) -> int:
+        """Returns the number of batches which wait in the queues of the workers.
+
+        Returns:
+            int: batches of all queues
+        """
+        return sum(lines.qsize() for lines in self.queues)
+
+    def start(self):
+        """Sends waiting lines of a quiet log in a daemon thread.
+        """
+        self.flush_status = True
+        threading.Thread(target=self._start, daemon=True).start()
+
+    def stop(self):
+        """Sends the waiting lines and waits until the workers processed them.
+        """
+        self.flush_status = False
+        self.flush()
+        for lines, worker in zip(self.queues, self.workers):
+            lines.put(None)
+            worker.join()
+        self.queues = []
+        self.workers = []
+
+    def _start(self):
+        """Sends the lines which are waiting longer than the interval until stop is
+        called.
+        """
+        while self.flush_status is True:
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            batch_start = self._batch_start
+            if batch_start is not None and time.monotonic() - batch_start >= FLUSH_INTERVAL_SECONDS:
+                self.flush()
+
+    def _worker(self, address) -> int:
+        """Returns the worker of an address, the key of compact_state.ip_key.
+        """
+        return hash(address) % len(self.batches)
+
+    def _add(self, worker: int, current_line: str):
+        """Adds a line to a batch and sends the batch if it is full.
+        """
+        if self._batch_start is None:
+            self._batch_start = time.monotonic()
+        batch = self.batches[worker]
+        batch.append(current_line)
+        if len(batch) >= LINE_BATCH_SIZE:
+            self._send_batch(worker)
+
+    def _send_batch(self, worker: int):
+        """Puts the waiting lines of a worker into its queue.
+        """
+        batch = self.batches[worker]
+        if batch:
+            self.queues[worker].put(batch)
+            LINES_ROUTED.inc(amount=len(batch), label_value=str(worker))
+            self.batches[worker] = []
+
+    def _take_over(self, event: SessionEvent):
+        """Remembers the sessions which were closed because their client id connected
+        again.
+        """
+        if event.kind == 'closed' and event.reason == 'taken_over':
+            self._taken_over.append(event)
+
+    def _send_taken_over(self, worker: int):
+        """Tells the old worker of a client which connected from an address of another
+        worker that its session is closed.
+        """
+        for event in self._taken_over:
+            old_worker = self._worker(event.session.address)
+            if old_worker != worker:
+                self._add(old_worker, str(event.closed) + ': Client ' + event.session.client_id
+                          + ' already connected, closing old connection.')
+        self._taken_over.clear()
+
+
+@beartype
+def partitioned_ingest_from_environment(uri: str = NEO4J_URI, user: str = NEO4J_USER,
+                                        password: str = NEO4J_PASS) -> Optional[PartitionedIngest]:
+    """Starts a partitioned ingest if IDS_INGEST_WORKERS is set.
+
+    Args:
+        uri (str): uri of the neo4j instance
+        user (str): neo4j user
+        password (str): neo4j password
+
+    Returns:
+        PartitionedIngest: the started ingest or None
+    """
+    workers = os.environ.get(INGEST_WORKERS_VARIABLE)
+    if not workers:
+        return None
+    if os.environ.get(STORAGE_BACKEND_VARIABLE) == 'memory':
+        logging.error('The memory backend can not be shared by ingest workers, the log is read in one thread')
+        return None
+    partitioned_ingest = PartitionedIngest(int(workers), functools.partial(create_graph_storage, None, uri, user,
+                                                                           password))
+    partitioned_ingest.start()
+    print(f'Ingesting the log with {workers} workers')
+    return partitioned_ingest
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from log_generator import MosquittoLogGenerator
+    from sqlite_database_access import SqliteDatabaseAccess
+
+    with tempfile.TemporaryDirectory() as example_directory:
+        example_path = os.path.join(example_directory, 'ids.db')
+        example_storage = SqliteDatabaseAccess(example_path)
+        example_storage.create_service('{"name": "Mosquitto", "port": "1883", "version": "1.6.9", "protocol": "MQTT"}')
+        example_storage.commit()
+        example_ingest = PartitionedIngest(4, functools.partial(SqliteDatabaseAccess, example_path))
+        example_start = time.perf_counter()
+        for example_line in MosquittoLogGenerator(seed=0).lines('slow_dos', 20000):
+            example_ingest.process_line(example_line)
+        example_ingest.stop()
+        print(f'20000 lines in {time.perf_counter() - example_start:.1f} s',
+              len(example_storage.count_active_connections_per_host()), 'hosts with active connections')
+        example_storage.close()
@@ -0,0 +1,251 @@
+"""This module resolves the ip address of pods in the k8s cluster by their app label.
+    All pods are listed once and afterwards a watch keeps an in memory index up to date,
+    so a lookup is a dictonary access instead of an api call. Only running pods which
+    are not being deleted are indexed and an app resolves to its newest pod, so events
+    of an old pod of a rollout do not switch the ip address back. The kubernetes client
+    is only imported once the first lookup is made, runs without k8s never load it.
+
+    Adapted from:
+    https://github.com/kubernetes-client/python/blob/master/examples/watch/pod_namespace_watch.py
+    [last accessed March 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from beartype import beartype
+
+from metrics_endpoint import METRICS
+
+# Only pods with an app label are indexed
+LABEL_SELECTOR = 'app'
+WATCH_TIMEOUT_SECONDS = 300
+RETRY_SECONDS = 5
+
+LOOKUPS = METRICS.counter('ids_pod_ip_lookups_total', 'Lookups of pod ip addresses in the index', 'result')
+
+
+class PodIpResolver:
+    """Keeps an index of pod ip addresses by app label with a single list and watch.
+    """
+
+    @beartype
+    def __init__(self, api_host: Optional[str] = None,
+                 on_change: Optional[Callable[[str, Optional[str], Optional[str]], None]] = None):
+        """Initializes the resolver without contacting the cluster.
+
+        Args:
+            api_host (str, optional): url of an api server e.g. a local fake server for
+            tests. If not set the in cluster config is used and the kube config otherwise.
+            on_change (Callable, optional): called with app, old ip and new ip whenever
+            an app gets a new ip address
+        """
+        self.api_host = api_host
+        self.on_change = on_change
+        self.pod_index = {}
+        # App -> pod key -> creation time and ip address of its running pods
+        self.pods_by_app = {}
+        self.ip_by_app = {}
+        self.last_ip_by_app = {}
+        self.watch_status = False
+        self._core_api = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    @beartype
+    def get_ip_address(self, app_selector: str) -> str:
+        """Returns the ip address of a pod with the given app label. The first call
+        lists all pods and starts the watch.
+
+        Args:
+            app_selector (str): the app name of the pod the ip address need to be retrieved
+
+        Returns:
+            str: ip address of the pod
+        """
+        if not self._ready.is_set():
+            self.start()
+        ip_address = self.ip_by_app.get(app_selector)
+        LOOKUPS.inc(1, 'miss' if ip_address is None else 'hit')
+        if ip_address is None:
+            logging.error('No running pod found with label app=%s', app_selector)
+            raise ValueError('No running pod found with label app=' + app_selector)
+        return ip_address
+
+    def start(self):
+        """Lists all pods to fill the index and starts watching for changes in a
+        background thread.
+        """
+        with self._lock:
+            if self._ready.is_set():
+                return
+            resource_version = self._list_pods()
+            self.watch_status = True
+            threading.Thread(target=self._watch, args=(resource_version,), daemon=True).start()
+            self._ready.set()
+
+    def stop(self):
+        """Stops the watch once the current request times out.
+        """
+        self.watch_status = False
+
+    def _api(self):
+        """Imports the kubernetes client and creates the api object on first use.
+
+        Returns:
+            CoreV1Api: client for the core kubernetes api
+        """
+        if self._core_api is None:
+            from kubernetes import client, config
+
+            if self.api_host is not None:
+                configuration = client.Configuration()
+                configuration.host = self.api_host
+                self._core_api = client.CoreV1Api(client.ApiClient(configuration))
+            else:
+                try:
+                    config.load_incluster_config()
+                except config.ConfigException:
+                    config.load_kube_config()
+                self._core_api = client.CoreV1Api()
+        return self._core_api
+
+    def _list_pods(self) -> str:
+        """Replaces the index with the current list of pods.
+
+        Returns:
+            str: resource version of the list to start the watch from
+        """
+        pod_list = self._api().list_pod_for_all_namespaces(label_selector=LABEL_SELECTOR)
+        known_pods = set(self.pod_index)
+        for pod in pod_list.items:
+            self._apply_event('MODIFIED', pod)
+            known_pods.discard(self._pod_key(pod))
+        for pod_key in known_pods:
+            self._remove_pod(pod_key)
+        return pod_list.metadata.resource_version
+
+    def _watch(self, resource_version: str):
+        """Applies pod events to the index until stop is called. If the resource version
+        is too old the pods are listed again, until the list succeeds.
+
+        Args:
+            resource_version (str): version of the last list
+        """
+        from kubernetes import watch
+        from kubernetes.client.exceptions import ApiException
+
+        while self.watch_status is True:
+            if resource_version is None:
+                try:
+                    resource_version = self._list_pods()
+                # Capture connection errors and keep the last known index
+                except Exception as exception:  # pylint: disable=broad-except
+                    logging.error('Listing the pods raised an error: \n %s', exception)
+                    time.sleep(RETRY_SECONDS)
+                    continue
+            pod_watch = watch.Watch()
+            try:
+                for event in pod_watch.stream(self._api().list_pod_for_all_namespaces,
+                                              label_selector=LABEL_SELECTOR,
+                                              resource_version=resource_version,
+                                              timeout_seconds=WATCH_TIMEOUT_SECONDS):
+                    self._apply_event(event['type'], event['object'])
+                    resource_version = event['object'].metadata.resource_version
+                    if self.watch_status is False:
+                        break
+            except ApiException as exception:
+                if exception.status != 410:
+                    logging.error('Pod watch raised an error: \n %s', exception)
+                    time.sleep(RETRY_SECONDS)
+                resource_version = None
+            # Capture connection errors and keep the last known index
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Pod watch raised an error: \n %s', exception)
+                time.sleep(RETRY_SECONDS)
+            finally:
+                pod_watch.stop()
+
+    def _apply_event(self, event_type: str, pod):
+        """Updates the index with a single pod event, pods which are not running or are
+        being deleted are removed.
+
+        Args:
+            event_type (str): ADDED, MODIFIED or DELETED
+            pod (V1Pod): the pod of the event
+        """
+        pod_key = self._pod_key(pod)
+        app = (pod.metadata.labels or {}).get('app')
+        status = pod.status
+        ip_address = status.pod_ip if status is not None else None
+        if (event_type == 'DELETED' or app is None or ip_address is None or status.phase != 'Running'
+                or pod.metadata.deletion_timestamp is not None):
+            self._remove_pod(pod_key)
+            return
+        entry = self.pod_index.get(pod_key)
+        if entry is not None and entry[0] != app:
+            self._remove_pod(pod_key)
+        created = pod.metadata.creation_timestamp
+        self.pod_index[pod_key] = (app, ip_address)
+        # Pods without a creation time are older than all others
+        self.pods_by_app.setdefault(app, {})[pod_key] = (created is not None, created or 0, ip_address)
+        self._set_newest_ip(app)
+
+    def _remove_pod(self, pod_key: str):
+        """Removes a pod from the index and falls back to the newest other pod of the
+        same app.
+
+        Args:
+            pod_key (str): namespace and name of the pod
+        """
+        entry = self.pod_index.pop(pod_key, None)
+        if entry is None:
+            return
+        app = entry[0]
+        pods = self.pods_by_app[app]
+        del pods[pod_key]
+        if not pods:
+            del self.pods_by_app[app]
+        self._set_newest_ip(app)
+
+    def _set_newest_ip(self, app: str):
+        """Sets the ip address of the newest running pod of an app.
+
+        Args:
+            app (str): app label
+        """
+        pods = self.pods_by_app.get(app)
+        self._set_app_ip(app, max(pods.values())[2] if pods else None)
+
+    def _set_app_ip(self, app: str, ip_address: Optional[str]):
+        """Sets the current ip address of an app and reports the change. If the old pod
+        was deleted before the new one got its ip the last known ip is reported as old ip.
+
+        Args:
+            app (str): app label
+            ip_address (str, optional): new ip address or None if no pod is left
+        """
+        if ip_address is None:
+            self.ip_by_app.pop(app, None)
+            return
+        old_ip_address = self.last_ip_by_app.get(app)
+        self.ip_by_app[app] = ip_address
+        self.last_ip_by_app[app] = ip_address
+        if old_ip_address != ip_address and self.on_change is not None and self._ready.is_set():
+            self.on_change(app, old_ip_address, ip_address)
+
+    @staticmethod
+    def _pod_key(pod) -> str:
+        """Returns a unique key of a pod.
+        """
+        return pod.metadata.namespace + '/' + pod.metadata.name
+
+
+if __name__ == '__main__':
+    resolver = PodIpResolver()
+    print(resolver.get_ip_address('mosquitto-broker'))
+    print(resolver.ip_by_app)
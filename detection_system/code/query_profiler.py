@@ -0,0 +1,224 @@
+"""This module profiles the cypher statements the detection system sends to neo4j. The
+    values which are written into the queries are replaced by ? so all executions of
+    the same statement are aggregated as one query shape. For every shape the number
+    of executions, the client time, the server times and the update counters of the
+    result summary are summed up. One in N executions is run with PROFILE to also sum
+    up the db hits and rows of the query plan.
+
+    Profiling is enabled with IDS_QUERY_PROFILING=1, IDS_PROFILE_EVERY sets N (0 never
+    runs PROFILE). The report with the most expensive shapes is printed on SIGUSR1 by
+    a reporter thread, see stage_timing.run_on_signal.
+
+    Adapted from:
+    https://neo4j.com/docs/api/python-driver/current/api.html#resultsummary
+    [last accessed April 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import functools
+import os
+import re
+import signal
+import threading
+import time
+from typing import Callable
+
+from beartype import beartype
+
+from stage_timing import run_on_signal
+
+# Statements which can not be run with PROFILE
+NOT_PROFILABLE = re.compile(r'^\s*(CALL|CREATE\s+CONSTRAINT|DROP|CREATE\s+INDEX|SHOW)\b', re.IGNORECASE)
+_STRING_LITERAL = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+_NUMBER_LITERAL = re.compile(r'(?<![\w$.])-?\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+COUNTER_NAMES = ('nodes_created', 'nodes_deleted', 'relationships_created', 'relationships_deleted',
+                 'properties_set', 'labels_added', 'indexes_added', 'constraints_added')
+DEFAULT_TOP = 10
+
+
+@beartype
+def query_shape(query: str) -> str:
+    """Replaces literals of a query by ? and collapses the whitespace.
+
+    Args:
+        query (str): a cypher query
+
+    Returns:
+        str: the shape of the query
+    """
+    shape = _STRING_LITERAL.sub('?', query)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def _sum_plan(plan) -> tuple:
+    """Sums up the db hits and returns the rows of the root of a profiled plan.
+    """
+    if plan is None:
+        return 0, 0
+    if not isinstance(plan, dict):
+        plan = {'dbHits': getattr(plan, 'db_hits', 0), 'rows': getattr(plan, 'rows', 0),
+                'children': getattr(plan, 'children', [])}
+    db_hits = plan.get('dbHits', 0)
+    for child in plan.get('children', []):
+        db_hits += _sum_plan(child)[0]
+    return db_hits, plan.get('rows', 0)
+
+
+class _ProfiledTransaction:
+    """Stands in for the transaction passed to a transaction function. Runs the query,
+    optionally with PROFILE, and remembers the results to read their summaries.
+    """
+
+    def __init__(self, transaction, profile: bool):
+        self._transaction = transaction
+        self._profile = profile
+        self.runs = []
+
+    def run(self, query, parameters=None, **kwparameters):
+        """Runs the query like the transaction would.
+        """
+        profiled = self._profile and not NOT_PROFILABLE.match(query)
+        start = time.perf_counter()
+        result = self._transaction.run('PROFILE ' + query if profiled else query, parameters, **kwparameters)
+        self.runs.append((query, result, start, profiled))
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+
+class QueryProfiler:
+    """Aggregates the summaries of the executed queries by their shape.
+    """
+
+    @beartype
+    def __init__(self, enabled: bool = False, profile_every: int = 0):
+        """Initializes the profiler.
+
+        Args:
+            enabled (bool): if False transaction functions are not wrapped
+            profile_every (int): every n-th execution runs with PROFILE, 0 disables it
+        """
+        self.enabled = enabled
+        self.profile_every = profile_every
+        self.shapes = {}
+        self._executions = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, work: Callable) -> Callable:
+        """Returns a transaction function which runs the work with a profiled transaction
+        and records the summaries of its queries.
+
+        Args:
+            work (Callable): a transaction function e.g. _create_and_return_host
+
+        Returns:
+            Callable: the wrapped transaction function
+        """
+        @functools.wraps(work)
+        def profiled_work(transaction, *args, **kwargs):
+            with self._lock:
+                self._executions += 1
+                profile = self.profile_every > 0 and self._executions % self.profile_every == 0
+            profiled_transaction = _ProfiledTransaction(transaction, profile)
+            value = work(profiled_transaction, *args, **kwargs)
+            for query, result, start, profiled in profiled_transaction.runs:
+                self._record(query, result.consume(), time.perf_counter() - start, profiled)
+            return value
+        return profiled_work
+
+    def _record(self, query: str, summary, elapsed: float, profiled: bool):
+        """Adds the summary of one execution to the statistics of its shape.
+        """
+        shape = query_shape(query)
+        counters = summary.counters
+        available_after = summary.result_available_after or 0
+        consumed_after = summary.result_consumed_after or 0
+        db_hits, rows = _sum_plan(summary.profile) if profiled else (0, 0)
+        with self._lock:
+            statistics = self.shapes.get(shape)
+            if statistics is None:
+                statistics = self.shapes[shape] = dict.fromkeys(
+                    ('executions', 'client_seconds', 'server_ms', 'profiled', 'db_hits', 'rows')
+                    + COUNTER_NAMES, 0)
+            statistics['executions'] += 1
+            statistics['client_seconds'] += elapsed
+            statistics['server_ms'] += available_after + consumed_after
+            for name in COUNTER_NAMES:
+                statistics[name] += getattr(counters, name, 0)
+            if profiled:
+                statistics['profiled'] += 1
+                statistics['db_hits'] += db_hits
+                statistics['rows'] += rows
+
+    @beartype
+    def top_shapes(self, top: int = DEFAULT_TOP, key: str = 'client_seconds') -> list:
+        """Returns the most expensive query shapes.
+
+        Args:
+            top (int): number of shapes
+            key (str): statistic to sort by e.g. client_seconds, server_ms or db_hits
+
+        Returns:
+            list: tuples of shape and statistics
+        """
+        with self._lock:
+            shapes = [(shape, dict(statistics)) for shape, statistics in self.shapes.items()]
+        return sorted(shapes, key=lambda item: item[1][key], reverse=True)[:top]
+
+    def report(self, top: int = DEFAULT_TOP) -> str:
+        """Formats the most expensive query shapes by total client time.
+
+        Returns:
+            str: one block per shape
+        """
+        lines = []
+        for rank, (shape, statistics) in enumerate(self.top_shapes(top), 1):
+            executions = statistics['executions']
+            lines.append(f'{rank}. {shape[:200]}')
+            lines.append(f"   executions {executions}, client {statistics['client_seconds'] * 1000:.1f}ms "
+                         f"(mean {statistics['client_seconds'] * 1000 / executions:.3f}ms), "
+                         f"server {statistics['server_ms']}ms")
+            updates = ', '.join(f'{name} {statistics[name]}' for name in COUNTER_NAMES if statistics[name])
+            if updates:
+                lines.append(f'   {updates}')
+            if statistics['profiled']:
+                lines.append(f"   profiled {statistics['profiled']}, "
+                             f"db hits per execution {statistics['db_hits'] / statistics['profiled']:.1f}, "
+                             f"rows per execution {statistics['rows'] / statistics['profiled']:.1f}")
+        return '\n'.join(lines) if lines else 'No queries profiled'
+
+    def dump(self):
+        """Prints the report.
+        """
+        print(self.report(), flush=True)
+
+    def install_signal_handler(self):
+        """Prints the report on SIGUSR1 in addition to a handler which was installed
+        before, e.g. the one of the stage timing. Must be called from the main thread.
+        """
+        if self.enabled and hasattr(signal, 'SIGUSR1'):
+            run_on_signal(signal.SIGUSR1, self.dump)
+
+
+PROFILER = QueryProfiler(os.environ.get('IDS_QUERY_PROFILING', '0') == '1',
+                         int(os.environ.get('IDS_PROFILE_EVERY', '0')))
+
+
+if __name__ == '__main__':
+    from neo4j_database_access import Neo4jDatabaseAccess
+
+    NEO4J_URI = 'bolt://localhost:30687'
+    NEO4J_USER = 'neo4j'
+    NEO4J_PASS = '1234'
+    PROFILER.enabled = True
+    PROFILER.profile_every = 2
+    neo4j_driver = Neo4jDatabaseAccess(NEO4J_URI, NEO4J_USER, NEO4J_PASS)
+    for _ in range(4):
+        neo4j_driver.check_if_host_is_blocked('127.0.0.1')
+        neo4j_driver.count_active_connections_per_host()
+    PROFILER.dump()
+    neo4j_driver.close()
@@ -0,0 +1,388 @@
+"""This module evaluates the detection rules of the network monitoring. The rules are
+    declared in config/detection_rules.json (or the file in IDS_DETECTION_RULES), e.g.
+
+    {"name": "too_many_connections", "type": "count_threshold", "threshold": 50, "block": true}
+
+    The supported types are:
+    - count_threshold: active connections of a host in the graph
+    - subnet: active connections of all hosts of an IPv4 prefix, with prefix_length
+    - connection_rate: sessions a host opened in the last window_seconds
+    - idle_hold: sessions of a host which are open longer than min_seconds
+
+    All rules of a pass are evaluated against one snapshot: the active connections per
+    host of one graph query and the sessions of the sessionizer. An aggregate, like the
+    sessions per host opened within a window, is computed once per pass and parameter
+    and shared by all rules which need it, so a new rule costs a few dictonary
+    operations instead of another query. The integer addresses of the hosts are kept
+    from the previous pass and the networks of a prefix are grouped from the networks
+    of a longer prefix, so a subnet rule does not parse the addresses again. A rule
+    reports a subject (host or network) once, until it does not exceed the threshold
+    anymore.
+
+    With IDS_DETECTION_MODE=vectorized the same rules are evaluated with NumPy on
+    feature columns of the hosts, see vectorized_detection, and with
+    IDS_DETECTION_MODE=sharded in several worker processes, see sharded_detection.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import os
+import socket
+import threading
+from collections import Counter, deque
+from typing import Callable, List, Optional, Tuple
+
+from beartype import beartype
+
+from compact_state import ip_from_key
+from connection_sessionizer import ConnectionSessionizer, SessionEvent
+from metrics_endpoint import METRICS
+
+DETECTION_RULES_VARIABLE = 'IDS_DETECTION_RULES'
+DETECTION_MODE_VARIABLE = 'IDS_DETECTION_MODE'
+DETECTION_MODES = ('rules', 'vectorized', 'sharded')
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'detection_rules.json')
+RULE_PARAMETERS = {'count_threshold': (), 'subnet': ('prefix_length',), 'connection_rate': ('window_seconds',),
+                   'idle_hold': ('min_seconds',)}
+AGGREGATE_LOOKUPS = METRICS.counter('ids_rule_aggregate_lookups_total', 'Aggregates of a pass by cache result',
+                                    'result')
+# Addresses of hosts which are not in the graph anymore kept before the cache is cleared
+MAX_STALE_ADDRESSES = 1024
+# Marks an address which is not in the cache, None marks one which is not IPv4
+UNPARSED = object()
+MESSAGES = {'count_threshold': 'Host {subject} has {value} active connections',
+            'subnet': 'Network {subject} has {value} active connections',
+            'connection_rate': 'Host {subject} opened {value} connections in {window_seconds} seconds',
+            'idle_hold': 'Host {subject} holds {value} connections open for more than {min_seconds} seconds'}
+
+
+class Rule:
+    """A declared rule, the subject is reported if its value is above the threshold.
+    """
+
+    def __init__(self, name: str, rule_type: str, threshold: int, block: bool = False, **parameters):
+        """Creates a rule.
+
+        Args:
+            name (str): unique name of the rule, e.g. too_many_connections
+            rule_type (str): one of the keys of RULE_PARAMETERS
+            threshold (int): values above it are reported
+            block (bool): if the reported host is blocked, only for host rules
+
+        Raises:
+            ValueError: if the type is unknown or a parameter is missing
+        """
+        if rule_type not in RULE_PARAMETERS:
+            raise ValueError('Unknown rule type ' + rule_type + ' of rule ' + name + ', use one of '
+                             + ', '.join(RULE_PARAMETERS))
+        missing = [parameter for parameter in RULE_PARAMETERS[rule_type] if parameter not in parameters]
+        if missing:
+            raise ValueError('Rule ' + name + ' needs ' + ', '.join(missing))
+        if block and rule_type == 'subnet':
+            raise ValueError('Rule ' + name + ' can not block, only host rules block')
+        self.name = name
+        self.rule_type = rule_type
+        self.threshold = threshold
+        self.block = block
+        self.parameters = parameters
+
+    @classmethod
+    @beartype
+    def from_dict(cls, rule: dict) -> 'Rule':
+        """Creates a rule of the rules file.
+
+        Args:
+            rule (dict): name, type, threshold, block and the parameters of the type
+
+        Returns:
+            Rule: the rule
+        """
+        rule = dict(rule)
+        return cls(rule.pop('name'), rule.pop('type'), int(rule.pop('threshold')), bool(rule.pop('block', False)),
+                   **rule)
+
+
+class Finding:
+    """A subject whose value exceeds the threshold of a rule.
+    """
+    __slots__ = ('rule', 'subject', 'value')
+
+    def __init__(self, rule: Rule, subject: str, value: int):
+        self.rule = rule
+        self.subject = subject
+        self.value = value
+
+    @property
+    def is_host(self) -> bool:
+        """True if the subject is a host, False for a network.
+        """
+        return self.rule.rule_type != 'subnet'
+
+    @property
+    def message(self) -> str:
+        """Text of the alert.
+        """
+        return MESSAGES[self.rule.rule_type].format(subject=self.subject, value=self.value, **self.rule.parameters)
+
+
+class DetectionSnapshot:
+    """The state of one pass. The aggregates are computed on first use and cached by
+    their parameter.
+    """
+
+    def __init__(self, rows: list, opened: list, sessions: list, now: Optional[int],
+                 addresses: Optional[dict] = None, network_names: Optional[dict] = None):
+        """Creates the snapshot.
+
+        Args:
+            rows (list): result of count_active_connections_per_host
+            opened (list): log timestamp and address of the recently opened sessions
+            sessions (list): the live sessions of the sessionizer
+            now (int, optional): log timestamp of the last session event
+            addresses (dict, optional): integer addresses of the previous passes by
+            ip address, None for addresses which are not IPv4, new addresses are added
+            network_names (dict, optional): names of the networks of the previous passes
+            by prefix length and network, new networks are added
+        """
+        self.rows = rows
+        self.opened = opened
+        self.sessions = sessions
+        self.now = now
+        self.addresses = addresses if addresses is not None else {}
+        self.network_names = network_names if network_names is not None else {}
+        # Lookups of the pass, added to AGGREGATE_LOOKUPS once at the end of the pass
+        self.lookups = {'hit': 0, 'miss': 0}
+        self._cache = {}
+        self._networks = {}
+
+    def aggregate(self, name: str, parameter, function: Callable) -> List[Tuple[str, int]]:
+        """Returns the cached aggregate or computes it.
+        """
+        key = (name, parameter)
+        if key not in self._cache:
+            self.lookups['miss'] += 1
+            self._cache[key] = function(parameter)
+        else:
+            self.lookups['hit'] += 1
+        return self._cache[key]
+
+    def active_connections(self, _=None) -> List[Tuple[str, int]]:
+        """Active connections per host.
+        """
+        return [(row['h']['ip_address'], row['count']) for row in self.rows]
+
+    def network_connections(self, prefix_length: int) -> List[Tuple[str, int]]:
+        """Active connections per IPv4 prefix of the hosts.
+        """
+        names = self.network_names.setdefault(prefix_length, {})
+        connections = []
+        for network, count in self.network_counts(prefix_length).items():
+            name = names.get(network)
+            if name is None:
+                name = socket.inet_ntoa((network << (32 - prefix_length)).to_bytes(4, 'big')) + '/' + str(prefix_length)
+                names[network] = name
+            connections.append((name, count))
+        return connections
+
+    def network_counts(self, prefix_length: int) -> dict:
+        """Active connections per network of the prefix, a network is the address
+        shifted right by 32 - prefix_length. The networks are grouped from the networks of the shortest longer
+        prefix which was computed already, only the first prefix reads the hosts.
+        """
+        if prefix_length not in self._networks:
+            longer = [length for length in self._networks if length > prefix_length]
+            counts = {}
+            if longer:
+                shift = min(longer) - prefix_length
+                for network, count in self._networks[min(longer)].items():
+                    network >>= shift
+                    counts[network] = counts.get(network, 0) + count
+            else:
+                shift = 32 - prefix_length
+                known = self.addresses.get
+                for ip_address, count in self.aggregate('active_connections', None, self.active_connections):
+                    address = known(ip_address, UNPARSED)
+                    if address is UNPARSED:
+                        address = self._parse_address(ip_address)
+                    if address is not None:
+                        network = address >> shift
+                        counts[network] = counts.get(network, 0) + count
+            self._networks[prefix_length] = counts
+        return self._networks[prefix_length]
+
+    def _parse_address(self, ip_address) -> Optional[int]:
+        """Returns the integer of an IPv4 address and keeps it for the next passes, None
+        if it is not one.
+        """
+        try:
+            address = int.from_bytes(socket.inet_aton(ip_address), 'big')
+        except (OSError, TypeError):
+            address = None
+        self.addresses[ip_address] = address
+        return address
+
+    def opened_sessions(self, window_seconds: int) -> List[Tuple[str, int]]:
+        """Sessions per host opened within the window before the last event.
+        """
+        if self.now is None:
+            return []
+        start = self.now - window_seconds
+        counts = Counter(address for timestamp, address in self.opened if timestamp > start)
+        return [(ip_from_key(address), count) for address, count in counts.items()]
+
+    def held_sessions(self, min_seconds: int) -> List[Tuple[str, int]]:
+        """Live sessions per host which are open longer than min_seconds.
+        """
+        if self.now is None:
+            return []
+        latest = self.now - min_seconds
+        counts = Counter(session.address for session in self.sessions if session.opened < latest)
+        return [(ip_from_key(address), count) for address, count in counts.items()]
+
+
+# Rule type -> aggregate of the snapshot and the parameter it is computed with
+AGGREGATES = {'count_threshold': ('active_connections', None), 'subnet': ('network_connections', 'prefix_length'),
+              'connection_rate': ('opened_sessions', 'window_seconds'), 'idle_hold': ('held_sessions', 'min_seconds')}
+
+
+class RuleEngine:
+    """Evaluates all rules against one snapshot per pass.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        """Creates the engine.
+
+        Args:
+            rules (List[Rule]): the rules in the order their findings are returned
+
+        Raises:
+            ValueError: if two rules have the same name
+        """
+        names = [rule.name for rule in rules]
+        if len(set(names)) != len(names):
+            raise ValueError('The names of the rules are not unique: ' + ', '.join(names))
+        self.rules = rules
+        self.reported = set()
+        self.sessionizer = None
+        self.now = None
+        # Only the sessions within the longest window of the rate rules are kept
+        self.window_seconds = max([rule.parameters['window_seconds'] for rule in rules
+                                   if rule.rule_type == 'connection_rate'], default=0)
+        self.opened = deque()
+        self.addresses = {}
+        self.network_names = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    @beartype
+    def from_file(cls, file_path: Optional[str] = None) -> 'RuleEngine':
+        """Reads the rules file.
+
+        Args:
+            file_path (str, optional): path to the json file, IDS_DETECTION_RULES or the
+            default rules if not set
+
+        Returns:
+            RuleEngine: the engine with the rules of the file
+        """
+        if file_path is None:
+            file_path = os.environ.get(DETECTION_RULES_VARIABLE) or DEFAULT_RULES_FILE
+        with open(file_path, 'r', encoding='utf-8') as rules_file:
+            return cls([Rule.from_dict(rule) for rule in json.load(rules_file)['rules']])
+
+    @beartype
+    def observe(self, sessionizer: ConnectionSessionizer):
+        """Feeds the sessions of the sessionizer to the rules which need them, without a
+        sessionizer connection_rate and idle_hold rules find nothing.
+
+        Args:
+            sessionizer (ConnectionSessionizer): the sessionizer of the log transformation
+        """
+        self.sessionizer = sessionizer
+        sessionizer.add_listener(self.process_event)
+
+    @beartype
+    def process_event(self, event: SessionEvent):
+        """Keeps the time of the event and the recently opened sessions.
+
+        Args:
+            event (SessionEvent): event of the sessionizer
+        """
+        self.now = event.session.connected if event.closed is None else event.closed
+        if event.kind != 'opened' or not self.window_seconds:
+            return
+        with self._lock:
+            self.opened.append((self.now, event.session.address))
+            start = self.now - self.window_seconds
+            while self.opened[0][0] <= start:
+                self.opened.popleft()
+
+    def evaluate(self, rows: Optional[list]) -> List[Finding]:
+        """Evaluates all rules and returns the findings which were not reported yet.
+
+        Args:
+            rows (list): result of count_active_connections_per_host of this pass
+
+        Returns:
+            List[Finding]: the new findings, ordered by rule
+        """
+        with self._lock:
+            opened = list(self.opened)
+        sessions = list(self.sessionizer.sessions.values()) if self.sessionizer is not None else []
+        snapshot = DetectionSnapshot(rows or [], opened, sessions, self.now, self.addresses, self.network_names)
+        findings = []
+        matching = set()
+        for rule in self.rules:
+            aggregate, parameter = AGGREGATES[rule.rule_type]
+            values = snapshot.aggregate(aggregate, rule.parameters.get(parameter),
+                                        getattr(snapshot, aggregate))
+            for subject, value in values:
+                if value > rule.threshold:
+                    matching.add((rule.name, subject))
+                    if (rule.name, subject) not in self.reported:
+                        findings.append(Finding(rule, subject, value))
+        self.reported = matching
+        for result, lookups in snapshot.lookups.items():
+            if lookups:
+                AGGREGATE_LOOKUPS.inc(lookups, result)
+        # The addresses of hosts which left the graph are dropped with all others
+        if len(self.addresses) > 2 * len(snapshot.rows) + MAX_STALE_ADDRESSES:
+            self.addresses = {}
+            self.network_names = {}
+        return findings
+
+
+@beartype
+def create_rule_engine(mode: Optional[str] = None, file_path: Optional[str] = None):
+    """Creates the detection of the configured mode with the rules of the rules file.
+
+    Args:
+        mode (str, optional): rules, vectorized or sharded, IDS_DETECTION_MODE or rules if
+        not set
+        file_path (str, optional): path to the rules file
+
+    Returns:
+        RuleEngine, VectorizedDetection or ShardedDetection: the detection, all have
+        observe and evaluate
+    """
+    mode = mode or os.environ.get(DETECTION_MODE_VARIABLE, 'rules')
+    if mode == 'rules':
+        return RuleEngine.from_file(file_path)
+    if mode == 'vectorized':
+        from vectorized_detection import VectorizedDetection
+
+        return VectorizedDetection.from_file(file_path)
+    if mode == 'sharded':
+        from sharded_detection import ShardedDetection
+
+        return ShardedDetection.from_file(file_path)
+    raise ValueError('Unknown detection mode ' + mode + ', use one of ' + ', '.join(DETECTION_MODES))
+
+
+if __name__ == '__main__':
+    example_engine = RuleEngine.from_file()
+    example_rows = [{'h': {'ip_address': '10.244.0.' + str(host)}, 'count': 45} for host in range(10, 40)]
+    example_rows.append({'h': {'ip_address': '10.244.1.10'}, 'count': 51})
+    for example_finding in example_engine.evaluate(example_rows):
+        print(example_finding.rule.name, example_finding.message)
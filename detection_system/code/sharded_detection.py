@@ -0,0 +1,235 @@
+"""This module spreads the detection over several worker processes, so the evaluation
+    of the hosts does not share the GIL with the log transformation and scales with
+    the cores of the machine.
+
+    Every host belongs to one shard, chosen by the hash of its address. The session
+    events of the sessionizer are routed to the process of the owning shard in
+    batches over a pipe and each process keeps the feature columns of its hosts, see
+    vectorized_detection. A detection pass asks all shards at once and merges their
+    answers: the host rules are evaluated within the shard, the networks of the subnet
+    rules span several shards, so every shard returns its sums per prefix and the
+    sums are added up before they are compared with the threshold. The rows of the
+    graph query of a pass are sent to the shards of their hosts with the pass, so the
+    count_threshold and subnet rules count the graph like in the rule engine. Findings
+    are reported once, like in the rule engine.
+
+    The number of shards is set with the environment variable IDS_DETECTION_SHARDS,
+    the number of cores if not set. The processes are started with spawn, so they do
+    not inherit the threads of the log transformation.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import multiprocessing
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+from beartype import beartype
+
+from compact_state import int_to_ip
+from connection_sessionizer import ConnectionSessionizer, SessionEvent
+from metrics_endpoint import METRICS
+from rule_engine import Finding, Rule, RuleEngine
+from vectorized_detection import VectorizedDetection, graph_counts
+
+DETECTION_SHARDS_VARIABLE = 'IDS_DETECTION_SHARDS'
+# Events are sent to a shard when this many are waiting, or at the next pass
+EVENT_BATCH_SIZE = 512
+
+SHARD_EVENTS = METRICS.counter('ids_shard_events_total', 'Session events routed to a detection shard', 'shard')
+
+
+def _run_shard(rules: List[Rule], connection):
+    """Main loop of a worker process, applies the batches of events and answers the
+    detection passes until it gets None.
+
+    Args:
+        rules (List[Rule]): the rules of the detection
+        connection: the worker end of the pipe
+    """
+    detection = VectorizedDetection([rule for rule in rules if rule.rule_type != 'subnet'])
+    prefix_lengths = sorted({rule.parameters['prefix_length'] for rule in rules if rule.rule_type == 'subnet'})
+    features = detection.features
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        if message[0] == 'events':
+            for opened, address, session_opened, now in message[1]:
+                if opened:
+                    features.add_session(address, session_opened, now)
+                else:
+                    features.remove_session(address, session_opened, now)
+        else:
+            # The clock of a shard only moves with its own events, the pass brings all to the same time
+            if message[1] is not None:
+                features.advance(message[1])
+            features.set_counts(message[2], message[3])
+            totals = {prefix_length: detection.network_totals(prefix_length) for prefix_length in prefix_lengths}
+            connection.send((detection.matching(), totals))
+    connection.close()
+
+
+class ShardedDetection:
+    """Routes the session events to the detection shards and merges their findings, it
+    can replace the rule engine of the network monitoring.
+    """
+
+    def __init__(self, rules: List[Rule], shards: Optional[int] = None):
+        """Starts a worker process per shard.
+
+        Args:
+            rules (List[Rule]): the rules in the order their findings are returned
+            shards (int, optional): number of worker processes, IDS_DETECTION_SHARDS or
+            the number of cores if not set
+        """
+        if shards is None:
+            shards = int(os.environ.get(DETECTION_SHARDS_VARIABLE) or os.cpu_count() or 1)
+        self.rules = rules
+        self.reported = set()
+        self.now = None
+        self.batches = [[] for _ in range(shards)]
+        self.connections = []
+        self.processes = []
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        for _ in range(shards):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_run_shard, args=(rules, worker_connection), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    @classmethod
+    @beartype
+    def from_file(cls, file_path: Optional[str] = None, shards: Optional[int] = None) -> 'ShardedDetection':
+        """Reads the rules file of the rule engine.
+
+        Args:
+            file_path (str, optional): path to the json file, IDS_DETECTION_RULES or the
+            default rules if not set
+            shards (int, optional): number of worker processes
+
+        Returns:
+            ShardedDetection: the detection with the rules of the file
+        """
+        return cls(RuleEngine.from_file(file_path).rules, shards)
+
+    @beartype
+    def observe(self, sessionizer: ConnectionSessionizer):
+        """Routes the sessions of the sessionizer to the shards.
+
+        Args:
+            sessionizer (ConnectionSessionizer): the sessionizer of the log transformation
+        """
+        sessionizer.add_listener(self.process_event)
+
+    @beartype
+    def process_event(self, event: SessionEvent):
+        """Adds an opened or closed session to the batch of the owning shard.
+
+        Args:
+            event (SessionEvent): event of the sessionizer
+        """
+        session = event.session
+        opened = event.kind == 'opened'
+        now = session.connected if opened else event.closed
+        shard = hash(session.address) % len(self.batches)
+        with self._lock:
+            self.now = now if self.now is None else max(self.now, now)
+            batch = self.batches[shard]
+            batch.append((opened, session.address, session.opened, now))
+            if len(batch) >= EVENT_BATCH_SIZE:
+                self._send_batch(shard)
+
+    def evaluate(self, rows: Optional[list] = None) -> List[Finding]:
+        """Evaluates all rules in all shards and returns the findings which were not
+        reported yet.
+
+        Args:
+            rows (list, optional): result of count_active_connections_per_host of this
+            pass, the live sessions are counted if not set
+
+        Returns:
+            List[Finding]: the new findings, ordered by rule
+        """
+        shard_keys = shard_counts = [None] * len(self.batches)
+        if rows is not None:
+            shard_keys, shard_counts = [[] for _ in self.batches], [[] for _ in self.batches]
+            for key, count in zip(*graph_counts(rows)):
+                shard = hash(key) % len(self.batches)
+                shard_keys[shard].append(key)
+                shard_counts[shard].append(count)
+        with self._lock:
+            for shard in range(len(self.batches)):
+                self._send_batch(shard)
+            # All shards evaluate at the same time, the answers are collected afterwards
+            for connection, keys, counts in zip(self.connections, shard_keys, shard_counts):
+                connection.send(('evaluate', self.now, keys, counts))
+            answers = [connection.recv() for connection in self.connections]
+        values = {rule.name: [] for rule in self.rules}
+        for matching, _ in answers:
+            for name, subjects in matching.items():
+                values[name].extend(subjects)
+        for rule in self.rules:
+            if rule.rule_type == 'subnet':
+                values[rule.name] = self._merge_networks(rule, [totals for _, totals in answers])
+        findings = []
+        matching = set()
+        for rule in self.rules:
+            for subject, value in values[rule.name]:
+                matching.add((rule.name, subject))
+                if (rule.name, subject) not in self.reported:
+                    findings.append(Finding(rule, subject, int(round(value))))
+        self.reported = matching
+        return findings
+
+    def stop(self):
+        """Stops the worker processes, the events which were not sent yet are dropped.
+        """
+        with self._lock:
+            for connection, process in zip(self.connections, self.processes):
+                connection.send(None)
+                process.join()
+                connection.close()
+            self.connections = []
+            self.processes = []
+
+    def _send_batch(self, shard: int):
+        """Sends the waiting events of a shard to its process.
+        """
+        batch = self.batches[shard]
+        if batch:
+            self.connections[shard].send(('events', batch))
+            SHARD_EVENTS.inc(amount=len(batch), label_value=str(shard))
+            self.batches[shard] = []
+
+    @staticmethod
+    def _merge_networks(rule: Rule, totals: List[dict]) -> list:
+        """Adds up the sums per prefix of all shards and returns the networks above the
+        threshold of the rule.
+        """
+        prefix_length = rule.parameters['prefix_length']
+        networks = np.concatenate([shard_totals[prefix_length][0] for shard_totals in totals])
+        sums = np.concatenate([shard_totals[prefix_length][1] for shard_totals in totals])
+        networks, inverse = np.unique(networks, return_inverse=True)
+        sums = np.bincount(inverse, weights=sums, minlength=len(networks))
+        mask = sums > rule.threshold
+        return [(int_to_ip(network << (32 - prefix_length)) + '/' + str(prefix_length), value)
+                for network, value in zip(networks[mask].tolist(), sums[mask].tolist())]
+
+
+if __name__ == '__main__':
+    from log_generator import MosquittoLogGenerator
+
+    example_sessionizer = ConnectionSessionizer()
+    example_detection = ShardedDetection.from_file(shards=4)
+    example_detection.observe(example_sessionizer)
+    for example_line in MosquittoLogGenerator(seed=0).lines('slow_dos', 20000):
+        example_sessionizer.process_line(example_line)
+    for example_finding in example_detection.evaluate():
+        print(example_finding.rule.name, example_finding.message)
+    example_detection.stop()
@@ -0,0 +1,474 @@
+"""This module stores the graph of the detection system in an embedded SQLite database
+    for single node deployments without a neo4j instance. Hosts, connections and
+    services are tables with their key as unique column, STARTS_CONNECTION edges have
+    their own table and all other edges are stored by label and key of their nodes.
+
+    The database runs in WAL mode, so other processes can read the file while the
+    detection system writes.
+    All statements are constant and take parameters, so sqlite keeps them prepared in
+    its statement cache. Writes are committed in batches, after BATCH_SIZE writes or
+    COMMIT_INTERVAL_SECONDS, whatever comes first, the interval is checked on the next
+    write and by the detection pass, so the writes of a quiet log are committed by the
+    next pass. The count of the detection is a
+    GROUP BY over the index of the active connections.
+
+    Adapted from:
+    https://www.sqlite.org/wal.html
+    [last accessed April 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, Tuple
+
+from beartype import beartype
+
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+from stage_timing import STAGE_TIMING
+
+SQLITE_PATH = 'ids_graph.db'
+BATCH_SIZE = 500
+COMMIT_INTERVAL_SECONDS = 1.0
+STATEMENT_CACHE_SIZE = 256
+# Table, key column and columns of the nodes which are stored
+NODE_TABLES = {'Host': ('hosts', 'ip_address', ('ip_address', 'creation_time', 'notification_sent', 'is_blocked')),
+               'Connection': ('connections', 'name', ('status', 'port', 'name', 'last_update_time')),
+               'Service': ('services', 'name', ('name', 'port', 'protocol', 'version'))}
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, ip_address TEXT UNIQUE, creation_time TEXT, '
+    'notification_sent TEXT, is_blocked TEXT)',
+    'CREATE TABLE IF NOT EXISTS connections (id INTEGER PRIMARY KEY, name TEXT UNIQUE, status TEXT, port TEXT, '
+    'last_update_time TEXT)',
+    'CREATE TABLE IF NOT EXISTS services (id INTEGER PRIMARY KEY, name TEXT UNIQUE, port TEXT, protocol TEXT, '
+    'version TEXT)',
+    'CREATE TABLE IF NOT EXISTS starts_connection (host_id INTEGER NOT NULL, connection_id INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS edges (edge_name TEXT NOT NULL, node1_label TEXT, node1_key TEXT, '
+    'node2_label TEXT, node2_key TEXT)',
+    'CREATE TABLE IF NOT EXISTS constraints (node_name TEXT, property_names TEXT, '
+    'PRIMARY KEY (node_name, property_names))',
+    # Only the active connections are in the index the detection joins on
+    'CREATE INDEX IF NOT EXISTS connections_active ON connections (id) WHERE status = \'active\'',
+    'CREATE INDEX IF NOT EXISTS starts_connection_connection ON starts_connection (connection_id, host_id)',
+    'CREATE INDEX IF NOT EXISTS starts_connection_host ON starts_connection (host_id)',
+    'CREATE INDEX IF NOT EXISTS hosts_blocked ON hosts (is_blocked)',
+    'CREATE INDEX IF NOT EXISTS edges_name ON edges (edge_name, node1_key)',
+)
+
+INSERT_HOST = ('INSERT OR IGNORE INTO hosts (ip_address, creation_time, notification_sent, is_blocked) '
+               'VALUES (:ip_address, :creation_time, :notification_sent, :is_blocked)')
+INSERT_CONNECTION = ('INSERT OR IGNORE INTO connections (name, status, port, last_update_time) '
+                     'VALUES (:name, :status, :port, :last_update_time)')
+INSERT_SERVICE = ('INSERT OR IGNORE INTO services (name, port, protocol, version) '
+                  'VALUES (:name, :port, :protocol, :version)')
+# CROSS JOIN keeps the order: active connections, their edges by the covering index and
+# the host by its id. Otherwise sqlite starts with all unblocked hosts and all their edges.
+COUNT_ACTIVE_CONNECTIONS = (
+    'SELECT h.ip_address, h.creation_time, h.notification_sent, h.is_blocked, count(*) '
+    'FROM connections c INDEXED BY connections_active '
+    'CROSS JOIN starts_connection s ON s.connection_id = c.id '
+    'CROSS JOIN hosts h ON h.id = s.host_id '
+    'WHERE c.status = \'active\' AND h.notification_sent = \'False\' AND h.is_blocked = \'False\' '
+    'GROUP BY h.id'
+)
+
+
+class SqliteDatabaseAccess(GraphStorage):
+    """Implements the graph storage on a sqlite database file. The connection is shared
+    by the threads of the process and guarded by a lock.
+    """
+
+    @beartype
+    def __init__(self, database_path: str = SQLITE_PATH, batch_size: int = BATCH_SIZE,
+                 commit_interval: float = COMMIT_INTERVAL_SECONDS):
+        """Opens or creates the database and its tables.
+
+        Args:
+            database_path (str): path of the database file, :memory: for a temporary one
+            batch_size (int): number of writes which are committed together
+            commit_interval (float): seconds after which pending writes are committed
+        """
+        self.database_path = database_path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.connection = sqlite3.connect(database_path, check_same_thread=False,
+                                          cached_statements=STATEMENT_CACHE_SIZE)
+        self._lock = threading.RLock()
+        self._pending_writes = 0
+        self._last_commit = time.monotonic()
+        self._in_batch = False
+        with self._lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # With WAL a crash can only lose the last commits, never corrupt the file
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+        STAGE_TIMING.instrument(self, 'sqlite.')
+        METRICS.instrument(self, 'ids_db')
+
+    def close(self):
+        """Commits the pending writes and closes the database.
+        """
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def commit(self):
+        """Commits the pending writes now.
+        """
+        with self._lock:
+            self.connection.commit()
+            self._pending_writes = 0
+            self._last_commit = time.monotonic()
+
+    def write_batch(self, mutations: List[Tuple[str, tuple]]):
+        """Applies the mutations in one immediate transaction which is committed right
+        away, so other processes writing to the file only wait for whole batches.
+
+        Args:
+            mutations (List[Tuple[str, tuple]]): name of the method and its arguments
+        """
+        with self._lock:
+            self.commit()
+            self.connection.execute('BEGIN IMMEDIATE')
+            self._in_batch = True
+            try:
+                for method_name, args in mutations:
+                    getattr(self, method_name)(*args)
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                self._in_batch = False
+            self.commit()
+
+    def _write(self, statement: str, parameters=()) -> int:
+        """Executes a write and commits the batch if it is full or old enough.
+
+        Returns:
+            int: number of changed rows
+        """
+        with self._lock:
+            try:
+                row_count = self.connection.execute(statement, parameters).rowcount
+            # Capture any errors along with the statement for traceability
+            except sqlite3.Error as exception:
+                logging.error('%s raised an error: \n %s', statement, exception)
+                raise
+            self._pending_writes += 1
+            # The writes of a batch are committed together by write_batch
+            if self._in_batch:
+                return row_count
+            if (self._pending_writes >= self.batch_size
+                    or time.monotonic() - self._last_commit >= self.commit_interval):
+                self.commit()
+            return row_count
+
+    def _read(self, statement: str, parameters=()) -> list:
+        """Executes a query and returns all rows.
+        """
+        with self._lock:
+            try:
+                return self.connection.execute(statement, parameters).fetchall()
+            # Capture any errors along with the statement for traceability
+            except sqlite3.Error as exception:
+                logging.error('%s raised an error: \n %s', statement, exception)
+                raise
+
+    @beartype
+    def create_host(self, host_json: str):
+        """Creates a host node, the ip address is unique.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._write(INSERT_HOST, self._row('Host', host_json))
+
+    @beartype
+    def upsert_host(self, host_json: str):
+        """Creates a host node if no host has the ip address.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._write(INSERT_HOST, self._row('Host', host_json))
+
+    @beartype
+    def create_connection(self, connection_json: str):
+        """Creates a connection node, the name is unique.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._write(INSERT_CONNECTION, self._row('Connection', connection_json))
+
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        """Creates a connection node if no connection has the name.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._write(INSERT_CONNECTION, self._row('Connection', connection_json))
+
+    @beartype
+    def create_service(self, service_json: str):
+        """Creates a service node, the name is unique.
+
+        Args:
+            service_json (str): data of the service in json format.
+        """
+        self._write(INSERT_SERVICE, self._row('Service', service_json))
+
+    @beartype
+    def create_edge(self, edge_data: str):
+        """Creates an edge between all pairs of nodes matching the two node descriptions.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._insert_edge(json.loads(edge_data), False)
+
+    @beartype
+    def merge_edge(self, edge_data: str):
+        """Creates an edge between all pairs of matching nodes which are not connected
+        by an edge of the same type yet.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._insert_edge(json.loads(edge_data), True)
+
+    def _insert_edge(self, edge_data: dict, unique: bool):
+        """Inserts the edges between the matching nodes, with unique only if the pair
+        has no edge of the type.
+        """
+        node1, node2 = edge_data['node1'], edge_data['node2']
+        where1, parameters1 = self._where_clause(node1, 'a')
+        where2, parameters2 = self._where_clause(node2, 'b')
+        table1, key1, _ = NODE_TABLES[node1['name']]
+        table2, key2, _ = NODE_TABLES[node2['name']]
+        if (edge_data['edge_name'] == 'STARTS_CONNECTION' and node1['name'] == 'Host'
+                and node2['name'] == 'Connection'):
+            statement = ('INSERT INTO starts_connection (host_id, connection_id) '
+                         'SELECT a.id, b.id FROM hosts a, connections b WHERE ' + where1 + ' AND ' + where2)
+            if unique:
+                statement = statement + (' AND NOT EXISTS (SELECT 1 FROM starts_connection s '
+                                         'WHERE s.connection_id = b.id AND s.host_id = a.id)')
+            self._write(statement, parameters1 + parameters2)
+            return
+        statement = ('INSERT INTO edges (edge_name, node1_label, node1_key, node2_label, node2_key) '
+                     'SELECT ?, ?, a.' + key1 + ', ?, b.' + key2 + ' FROM ' + table1 + ' a, ' + table2 + ' b '
+                     'WHERE ' + where1 + ' AND ' + where2)
+        parameters = [edge_data['edge_name'], node1['name'], node2['name']] + parameters1 + parameters2
+        if unique:
+            statement = statement + (' AND NOT EXISTS (SELECT 1 FROM edges e WHERE e.edge_name = ? '
+                                     'AND e.node1_label = ? AND e.node1_key = a.' + key1 + ' '
+                                     'AND e.node2_label = ? AND e.node2_key = b.' + key2 + ')')
+            parameters = parameters + [edge_data['edge_name'], node1['name'], node2['name']]
+        self._write(statement, parameters)
+
+    @beartype
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Stores a constraint, the key columns of the tables are unique anyway.
+
+        Args:
+            node_name (str): name of the node the constraint should be applied on.
+            property_names (List[str]): names of the properties of the constraint.
+        """
+        self._write('INSERT OR IGNORE INTO constraints (node_name, property_names) VALUES (?, ?)',
+                    (node_name, ','.join(property_names)))
+
+    @beartype
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Check if a node with the given property value exists.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_name (str): name of the property.
+            property_value ([type]): value of the property.
+
+        Returns:
+            bool: True if node exists False otherwise.
+        """
+        where, parameters = self._where_clause({'name': node_name, 'property_names': [property_name],
+                                                'property_values': [property_value]}, 'a')
+        table = NODE_TABLES[node_name][0]
+        return bool(self._read('SELECT 1 FROM ' + table + ' a WHERE ' + where + ' LIMIT 1', parameters))
+
+    @beartype
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Checks if a constraint was created before.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_names (List[str]): names of the properties of the constraint.
+
+        Returns:
+            bool: True if the constraint exists False otherwise
+        """
+        return bool(self._read('SELECT 1 FROM constraints WHERE node_name = ? AND property_names = ?',
+                               (node_name, ','.join(property_names))))
+
+    @beartype
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """Checks if a host is blocked for new incoming connection or not.
+
+        Args:
+            ip_address (str): ip address of host to verify
+
+        Returns:
+            bool: True if host is currently blocked
+        """
+        rows = self._read('SELECT is_blocked FROM hosts WHERE ip_address = ?', (ip_address,))
+        return bool(rows) and rows[0][0] == 'True'
+
+    @beartype
+    def update_connection_status(self, connection_name: str, status: str):
+        """Updates the status of a connection to active or inactive
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            status (str): status to be set for the connection
+        """
+        self._write('UPDATE connections SET status = ? WHERE name = ?', (status, connection_name))
+
+    @beartype
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Updates the timestamp when the connection was last updated.
+
+        Args:
+            connection_name (str): name of the connection
+            time (str): the timestamp to set
+        """
+        self._write('UPDATE connections SET last_update_time = ? WHERE name = ?', (time, connection_name))
+
+    @beartype
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Updates the block status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host to be blocked
+            is_blocked (str): state of the block status (True/False)
+        """
+        self._write('UPDATE hosts SET is_blocked = ? WHERE ip_address = ?', (is_blocked, ip_address))
+        # An alert must not be lost, the block is committed right away
+        self.commit()
+
+    @beartype
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Updates the notification status of a host.
+
+        Args:
+            ip_address (str): ip_address of the host
+            sent (str): state of the notification status (True/False)
+        """
+        self._write('UPDATE hosts SET notification_sent = ? WHERE ip_address = ?', (sent, ip_address))
+        self.commit()
+
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Updates the ip address of a host, unless another host has the new ip address.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+        """
+        if self._read('SELECT 1 FROM hosts WHERE ip_address = ?', (new_ip_address,)):
+            logging.error('The host %s was not moved to %s, a host with this ip address exists',
+                          old_ip_address, new_ip_address)
+            return
+        self._write('UPDATE hosts SET ip_address = ? WHERE ip_address = ?', (new_ip_address, old_ip_address))
+
+    @beartype
+    def update_service_version(self, service_name: str, version: str):
+        """Updates the version of a service.
+
+        Args:
+            service_name (str): name of the service
+            version (str): version of the service
+        """
+        self._write('UPDATE services SET version = ? WHERE name = ?', (version, service_name))
+
+    @beartype
+    def update_service_port(self, service_name: str, port: str):
+        """Updates the port of a service.
+
+        Args:
+            service_name (str): name of the service
+            port (str): port of the service
+        """
+        self._write('UPDATE services SET port = ? WHERE name = ?', (port, service_name))
+
+    def count_active_connections_per_host(self):
+        """Counts the active connections of every host which is neither blocked nor
+        already notified.
+
+        Returns:
+            result (list): a list of dictonaries with the host properties as h and the
+            number of active connections as count
+        """
+        with self._lock:
+            # Without a later write the pending writes would stay invisible to other processes
+            if self._pending_writes:
+                self.commit()
+            rows = self._read(COUNT_ACTIVE_CONNECTIONS)
+        return [{'h': {'ip_address': ip_address, 'creation_time': creation_time,
+                       'notification_sent': notification_sent, 'is_blocked': is_blocked},
+                 'count': count}
+                for ip_address, creation_time, notification_sent, is_blocked, count in rows]
+
+    def get_blocked_hosts(self):
+        """Returns the ip addresses of all blocked hosts.
+
+        Returns:
+            List[str]: the ip addresses
+        """
+        return [row[0] for row in self._read('SELECT ip_address FROM hosts WHERE is_blocked = \'True\'')]
+
+    @staticmethod
+    def _row(node_name: str, node_json: str) -> dict:
+        """Returns the values of the columns of a node from its json data.
+        """
+        node_data = json.loads(node_json)
+        return {name: node_data.get(name) for name in NODE_TABLES[node_name][2]}
+
+    @staticmethod
+    def _where_clause(description: dict, alias: str) -> tuple:
+        """Formats the condition matching a node description with ? parameters. Only
+        known columns are formatted into the statement.
+
+        Returns:
+            tuple: the condition and the list of its parameters
+        """
+        if description['name'] not in NODE_TABLES:
+            raise ValueError('Nodes with label ' + description['name'] + ' are not stored in sqlite')
+        columns = NODE_TABLES[description['name']][2]
+        conditions = []
+        for property_name in description['property_names']:
+            if property_name not in columns:
+                raise ValueError('Unknown property ' + property_name + ' of ' + description['name'])
+            conditions.append(alias + '.' + property_name + ' = ?')
+        return ' AND '.join(conditions) or '1', list(description['property_values'])
+
+
+if __name__ == '__main__':
+    sqlite_driver = SqliteDatabaseAccess(':memory:')
+    sqlite_driver.create_host(json.dumps({'ip_address': '127.0.0.1', 'creation_time': '1635015162',
+                                          'is_blocked': 'False', 'notification_sent': 'False'}))
+    sqlite_driver.create_connection(json.dumps({'status': 'active', 'name': 'mqtt-explorer-0a61e6f1',
+                                                'last_update_time': '1635015162'}))
+    sqlite_driver.create_edge(json.dumps({'edge_name': 'STARTS_CONNECTION',
+                                          'node1': {'name': 'Host', 'property_names': ['ip_address'],
+                                                    'property_values': ['127.0.0.1']},
+                                          'node2': {'name': 'Connection', 'property_names': ['name'],
+                                                    'property_values': ['mqtt-explorer-0a61e6f1']}}))
+    print(sqlite_driver.count_active_connections_per_host())
+    sqlite_driver.close()
@@ -0,0 +1,270 @@
+"""This module records how long the stages of the detection system take: reading and
+    parsing log lines, every method of the database access, detection passes and
+    sending alerts. The durations are kept in log linear histograms like the HDR
+    histogram, so percentiles have a relative error of about one percent with a fixed
+    small number of buckets and recording is a few integer operations.
+
+    The timing is enabled with the environment variable IDS_STAGE_TIMING=1. If it is
+    disabled the timers are a shared no-op context and no method is wrapped. The report
+    is printed when the process receives SIGUSR1, e.g. kill -USR1 <pid>. The signal
+    handler only wakes up a reporter thread: it runs on the main thread between two
+    bytecodes, also while the ingest holds the lock of the histograms.
+
+    Adapted from:
+    https://github.com/HdrHistogram/HdrHistogram_py
+    [last accessed April 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import contextlib
+import functools
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Callable, Optional
+
+from beartype import beartype
+
+# 2^7 sub buckets per power of two, the relative error of a value is below 1/128
+SUB_BUCKET_BITS = 7
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+_NO_TIMER = contextlib.nullcontext()
+
+
+@beartype
+def run_on_signal(signal_number: int, function: Callable[[], None]):
+    """Calls a function in a daemon thread whenever the process receives a signal, a
+    handler which was installed before is still called. The handler only writes a
+    byte to a pipe, it takes no lock the interrupted main thread may hold. Must be
+    called from the main thread.
+
+    Args:
+        signal_number (int): e.g. signal.SIGUSR1
+        function (Callable[[], None]): e.g. the dump of a report
+    """
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    previous = signal.getsignal(signal_number)
+
+    def handler(received_signal, frame):
+        try:
+            os.write(write_fd, b'\0')
+        # The pipe is full, the reporter runs anyway
+        except BlockingIOError:
+            pass
+        if callable(previous):
+            previous(received_signal, frame)
+
+    def run():
+        while os.read(read_fd, 1):
+            try:
+                function()
+            # A failing report must not end the reporter
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Reporting on signal %s raised an error: \n %s', signal_number, exception)
+
+    threading.Thread(target=run, daemon=True).start()
+    signal.signal(signal_number, handler)
+
+
+class LogLinearHistogram:
+    """Counts values in buckets which are linear within each power of two.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.total_count = 0
+        self.total_value = 0
+        self.max_value = 0
+
+    @beartype
+    def record(self, value: int):
+        """Adds a value.
+
+        Args:
+            value (int): a positive value e.g. a duration in microseconds
+        """
+        exponent = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        index = (exponent << SUB_BUCKET_BITS) + (value >> exponent)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total_count += 1
+        self.total_value += value
+        if value > self.max_value:
+            self.max_value = value
+
+    @beartype
+    def value_at_percentile(self, fraction: float) -> int:
+        """Returns the highest value of the bucket which contains the percentile.
+
+        Args:
+            fraction (float): e.g. 0.99 for the p99
+
+        Returns:
+            int: the value, 0 if nothing was recorded
+        """
+        if self.total_count == 0:
+            return 0
+        target = max(1, int(fraction * self.total_count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                exponent = index >> SUB_BUCKET_BITS
+                sub_bucket = index - (exponent << SUB_BUCKET_BITS)
+                return min(((sub_bucket + 1) << exponent) - 1, self.max_value)
+        return self.max_value
+
+    def mean(self) -> float:
+        """Returns the mean of all values.
+        """
+        return self.total_value / self.total_count if self.total_count else 0.0
+
+
+class StageTiming:
+    """Collects a histogram per stage and the error count of each instrumented method.
+    """
+
+    @beartype
+    def __init__(self, enabled: bool):
+        """Initializes the timing.
+
+        Args:
+            enabled (bool): if False all timers are no-ops
+        """
+        self.enabled = enabled
+        self.histograms = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def time(self, stage: str):
+        """Returns a context manager which records the duration of its block.
+
+        Args:
+            stage (str): name of the stage
+
+        Returns:
+            ContextManager: the timer or a shared no-op if the timing is disabled
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return self._timer(stage)
+
+    @contextlib.contextmanager
+    def _timer(self, stage: str):
+        """Records the duration of the block in microseconds.
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter_ns() - start) // 1000)
+
+    @beartype
+    def record(self, stage: str, microseconds: int):
+        """Adds a duration to the histogram of a stage.
+
+        Args:
+            stage (str): name of the stage
+            microseconds (int): the duration
+        """
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LogLinearHistogram()
+            histogram.record(microseconds)
+
+    @beartype
+    def instrument(self, instance: object, prefix: str):
+        """Wraps every public method of an instance to time it and to count its calls
+        and errors. Only the instance is changed, not its class.
+
+        Args:
+            instance (object): e.g. a Neo4jDatabaseAccess
+            prefix (str): put in front of the method name to name the stage
+        """
+        if not self.enabled:
+            return
+        for name in dir(type(instance)):
+            if name.startswith('_') or not callable(getattr(type(instance), name)):
+                continue
+            setattr(instance, name, self.wrap(getattr(instance, name), prefix + name))
+
+    def wrap(self, method: Callable, stage: str) -> Callable:
+        """Returns the function with timing and error counting. For hot loops where even
+        a no-op context is too much, the function is returned unchanged if disabled.
+
+        Args:
+            method (Callable): the function to time
+            stage (str): name of the stage
+
+        Returns:
+            Callable: the wrapped function
+        """
+        if not self.enabled:
+            return method
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors[stage] = self.errors.get(stage, 0) + 1
+                raise
+            finally:
+                self.record(stage, (time.perf_counter_ns() - start) // 1000)
+        return wrapper
+
+    def report(self) -> str:
+        """Formats the histograms and counters as a table with durations in ms.
+
+        Returns:
+            str: one line per stage
+        """
+        with self._lock:
+            stages = sorted(self.histograms.items())
+            header = f"{'stage':<50} {'count':>9} {'errors':>7} {'mean':>9}"
+            header = header + ''.join(f" {'p' + format(fraction * 100, 'g'):>9}" for fraction in PERCENTILES)
+            lines = [header + f" {'max':>9}"]
+            for stage, histogram in stages:
+                line = (f'{stage:<50} {histogram.total_count:>9} {self.errors.get(stage, 0):>7} '
+                        f'{histogram.mean() / 1000:>9.3f}')
+                for fraction in PERCENTILES:
+                    line = line + f' {histogram.value_at_percentile(fraction) / 1000:>9.3f}'
+                lines.append(line + f' {histogram.max_value / 1000:>9.3f}')
+        return '\n'.join(lines)
+
+    def dump(self):
+        """Prints the report.
+        """
+        print(self.report(), flush=True)
+
+    @beartype
+    def install_signal_handler(self, signal_number: Optional[int] = None):
+        """Prints the report in a reporter thread whenever the process receives the
+        signal. Must be called from the main thread, does nothing on systems without
+        SIGUSR1.
+
+        Args:
+            signal_number (int, optional): defaults to SIGUSR1
+        """
+        if signal_number is None:
+            signal_number = getattr(signal, 'SIGUSR1', None)
+        if self.enabled and signal_number is not None:
+            run_on_signal(signal_number, self.dump)
+
+
+STAGE_TIMING = StageTiming(os.environ.get('IDS_STAGE_TIMING', '0') == '1')
+
+
+if __name__ == '__main__':
+    example_timing = StageTiming(True)
+    for duration in range(1, 100000, 7):
+        example_timing.record('example', duration)
+    with example_timing.time('sleep'):
+        time.sleep(0.01)
+    example_timing.dump()
@@ -0,0 +1,274 @@
+"""This module detects slow DoS attacks which are spread over many ip addresses of one
+    network, so every single host stays below the threshold of the network monitoring.
+
+    The connected clients are counted per prefix of their ip address, by default per
+    /32, /24 and /16. The counters are updated with every session the sessionizer opens
+    or closes and a counter is removed when it drops to zero, so the memory grows with
+    the prefixes which have connected clients and nothing is aggregated in the graph.
+    A prefix whose count crosses the threshold of its level is reported once, until
+    its count falls below the threshold again.
+
+    The thresholds are set with the environment variable IDS_SUBNET_THRESHOLDS as
+    prefix length and threshold pairs, e.g. IDS_SUBNET_THRESHOLDS=32:50,24:200,16:1000.
+    Clients which connected before the log was read are not counted.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import ipaddress
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from beartype import beartype
+
+from alarm_notification import AlarmNotification
+from compact_state import IPV6_FLAG
+from connection_sessionizer import ConnectionSessionizer, SessionEvent
+from ip_blocklist import IpBlocklist
+from metrics_endpoint import METRICS
+from stage_timing import STAGE_TIMING
+
+SUBNET_THRESHOLDS_VARIABLE = 'IDS_SUBNET_THRESHOLDS'
+# Prefix length -> number of connected clients above which the prefix is reported
+DEFAULT_THRESHOLDS = {32: 50, 24: 200, 16: 1000}
+DEFAULT_IPV6_THRESHOLDS = {128: 50, 64: 200, 48: 1000}
+DEFAULT_INTERVAL_SECONDS = 1.0
+
+SUBNET_ALERTS_SENT = METRICS.counter('ids_subnet_alerts_sent_total', 'Alerts sent for prefixes with too many clients',
+                                     'prefix_length')
+
+
+class PrefixCounters:
+    """Counters of the connected clients per prefix for several prefix lengths of
+    addresses with a fixed width.
+    """
+
+    def __init__(self, thresholds: Dict[int, int], width: int):
+        """Creates empty counters.
+
+        Args:
+            thresholds (Dict[int, int]): threshold per prefix length
+            width (int): bits of an address, 32 for IPv4 and 128 for IPv6
+        """
+        self.width = width
+        # Longest prefix first, so a host is reported before its network
+        self.levels = [(length, width - length, threshold, {})
+                       for length, threshold in sorted(thresholds.items(), reverse=True)]
+
+    def __len__(self) -> int:
+        return sum(len(counts) for _, _, _, counts in self.levels)
+
+    def add(self, address: int, change: int) -> List[Tuple[int, int, int]]:
+        """Changes the counters of all prefixes of an address.
+
+        Args:
+            address (int): the address as integer
+            change (int): 1 for an opened and -1 for a closed session
+
+        Returns:
+            List[Tuple[int, int, int]]: prefix length, network and count of every prefix
+            which crossed its threshold with this change
+        """
+        crossed = []
+        for length, shift, threshold, counts in self.levels:
+            network = address >> shift
+            count = counts.get(network, 0) + change
+            if count > 0:
+                counts[network] = count
+            else:
+                counts.pop(network, None)
+            if change > 0 and count == threshold + 1:
+                crossed.append((length, network << shift, count))
+        return crossed
+
+    def count(self, address: int, length: int) -> int:
+        """Returns the number of connected clients in the prefix of an address.
+
+        Args:
+            address (int): the address as integer
+            length (int): one of the configured prefix lengths
+
+        Returns:
+            int: the number of clients
+        """
+        for level_length, shift, _, counts in self.levels:
+            if level_length == length:
+                return counts.get(address >> shift, 0)
+        raise ValueError('No counters for prefix length ' + str(length))
+
+    def is_above(self, length: int, network: int) -> bool:
+        """Checks if the prefix is still above its threshold.
+
+        Args:
+            length (int): prefix length
+            network (int): address of the network
+
+        Returns:
+            bool: True if the count is above the threshold
+        """
+        for level_length, shift, threshold, counts in self.levels:
+            if level_length == length:
+                return counts.get(network >> shift, 0) > threshold
+        return False
+
+
+@beartype
+def thresholds_from_environment() -> Dict[int, int]:
+    """Reads the IPv4 thresholds from IDS_SUBNET_THRESHOLDS.
+
+    Returns:
+        Dict[int, int]: threshold per prefix length, the defaults if the variable is not set
+    """
+    value = os.environ.get(SUBNET_THRESHOLDS_VARIABLE)
+    if not value:
+        return dict(DEFAULT_THRESHOLDS)
+    thresholds = {}
+    for pair in value.split(','):
+        length, threshold = pair.split(':')
+        if not 0 <= int(length) <= 32:
+            raise ValueError('Prefix length ' + length + ' is not between 0 and 32')
+        thresholds[int(length)] = int(threshold)
+    return thresholds
+
+
+class SubnetMonitoring:
+    """Counts the sessions of the sessionizer per prefix and reports the prefixes with
+    too many connected clients.
+    """
+
+    def __init__(self, sessionizer: ConnectionSessionizer, thresholds: Optional[Dict[int, int]] = None,
+                 ipv6_thresholds: Optional[Dict[int, int]] = None, blocklist: Optional[IpBlocklist] = None,
+                 email_notification=None) -> None:
+        """Registers the counters as listener of the sessionizer.
+
+        Args:
+            sessionizer (ConnectionSessionizer): the sessionizer of the log transformation
+            thresholds (Dict[int, int], optional): IPv4 threshold per prefix length, read
+            from IDS_SUBNET_THRESHOLDS if not set
+            ipv6_thresholds (Dict[int, int], optional): IPv6 threshold per prefix length
+            blocklist (IpBlocklist, optional): reported prefixes are blocked if set
+            email_notification (optional): sends the alerts, an AlarmNotification if not set
+        """
+        self.counters = (PrefixCounters(thresholds if thresholds is not None else thresholds_from_environment(), 32),
+                         PrefixCounters(ipv6_thresholds if ipv6_thresholds is not None
+                                        else DEFAULT_IPV6_THRESHOLDS, 128))
+        self.blocklist = blocklist
+        self.email_notification = email_notification if email_notification is not None else AlarmNotification()
+        self.monitoring_status = True
+        # Prefixes which crossed their threshold and were not reported yet
+        self.pending = deque()
+        self.reported = set()
+        self._lock = threading.Lock()
+        sessionizer.add_listener(self.process_event)
+        METRICS.gauge('ids_subnet_prefixes', 'Prefixes with connected clients', function=self.active_prefixes)
+
+    def active_prefixes(self) -> int:
+        """Returns the number of counters.
+
+        Returns:
+            int: prefixes with at least one connected client
+        """
+        return len(self.counters[0]) + len(self.counters[1])
+
+    @beartype
+    def process_event(self, event: SessionEvent):
+        """Counts an opened or closed session.
+
+        Args:
+            event (SessionEvent): event of the sessionizer
+        """
+        address = event.session.address
+        # Addresses in an unusual notation are not part of any network
+        if not isinstance(address, int):
+            return
+        if address & IPV6_FLAG:
+            counters, address = self.counters[1], address ^ IPV6_FLAG
+        else:
+            counters = self.counters[0]
+        with self._lock:
+            crossed = counters.add(address, 1 if event.kind == 'opened' else -1)
+            for length, network, _ in crossed:
+                if (counters, length, network) not in self.reported:
+                    self.reported.add((counters, length, network))
+                    self.pending.append((counters, length, network))
+
+    def run_detection_pass(self) -> List[str]:
+        """Reports the prefixes which crossed their threshold since the last pass and
+        forgets the reported prefixes which are below their threshold again.
+
+        Returns:
+            List[str]: the reported prefixes in CIDR notation
+        """
+        with STAGE_TIMING.time('subnet_detection_pass'):
+            return self._run_detection_pass()
+
+    def _run_detection_pass(self) -> List[str]:
+        """Executes the detection pass.
+
+        Returns:
+            List[str]: the reported prefixes in CIDR notation
+        """
+        with self._lock:
+            pending = list(self.pending)
+            self.pending.clear()
+            counts = [counters.count(network, length) for counters, length, network in pending]
+            self.reported = {(counters, length, network) for counters, length, network in self.reported
+                             if counters.is_above(length, network)}
+        reported_prefixes = []
+        for (counters, length, network), count in zip(pending, counts):
+            prefix = str(ipaddress.ip_network((network, length)) if counters.width == 32
+                         else ipaddress.IPv6Network((network, length)))
+            if length == counters.width:
+                prefix = prefix.split('/')[0]
+            message = 'Prefix ' + prefix + ' has ' + str(count) + ' connected clients'
+            if self.blocklist is not None:
+                self.blocklist.block(prefix)
+            with STAGE_TIMING.time('alert_send'):
+                self.email_notification.connect_to_smtp_server()
+                self.email_notification.send_email(message)
+                self.email_notification.stop_smtp()
+            SUBNET_ALERTS_SENT.inc(label_value=str(length))
+            reported_prefixes.append(prefix)
+        return reported_prefixes
+
+    def _start(self, interval: float):
+        """Runs the detection passes until stop is called.
+        """
+        while self.monitoring_status is True:
+            self.run_detection_pass()
+            time.sleep(interval)
+
+        if self.monitoring_status is False:
+            sys.exit()
+
+    @beartype
+    def start(self, interval: float = DEFAULT_INTERVAL_SECONDS):
+        """Reports the crossed prefixes periodically in a background thread.
+
+        Args:
+            interval (float): seconds to wait between two passes
+        """
+        self.monitoring_status = True
+        threading.Thread(target=self._start, args=(interval,), daemon=True).start()
+
+    def stop(self):
+        """Stops the background reports after the current pass.
+        """
+        self.monitoring_status = False
+
+
+if __name__ == '__main__':
+    from benchmark import DiscardNotification
+    from log_generator import MosquittoLogGenerator
+
+    example_sessionizer = ConnectionSessionizer()
+    example_notification = DiscardNotification()
+    example_monitoring = SubnetMonitoring(example_sessionizer, email_notification=example_notification)
+    for example_line in MosquittoLogGenerator(seed=0).lines('distributed_dos', 10000):
+        example_sessionizer.process_line(example_line)
+    print(example_monitoring.run_detection_pass(), example_monitoring.active_prefixes())
+    print(example_notification.messages)
@@ -0,0 +1,38 @@
+"""This module makes the modules of the detection system importable for the tests,
+    they import each other by their module name. The create_detection fixture runs a
+    test with every detection mode which evaluates the rules like the rule engine.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(name='create_detection', params=['vectorized', 'sharded'])
+def fixture_create_detection(request):
+    """Creates the detection of the mode with the given rules, the workers of the
+    sharded detection are stopped after the test.
+    """
+    # Imported here, the modules are importable once the path is set
+    from sharded_detection import ShardedDetection
+    from vectorized_detection import VectorizedDetection
+
+    created = []
+
+    def create_detection(rules):
+        if request.param == 'vectorized':
+            detection = VectorizedDetection(rules)
+        else:
+            detection = ShardedDetection(rules, shards=3)
+        created.append(detection)
+        return detection
+
+    yield create_detection
+    for detection in created:
+        if isinstance(detection, ShardedDetection):
+            detection.stop()
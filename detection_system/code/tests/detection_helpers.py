@@ -0,0 +1,34 @@
+"""Rules and helpers shared by the tests of the detection modes.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+from collections import Counter
+
+from connection_sessionizer import ConnectionSessionizer
+from rule_engine import Rule
+
+RULES = [Rule('too_many_connections', 'count_threshold', 40, block=True),
+         Rule('crowded_network', 'subnet', 100, prefix_length=24),
+         Rule('connection_flood', 'connection_rate', 10, window_seconds=60)]
+
+
+def connect(sessionizer: ConnectionSessionizer, timestamp: int, ip_address: str, client_id: str):
+    """Applies the lines of a client which connects.
+    """
+    sessionizer.process_line(f'{timestamp}: New connection from {ip_address} on port 1883.')
+    sessionizer.process_line(f'{timestamp}: New client connected from {ip_address} as {client_id} (p2, c1, k60).')
+
+
+def graph_rows(sessionizer: ConnectionSessionizer) -> list:
+    """Returns the rows count_active_connections_per_host would return for the live
+    sessions.
+    """
+    counts = Counter(session.ip_address for session in sessionizer.sessions.values())
+    return [{'h': {'ip_address': ip_address}, 'count': count} for ip_address, count in counts.items()]
+
+
+def findings(detection, rows) -> set:
+    """Returns rule name, subject and value of the new findings of a pass.
+    """
+    return {(finding.rule.name, finding.subject, finding.value) for finding in detection.evaluate(rows)}
@@ -0,0 +1,64 @@
+"""Tests of the retries of the batched storage.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+
+import pytest
+from neo4j.exceptions import ServiceUnavailable
+
+import batched_graph_storage
+from batched_graph_storage import MAX_BATCH_RETRIES, BatchedGraphStorage
+from in_memory_database_access import InMemoryDatabaseAccess
+
+
+class FailingStorage(InMemoryDatabaseAccess):
+    """Raises an error for the first writes.
+    """
+
+    def __init__(self, error: Exception, failures: int):
+        super().__init__()
+        self.error = error
+        self.failures = failures
+        self.attempts = 0
+
+    def write_batch(self, mutations):
+        self.attempts += 1
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        super().write_batch(mutations)
+
+
+@pytest.fixture(autouse=True)
+def fixture_fast_retry(monkeypatch):
+    monkeypatch.setattr(batched_graph_storage, 'RETRY_SECONDS', 0.01)
+
+
+def write_host(storage: BatchedGraphStorage):
+    storage.create_host(json.dumps({'ip_address': '10.244.0.12', 'creation_time': '1635015162',
+                                    'is_blocked': 'False', 'notification_sent': 'False'}))
+    storage.flush()
+
+
+def test_a_batch_is_written_again_while_the_storage_is_unavailable():
+    storage = FailingStorage(ServiceUnavailable('The database is restarting'), 2)
+
+    write_host(BatchedGraphStorage(storage))
+
+    assert storage.attempts == 3
+    assert storage.check_if_node_exists('Host', 'ip_address', '10.244.0.12')
+
+
+@pytest.mark.parametrize('error, attempts', [(ValueError('The host is invalid'), 1),
+                                             (ServiceUnavailable('The database is gone'), MAX_BATCH_RETRIES + 1)])
+def test_a_batch_which_still_fails_is_dropped(error, attempts):
+    storage = FailingStorage(error, MAX_BATCH_RETRIES + 1)
+    batched_storage = BatchedGraphStorage(storage)
+
+    write_host(batched_storage)
+
+    assert storage.attempts == attempts
+    assert batched_storage.pending() == 0
+    assert not storage.check_if_node_exists('Host', 'ip_address', '10.244.0.12')
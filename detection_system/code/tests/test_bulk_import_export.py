@@ -0,0 +1,57 @@
+"""Tests of the external sort and the deduplicated files of the csv export.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import csv
+import os
+
+import pytest
+
+from bulk_import_export import BulkImportExport, CsvExportStorage, ExternalSorter
+
+LINES = ['1635015160: New connection from 10.244.0.12 on port 1883.\n',
+         '1635015160: New client connected from 10.244.0.12 as client-01 (p2, c1, k60).\n',
+         '1635015170: Client client-01 disconnected.\n',
+         '1635015180: New connection from 10.244.0.12 on port 1883.\n',
+         '1635015180: New client connected from 10.244.0.12 as client-01 (p2, c1, k60).\n',
+         '1635015190: New connection from 10.244.0.13 on port 1883.\n',
+         '1635015190: New client connected from 10.244.0.13 as client-02 (p2, c1, k60).\n']
+
+
+def read_csv(directory, file_name: str) -> list:
+    with open(os.path.join(directory, file_name), 'r', encoding='utf-8', newline='') as csv_file:
+        return list(csv.reader(csv_file))
+
+
+def test_the_runs_are_merged_in_order(tmp_path):
+    sorter = ExternalSorter(str(tmp_path), 'rows', chunk_rows=2)
+    for row in [('c', '1'), ('a', '2'), ('b', '3'), ('a', '1'), ('c', '0')]:
+        sorter.add(row)
+
+    assert len(sorter.runs) == 2
+    assert list(sorter.sorted_rows()) == [('a', '1'), ('a', '2'), ('b', '3'), ('c', '0'), ('c', '1')]
+
+
+def test_nodes_and_edges_are_deduplicated_across_runs(tmp_path):
+    bulk_export = BulkImportExport(str(tmp_path), chunk_rows=2)
+
+    counts = bulk_export.export(LINES)
+
+    assert counts == {'hosts.csv': 2, 'connections.csv': 2, 'services.csv': 1, 'starts_connection.csv': 2,
+                      'connects_to.csv': 2}
+    connections = read_csv(tmp_path, 'connections.csv')
+    assert connections[0][0] == 'name:ID(Connection)'
+    # The sets after the first create are folded into the node in the order of the log
+    assert ['client-01', 'active', '', '1635015180'] in connections[1:]
+    assert read_csv(tmp_path, 'starts_connection.csv')[1:] == [['10.244.0.12', 'client-01', 'STARTS_CONNECTION'],
+                                                               ['10.244.0.13', 'client-02', 'STARTS_CONNECTION']]
+    assert not os.path.exists(os.path.join(tmp_path, 'runs'))
+
+
+def test_the_export_keeps_no_graph(tmp_path):
+    export_storage = CsvExportStorage(str(tmp_path))
+
+    assert export_storage.count_active_connections_per_host() == []
+    with pytest.raises(ValueError):
+        export_storage.update_host_ip_address('10.244.0.12', '10.244.0.13')
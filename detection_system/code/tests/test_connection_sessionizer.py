@@ -0,0 +1,98 @@
+"""Tests of the session transitions of the connection sessionizer.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import pytest
+
+import connection_sessionizer
+from compact_state import ip_from_key
+from connection_sessionizer import MAX_PENDING_SOCKETS, ConnectionSessionizer
+
+
+@pytest.fixture(name='sessionizer')
+def fixture_sessionizer():
+    return ConnectionSessionizer()
+
+
+@pytest.fixture(name='events')
+def fixture_events(sessionizer):
+    events = []
+    sessionizer.add_listener(events.append)
+    return events
+
+
+def test_a_session_is_opened_with_its_socket(sessionizer, events):
+    assert sessionizer.process_line('1635015160: New connection from 10.244.0.12 on port 1883.') is None
+    event = sessionizer.process_line('1635015162: New client connected from 10.244.0.12 as client1 (p2, c1, k60).')
+
+    assert event.kind == 'opened' and events == [event]
+    assert (event.session.ip_address, event.session.port, event.session.opened, event.session.connected) == (
+        '10.244.0.12', 1883, 1635015160, 1635015162)
+    assert sessionizer.session('client1') is event.session
+    assert not sessionizer.pending_sockets
+
+
+@pytest.mark.parametrize('line, reason', [('1635015170: Client client1 disconnected.', 'disconnected'),
+                                          ('1635015170: Client client1 has exceeded timeout, disconnecting.',
+                                           'timeout'),
+                                          ('1635015170: Socket error on client client1, disconnecting.',
+                                           'socket_error')])
+def test_a_session_is_closed_with_its_reason(sessionizer, line, reason):
+    sessionizer.process_line('1635015160: New connection from 10.244.0.12 on port 1883.')
+    sessionizer.process_line('1635015162: New client connected from 10.244.0.12 as client1 (p2, c1, k60).')
+    event = sessionizer.process_line(line)
+
+    assert (event.kind, event.reason, event.duration, event.session.ip_address) == (
+        'closed', reason, 10, '10.244.0.12')
+    assert sessionizer.session('client1') is None
+
+
+def test_a_reused_client_id_closes_the_old_session(sessionizer, events):
+    sessionizer.process_line('1635015162: New client connected from 10.244.0.12 as client1 (p2, c1, k60).')
+    sessionizer.process_line('1635015170: Client client1 already connected, closing old connection.')
+    sessionizer.process_line('1635015170: New client connected from 10.244.0.13 as client1 (p2, c1, k60).')
+
+    assert [(event.kind, event.reason, event.session.ip_address) for event in events] == [
+        ('opened', None, '10.244.0.12'), ('closed', 'taken_over', '10.244.0.12'), ('opened', None, '10.244.0.13')]
+
+
+def test_a_connect_without_the_old_line_takes_the_session_over(sessionizer, events):
+    sessionizer.process_line('1635015162: New client connected from 10.244.0.12 as client1 (p2, c1, k60).')
+    sessionizer.process_line('1635015170: New client connected from 10.244.0.13 as client1 (p2, c1, k60).')
+
+    assert [(event.kind, event.reason) for event in events] == [
+        ('opened', None), ('closed', 'taken_over'), ('opened', None)]
+    assert sessionizer.session('client1').ip_address == '10.244.0.13'
+
+
+def test_unknown_clients_and_other_lines_are_ignored(sessionizer, events):
+    assert sessionizer.process_line('1635015170: Client client1 disconnected.') is None
+    assert sessionizer.process_line('1635015170: mosquitto version 1.6.9 running') is None
+    assert events == []
+
+
+def test_sockets_of_an_address_are_used_in_order_and_bounded(sessionizer):
+    for port in range(MAX_PENDING_SOCKETS + 2):
+        sessionizer.process_line(f'{1635015000 + port}: New connection from 10.244.0.12 on port {port}.')
+    event = sessionizer.process_line('1635015200: New client connected from 10.244.0.12 as client1 (p2, c1, k60).')
+
+    assert event.session.port == 2
+    assert len(sessionizer.pending_sockets[sessionizer.session('client1').address]) == MAX_PENDING_SOCKETS - 1
+
+
+def test_the_address_without_a_new_socket_for_the_longest_time_is_dropped(sessionizer, monkeypatch):
+    monkeypatch.setattr(connection_sessionizer, 'MAX_PENDING_ADDRESSES', 3)
+    for host in (10, 11, 12, 10, 13):
+        sessionizer.process_line(f'1635015000: New connection from 10.244.0.{host} on port 1883.')
+    event = sessionizer.process_line('1635015001: New client connected from 10.244.0.11 as client1 (p2, c1, k60).')
+
+    assert [(ip_from_key(address), len(sockets)) for address, sockets in sessionizer.pending_sockets.items()] == [
+        ('10.244.0.12', 1), ('10.244.0.10', 2), ('10.244.0.13', 1)]
+    assert event.session.port is None and event.session.opened == 1635015001
+
+
+def test_ipv6_addresses_keep_their_notation(sessionizer):
+    event = sessionizer.process_line('1635015162: New client connected from fd00::12 as client1 (p2, c1, k60).')
+
+    assert event.session.ip_address == 'fd00::12'
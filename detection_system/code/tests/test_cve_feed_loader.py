@@ -0,0 +1,179 @@
+"""Tests of the streaming parser and the version index of the CVE feed loader.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import gzip
+import json
+import random
+
+import pytest
+
+import cve_feed_loader
+from cve_feed_loader import UNBOUNDED_END, CveFeedLoader, VersionIntervalIndex, parse_version
+from neo4j_database_access import Neo4jDatabaseAccess
+
+
+def legacy_item(cve_code: str, cpe_match: dict) -> dict:
+    """Returns an item of a 1.1 feed.
+    """
+    return {'cve': {'CVE_data_meta': {'ID': cve_code},
+                    'description': {'description_data': [{'lang': 'en', 'value': 'Broken ' + cve_code}]}},
+            'configurations': {'nodes': [{'operator': 'OR', 'children': [{'cpe_match': [cpe_match]}]}]}}
+
+
+def current_item(cve_code: str, cpe_match: dict) -> dict:
+    """Returns an item of a 2.0 feed.
+    """
+    return {'cve': {'id': cve_code, 'descriptions': [{'lang': 'en', 'value': 'Broken ' + cve_code}],
+                    'configurations': [{'nodes': [{'cpeMatch': [cpe_match]}]}]}}
+
+
+MOSQUITTO_RANGE = {'vulnerable': True, 'versionStartIncluding': '1.6', 'versionEndExcluding': '2.0.10',
+                   'cpe23Uri': 'cpe:2.3:a:eclipse:mosquitto:*:*:*:*:*:*:*:*',
+                   'criteria': 'cpe:2.3:a:eclipse:mosquitto:*:*:*:*:*:*:*:*'}
+NEO4J_VERSION = {'vulnerable': True, 'cpe23Uri': 'cpe:2.3:a:neo4j:neo4j:4.3.6:*:*:*:*:*:*:*',
+                 'criteria': 'cpe:2.3:a:neo4j:neo4j:4.3.6:*:*:*:*:*:*:*'}
+
+
+@pytest.fixture(name='small_chunks')
+def fixture_small_chunks(monkeypatch):
+    # Items and the array key are split over many reads
+    monkeypatch.setattr(cve_feed_loader, 'READ_CHUNK_SIZE', 7)
+
+
+def write_feed(path, feed: dict) -> str:
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as feed_file:
+        json.dump(feed, feed_file, indent=1)
+    return str(path)
+
+
+@pytest.mark.parametrize('file_name, array_key, item', [('feed.json', 'CVE_Items', legacy_item),
+                                                        ('feed.json.gz', 'vulnerabilities', current_item)])
+def test_items_are_streamed_from_small_chunks(tmp_path, small_chunks, file_name, array_key, item):
+    items = [item('CVE-2021-' + str(number), MOSQUITTO_RANGE) for number in range(20)]
+    feed = {'format': 'NVD_CVE', 'version': '1', 'timestamp': '2022-03-01', array_key: items}
+
+    assert list(CveFeedLoader.stream_feed_items(write_feed(tmp_path / file_name, feed))) == items
+
+
+def test_a_feed_without_items_yields_nothing(tmp_path, small_chunks):
+    assert list(CveFeedLoader.stream_feed_items(write_feed(tmp_path / 'empty.json', {'CVE_Items': []}))) == []
+    assert list(CveFeedLoader.stream_feed_items(write_feed(tmp_path / 'other.json', {'items': [1]}))) == []
+
+
+def test_a_truncated_feed_raises(tmp_path, small_chunks):
+    path = write_feed(tmp_path / 'feed.json', {'CVE_Items': [legacy_item('CVE-2021-1', MOSQUITTO_RANGE)] * 3})
+    with open(path, 'r', encoding='utf-8') as feed_file:
+        content = feed_file.read()
+    with open(path, 'w', encoding='utf-8') as feed_file:
+        feed_file.write(content[:len(content) // 2])
+
+    with pytest.raises(ValueError):
+        list(CveFeedLoader.stream_feed_items(path))
+
+
+@pytest.mark.parametrize('item', [legacy_item, current_item])
+def test_both_feed_versions_are_parsed_alike(item):
+    vulnerability, ranges = CveFeedLoader.parse_item(item('CVE-2021-34434', MOSQUITTO_RANGE))
+
+    assert ranges == [('mosquitto', (1, 6), True, (2, 0, 10), False)]
+    assert (vulnerability['cve_code'], vulnerability['description'], vulnerability['effected_app'],
+            vulnerability['effected_app_version']) == ('CVE-2021-34434', 'Broken CVE-2021-34434', 'mosquitto',
+                                                       '>=1.6 <2.0.10')
+
+
+def test_a_single_version_is_a_closed_range():
+    assert CveFeedLoader.parse_item(legacy_item('CVE-2021-1', NEO4J_VERSION))[1] == [
+        ('neo4j', (4, 3, 6), True, (4, 3, 6), True)]
+
+
+def test_versions_compare_in_version_order():
+    assert parse_version('2.4.0') == parse_version('2.4') == (2, 4)
+    assert parse_version('4.3.6-enterprise') == (4, 3, 6)
+    assert parse_version('1.10') > parse_version('1.9')
+
+
+def test_the_index_finds_the_ranges_like_a_scan():
+    generator = random.Random(0)
+    index = VersionIntervalIndex()
+    intervals = []
+    for number in range(200):
+        start = tuple(generator.randint(0, 5) for _ in range(generator.randint(0, 3)))
+        end = UNBOUNDED_END if generator.random() < 0.1 else tuple(
+            generator.randint(0, 5) for _ in range(generator.randint(1, 3)))
+        interval = (start, generator.random() < 0.5, end, generator.random() < 0.5, 'CVE-' + str(number))
+        index.add('mosquitto', *interval)
+        intervals.append(interval)
+
+    for _ in range(500):
+        version = tuple(generator.randint(0, 5) for _ in range(generator.randint(1, 3)))
+        expected = {cve_code for start, start_inclusive, end, end_inclusive, cve_code in intervals
+                    if (start < version or start_inclusive and start == version)
+                    and (version < end or end_inclusive and end == version)}
+        assert index.lookup('mosquitto', version) == expected
+    assert index.lookup('neo4j', (4,)) == set()
+
+
+class RecordingDriver(Neo4jDatabaseAccess):
+    """Answers the queries of the loader from lists, records its writes and applies
+    them to the edges.
+    """
+
+    def __init__(self, services: list, vulnerabilities: list, edges: list):  # pylint: disable=super-init-not-called
+        self.services = services
+        self.vulnerabilities = vulnerabilities
+        self.edges = edges
+        self.writes = []
+
+    def execute_and_return_query_result(self, query: str, parameters=None):
+        if query.startswith('MATCH (v:Vulnerability)'):
+            return self.vulnerabilities
+        if query.startswith('MATCH (s:Service) RETURN'):
+            return self.services
+        return [{'name': name, 'cve_code': cve_code, 'source': 'nvd'} for name, cve_code in self.edges]
+
+    def merge_nodes(self, node_name, key_names, rows, create_rows=None):
+        self.writes.append(('merge_nodes', [row['cve_code'] for row in rows]))
+
+    def merge_edges(self, edge_name, node1, node2, rows):
+        edges = [(row['node1']['name'], row['node2']['cve_code']) for row in rows]
+        self.writes.append(('merge_edges', edges))
+        self.edges.extend(edges)
+
+    def delete_edges(self, edge_name, node1, node2, rows):
+        edges = [(row['node1']['name'], row['node2']['cve_code']) for row in rows]
+        self.writes.append(('delete_edges', edges))
+        self.edges = [edge for edge in self.edges if edge not in edges]
+
+
+def test_only_changes_are_written(tmp_path):
+    feed = write_feed(tmp_path / 'feed.json', {'CVE_Items': [legacy_item('CVE-2021-1', MOSQUITTO_RANGE),
+                                                             legacy_item('CVE-2021-2', NEO4J_VERSION),
+                                                             legacy_item('CVE-2021-3', NEO4J_VERSION)]})
+    unchanged = CveFeedLoader.parse_item(legacy_item('CVE-2021-1', MOSQUITTO_RANGE))[0]
+    driver = RecordingDriver(
+        [{'name': 'Mosquitto', 'version': '1.6.9'}, {'name': 'Neo4j', 'version': '4.4.0'}],
+        [{'cve_code': 'CVE-2021-1', 'feed_hash': unchanged['feed_hash'], 'topology_managed': None},
+         {'cve_code': 'CVE-2021-3', 'feed_hash': 'old', 'topology_managed': 'True'}],
+        [('Neo4j', 'CVE-2021-2')])
+
+    summary = CveFeedLoader(driver).load_feeds([feed])
+
+    assert driver.writes == [('merge_nodes', ['CVE-2021-2']), ('delete_edges', [('Neo4j', 'CVE-2021-2')]),
+                             ('merge_edges', [('Mosquitto', 'CVE-2021-1')])]
+    assert (summary['vulnerabilities'], summary['created_edges'], summary['deleted_edges']) == (1, 1, 1)
+
+
+def test_a_second_feed_keeps_the_edges_of_the_first(tmp_path):
+    first = write_feed(tmp_path / 'nvdcve-1.1-2021.json', {'CVE_Items': [legacy_item('CVE-2021-1', MOSQUITTO_RANGE)]})
+    second = write_feed(tmp_path / 'nvdcve-1.1-2022.json', {'CVE_Items': [legacy_item('CVE-2022-1', NEO4J_VERSION)]})
+    driver = RecordingDriver([{'name': 'Mosquitto', 'version': '1.6.9'}, {'name': 'Neo4j', 'version': '4.3.6'}],
+                             [], [])
+
+    CveFeedLoader(driver).load_feeds([first])
+    summary = CveFeedLoader(driver).load_feeds([second])
+
+    assert summary['deleted_edges'] == 0
+    assert sorted(driver.edges) == [('Mosquitto', 'CVE-2021-1'), ('Neo4j', 'CVE-2022-1')]
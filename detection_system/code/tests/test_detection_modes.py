@@ -0,0 +1,68 @@
+"""Tests of the vectorized and the sharded detection against the rule engine.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import pytest
+
+from connection_sessionizer import ConnectionSessionizer
+from detection_helpers import RULES, connect, findings, graph_rows
+from log_generator import MosquittoLogGenerator
+from rule_engine import RuleEngine
+
+
+@pytest.mark.parametrize('scenario', ['slow_dos', 'distributed_dos'])
+def test_count_and_subnet_rules_match_the_rule_engine(create_detection, scenario):
+    sessionizer = ConnectionSessionizer()
+    rule_engine, detection = RuleEngine(RULES[:2]), create_detection(RULES[:2])
+    rule_engine.observe(sessionizer)
+    detection.observe(sessionizer)
+    for line in MosquittoLogGenerator(seed=0).lines(scenario, 20000):
+        sessionizer.process_line(line)
+    rows = graph_rows(sessionizer)
+
+    expected = findings(rule_engine, rows)
+    assert {name for name, _, _ in expected} == {'too_many_connections', 'crowded_network'}
+    assert findings(detection, rows) == expected
+
+
+def test_counts_of_the_graph_are_used_after_a_restart(create_detection):
+    rows = [{'h': {'ip_address': '10.244.0.' + str(host)}, 'count': 30} for host in range(10, 20)]
+    rows += [{'h': {'ip_address': '10.244.1.10'}, 'count': 51}, {'h': {'ip_address': '10.244.1.11'}, 'count': 3}]
+
+    assert findings(create_detection(RULES[:2]), rows) == findings(RuleEngine(RULES[:2]), rows) == {
+        ('too_many_connections', '10.244.1.10', 51), ('crowded_network', '10.244.0.0/24', 300)}
+
+
+def test_hosts_which_are_not_in_the_rows_are_not_counted(create_detection):
+    # Blocked and notified hosts are left out by count_active_connections_per_host
+    sessionizer = ConnectionSessionizer()
+    detection = create_detection(RULES[:1])
+    detection.observe(sessionizer)
+    for number in range(50):
+        connect(sessionizer, 1635015162, '10.244.0.12', 'client' + str(number))
+
+    assert findings(detection, []) == set()
+    assert findings(detection, None) == {('too_many_connections', '10.244.0.12', 50)}
+
+
+def test_connection_flood_is_found_like_by_the_rule_engine(create_detection):
+    sessionizer = ConnectionSessionizer()
+    rule_engine, detection = RuleEngine(RULES[2:]), create_detection(RULES[2:])
+    rule_engine.observe(sessionizer)
+    detection.observe(sessionizer)
+    for number in range(20):
+        connect(sessionizer, 1635015162 + number, '10.244.0.12', 'client' + str(number))
+    connect(sessionizer, 1635015181, '10.244.0.13', 'other')
+
+    assert findings(detection, []) == findings(rule_engine, []) == {('connection_flood', '10.244.0.12', 20)}
+
+
+def test_a_finding_is_reported_once_until_it_clears(create_detection):
+    detection = create_detection(RULES[:1])
+    rows = [{'h': {'ip_address': '10.244.0.12'}, 'count': 60}]
+
+    assert len(detection.evaluate(rows)) == 1
+    assert detection.evaluate(rows) == []
+    assert detection.evaluate([]) == []
+    assert len(detection.evaluate(rows)) == 1
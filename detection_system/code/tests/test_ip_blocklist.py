@@ -0,0 +1,131 @@
+"""Tests of the radix tree and the blocklist of the detection system.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import ipaddress
+import json
+import random
+
+from in_memory_database_access import InMemoryDatabaseAccess
+from ip_blocklist import IpBlocklist, RadixTree
+from network_monitoring import NetworkMonitoring
+from rule_engine import Rule, RuleEngine
+
+
+def shortest_prefix(prefixes: set, address: int):
+    """Returns the shortest prefix containing the address by checking every prefix.
+    """
+    matching = [(length, network) for network, length in prefixes
+                if ipaddress.IPv4Address(address) in ipaddress.IPv4Network((network, length))]
+    return (min(matching)[1], min(matching)[0]) if matching else None
+
+
+def random_address(generator: random.Random) -> int:
+    """Returns an address with few distinct bits, so the prefixes nest and share paths.
+    """
+    return generator.choice((10, 172, 192)) << 24 | generator.getrandbits(24) & 0x0f0f0f
+
+
+def test_the_tree_matches_like_a_scan_of_all_prefixes():
+    generator = random.Random(0)
+    tree = RadixTree(32)
+    prefixes = set()
+    for _ in range(300):
+        length = generator.choice((8, 12, 16, 20, 24, 28, 32))
+        network = random_address(generator) >> (32 - length) << (32 - length)
+        tree.insert(network, length)
+        prefixes.add((network, length))
+    for network, length in generator.sample(sorted(prefixes), 150):
+        assert tree.remove(network, length)
+        prefixes.discard((network, length))
+
+    assert len(tree) == len(prefixes)
+    assert tree.prefixes() == sorted(prefixes)
+    for _ in range(2000):
+        address = random_address(generator)
+        assert tree.match(address) == shortest_prefix(prefixes, address)
+
+
+def test_removing_a_missing_prefix_keeps_the_tree():
+    tree = RadixTree(32)
+    tree.insert(0x0af40000, 16)
+    tree.insert(0x0af40100, 24)
+
+    assert not tree.remove(0x0af40000, 24)
+    assert not tree.remove(0x0a000000, 8)
+    assert tree.remove(0x0af40000, 16)
+    assert tree.match(0x0af40105) == (0x0af40100, 24)
+    assert tree.match(0x0af40205) is None
+
+
+def test_hosts_and_networks_are_blocked():
+    blocklist = IpBlocklist(['10.244.1.0/24', 'fd00::/64'])
+    blocklist.block('10.244.0.12')
+
+    assert blocklist.is_blocked('10.244.0.12')
+    assert blocklist.is_blocked('10.244.1.200')
+    assert blocklist.is_blocked('fd00::12')
+    assert not blocklist.is_blocked('10.244.0.13')
+    assert not blocklist.is_blocked('fd00:0:0:1::12')
+    assert blocklist.entries() == ['10.244.0.12', '10.244.1.0/24', 'fd00::/64']
+
+
+def test_a_host_of_a_blocked_network_stays_blocked():
+    blocklist = IpBlocklist(['10.244.1.0/24'])
+    blocklist.block('10.244.1.12')
+    blocklist.unblock('10.244.1.12')
+
+    assert blocklist.is_blocked('10.244.1.12')
+    assert len(blocklist) == 1
+
+
+def test_other_strings_are_matched_exactly():
+    blocklist = IpBlocklist([])
+    blocklist.block('broker-host')
+
+    assert blocklist.is_blocked('broker-host')
+    assert not blocklist.is_blocked('broker')
+
+
+class ActiveConnectionsStorage(InMemoryDatabaseAccess):
+    """Returns fixed active connections to the detection.
+    """
+
+    def __init__(self, rows: list):
+        super().__init__()
+        self.rows = rows
+
+    def count_active_connections_per_host(self):
+        return self.rows
+
+
+class DiscardNotification:
+    """Stands in for the AlarmNotification so the detection pass sends no emails.
+    """
+
+    def connect_to_smtp_server(self):
+        pass
+
+    def send_email(self, message):
+        pass
+
+    def stop_smtp(self):
+        pass
+
+
+def test_the_hosts_of_the_graph_and_of_the_detection_are_blocked():
+    storage = ActiveConnectionsStorage([{'h': {'ip_address': '10.244.0.13'}, 'count': 51}])
+    for ip_address, is_blocked in (('10.244.0.12', 'True'), ('10.244.0.13', 'False')):
+        storage.create_host(json.dumps({'ip_address': ip_address, 'is_blocked': is_blocked,
+                                        'notification_sent': 'False', 'creation_time': '1635015162'}))
+    blocklist = IpBlocklist([])
+    blocklist.load(storage)
+    network_monitoring = NetworkMonitoring('', '', '', neo4j_driver=storage, email_notification=DiscardNotification(),
+                                           rule_engine=RuleEngine([Rule('host', 'count_threshold', 50, block=True)]))
+    network_monitoring.add_block_listener(blocklist.block)
+
+    assert blocklist.entries() == ['10.244.0.12']
+    assert network_monitoring.run_detection_pass() == ['10.244.0.13']
+    assert blocklist.entries() == ['10.244.0.12', '10.244.0.13']
+    assert storage.get_blocked_hosts() == ['10.244.0.12', '10.244.0.13']
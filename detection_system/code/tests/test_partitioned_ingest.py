@@ -0,0 +1,78 @@
+"""Tests of the routing of the partitioned ingest.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import functools
+
+import pytest
+
+from log_generator import MosquittoLogGenerator
+from mosquitto_log_transformation import MosquittoLogTransformation
+from partitioned_ingest import PartitionedIngest
+from sqlite_database_access import SqliteDatabaseAccess
+
+SERVICE = '{"name": "Mosquitto", "port": "1883", "version": "1.6.9", "protocol": "MQTT"}'
+
+
+@pytest.fixture(name='ingest')
+def fixture_ingest(tmp_path):
+    path = str(tmp_path / 'ids.db')
+    SqliteDatabaseAccess(path).close()
+    ingest = PartitionedIngest(3, functools.partial(SqliteDatabaseAccess, path), use_processes=False)
+    yield ingest
+    ingest.stop()
+
+
+def addresses_of_other_workers(ingest: PartitionedIngest) -> tuple:
+    """Returns two addresses which are owned by different workers.
+    """
+    first = '10.244.0.10'
+    second = next(ip_address for ip_address in ('10.244.0.' + str(host) for host in range(11, 255))
+                  if ingest.route(f'1: New connection from {ip_address} on port 1883.')
+                  != ingest.route(f'1: New connection from {first} on port 1883.'))
+    return first, second
+
+
+def test_all_lines_of_a_client_go_to_its_worker(ingest):
+    lines = ['1635015160: New connection from 10.244.0.12 on port 1883.',
+             '1635015160: New client connected from 10.244.0.12 as client1 (p2, c1, k60).',
+             '1635015170: Client client1 has exceeded timeout, disconnecting.']
+
+    assert len({ingest.route(line) for line in lines}) == 1
+    assert ingest.route('1635015170: Client client1 disconnected.') == 0
+    assert ingest.route('1635015170: mosquitto version 1.6.9 running') == 0
+
+
+def test_the_old_worker_closes_a_taken_over_session(ingest):
+    first, second = addresses_of_other_workers(ingest)
+    old_worker = ingest.route(f'1635015160: New client connected from {first} as client1 (p2, c1, k60).')
+    new_worker = ingest.route(f'1635015170: New client connected from {second} as client1 (p2, c1, k60).')
+
+    assert ingest.batches[old_worker] == [
+        '1635015170: Client client1 already connected, closing old connection.']
+    assert ingest.batches[new_worker] == []
+
+
+def test_the_partitioned_graph_equals_the_graph_of_one_transformation(tmp_path):
+    lines = list(MosquittoLogGenerator(seed=2).lines('mixed', 4000))
+    states = []
+    for name in ('single', 'partitioned'):
+        path = str(tmp_path / (name + '.db'))
+        storage = SqliteDatabaseAccess(path)
+        storage.create_service(SERVICE)
+        storage.commit()
+        if name == 'single':
+            line_processor = MosquittoLogTransformation(storage)
+        else:
+            line_processor = PartitionedIngest(3, functools.partial(SqliteDatabaseAccess, path), use_processes=False)
+        for line in lines:
+            line_processor.process_line(line)
+        if name == 'partitioned':
+            line_processor.stop()
+        states.append((sorted((row['h']['ip_address'], row['count'])
+                              for row in storage.count_active_connections_per_host()),
+                       sorted(storage.connection.execute('SELECT name, status FROM connections').fetchall())))
+        storage.close()
+
+    assert states[0][0] and states[0] == states[1]
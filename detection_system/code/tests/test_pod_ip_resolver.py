@@ -0,0 +1,65 @@
+"""Tests of the pod index of the pod ip resolver.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from pod_ip_resolver import PodIpResolver
+
+
+def pod(name: str, ip_address: str, minute: int, phase: str = 'Running', deleting: bool = False):
+    """Returns a pod of the broker app with the fields the resolver reads.
+    """
+    created = datetime.datetime(2022, 3, 1, 12, minute, tzinfo=datetime.timezone.utc)
+    metadata = SimpleNamespace(namespace='default', name=name, labels={'app': 'broker'}, creation_timestamp=created,
+                               deletion_timestamp=created if deleting else None)
+    return SimpleNamespace(metadata=metadata, status=SimpleNamespace(pod_ip=ip_address, phase=phase))
+
+
+def apply_event(resolver: PodIpResolver, event_type: str, watched_pod):
+    """Applies an event of the watch to the index.
+    """
+    resolver._apply_event(event_type, watched_pod)  # pylint: disable=protected-access
+
+
+@pytest.fixture(name='changes')
+def fixture_changes():
+    return []
+
+
+@pytest.fixture(name='resolver')
+def fixture_resolver(changes):
+    resolver = PodIpResolver(on_change=lambda *change: changes.append(change))
+    # The index is filled by the events of the test instead of a list of the cluster
+    resolver._ready.set()  # pylint: disable=protected-access
+    return resolver
+
+
+def test_events_of_an_old_pod_do_not_switch_the_ip_address_back(resolver, changes):
+    apply_event(resolver, 'ADDED', pod('broker-old', '10.244.0.10', 0))
+    apply_event(resolver, 'ADDED', pod('broker-new', '10.244.0.11', 5, 'Pending'))
+    assert resolver.get_ip_address('broker') == '10.244.0.10'
+
+    apply_event(resolver, 'MODIFIED', pod('broker-new', '10.244.0.11', 5))
+    apply_event(resolver, 'MODIFIED', pod('broker-old', '10.244.0.10', 0))
+
+    assert resolver.get_ip_address('broker') == '10.244.0.11'
+    assert changes == [('broker', None, '10.244.0.10'), ('broker', '10.244.0.10', '10.244.0.11')]
+
+
+def test_a_deleted_pod_falls_back_to_the_newest_running_one(resolver):
+    for name, ip_address, minute in (('broker-a', '10.244.0.10', 0), ('broker-c', '10.244.0.12', 9),
+                                     ('broker-b', '10.244.0.11', 5)):
+        apply_event(resolver, 'ADDED', pod(name, ip_address, minute))
+
+    apply_event(resolver, 'MODIFIED', pod('broker-c', '10.244.0.12', 9, deleting=True))
+    assert resolver.get_ip_address('broker') == '10.244.0.11'
+    apply_event(resolver, 'DELETED', pod('broker-b', '10.244.0.11', 5))
+    apply_event(resolver, 'DELETED', pod('broker-a', '10.244.0.10', 0))
+    with pytest.raises(ValueError):
+        resolver.get_ip_address('broker')
+    assert not resolver.pods_by_app
@@ -0,0 +1,90 @@
+"""Tests of the rules of the rule engine.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import pytest
+
+from connection_sessionizer import ConnectionSessionizer
+from detection_helpers import connect, findings
+from rule_engine import Rule, RuleEngine, create_rule_engine
+
+
+def test_the_default_rules_are_read():
+    assert [rule.rule_type for rule in RuleEngine.from_file().rules] == [
+        'count_threshold', 'subnet', 'connection_rate', 'idle_hold']
+    assert isinstance(create_rule_engine('rules'), RuleEngine)
+
+
+@pytest.mark.parametrize('rule', [{'name': 'a', 'type': 'unknown', 'threshold': 1},
+                                  {'name': 'a', 'type': 'subnet', 'threshold': 1},
+                                  {'name': 'a', 'type': 'subnet', 'threshold': 1, 'prefix_length': 24,
+                                   'block': True}])
+def test_invalid_rules_are_rejected(rule):
+    with pytest.raises(ValueError):
+        Rule.from_dict(rule)
+
+
+def test_rule_names_have_to_be_unique():
+    with pytest.raises(ValueError):
+        RuleEngine([Rule('a', 'count_threshold', 1), Rule('a', 'count_threshold', 2)])
+
+
+def test_count_and_subnet_rules_count_the_rows():
+    rule_engine = RuleEngine([Rule('host', 'count_threshold', 50), Rule('network', 'subnet', 100, prefix_length=24)])
+    rows = [{'h': {'ip_address': '10.244.0.' + str(host)}, 'count': 20} for host in range(10, 16)]
+    rows.append({'h': {'ip_address': '10.244.1.10'}, 'count': 51})
+
+    assert findings(rule_engine, rows) == {('host', '10.244.1.10', 51), ('network', '10.244.0.0/24', 120)}
+
+
+def test_subnet_rules_of_several_prefixes_share_the_addresses():
+    rule_engine = RuleEngine([Rule('small', 'subnet', 100, prefix_length=28),
+                              Rule('large', 'subnet', 160, prefix_length=16),
+                              Rule('medium', 'subnet', 100, prefix_length=24)])
+    rows = [{'h': {'ip_address': '10.244.0.' + str(host)}, 'count': 20} for host in range(10, 16)]
+    rows += [{'h': {'ip_address': '10.244.1.10'}, 'count': 51}, {'h': {'ip_address': None}, 'count': 99}]
+    expected = {('small', '10.244.0.0/28', 120), ('large', '10.244.0.0/16', 171), ('medium', '10.244.0.0/24', 120)}
+
+    assert findings(rule_engine, rows) == expected
+    assert rule_engine.addresses['10.244.1.10'] == 0x0af4010a and rule_engine.addresses[None] is None
+    rule_engine.reported = set()
+    assert findings(rule_engine, rows) == expected
+
+
+def test_a_finding_is_reported_again_after_it_cleared():
+    rule_engine = RuleEngine([Rule('host', 'count_threshold', 50)])
+    rows = [{'h': {'ip_address': '10.244.1.10'}, 'count': 51}]
+
+    assert len(rule_engine.evaluate(rows)) == 1
+    assert rule_engine.evaluate(rows) == []
+    assert rule_engine.evaluate([]) == []
+    assert len(rule_engine.evaluate(rows)) == 1
+
+
+def test_connection_rate_only_counts_the_window():
+    sessionizer = ConnectionSessionizer()
+    rule_engine = RuleEngine([Rule('flood', 'connection_rate', 5, window_seconds=60)])
+    rule_engine.observe(sessionizer)
+    for number in range(10):
+        connect(sessionizer, 1635015000 + number, '10.244.0.12', 'client' + str(number))
+
+    assert findings(rule_engine, []) == {('flood', '10.244.0.12', 10)}
+    connect(sessionizer, 1635015100, '10.244.0.13', 'other')
+    assert findings(rule_engine, []) == set()
+
+
+def test_idle_hold_counts_the_sessions_open_longer_than_min_seconds():
+    sessionizer = ConnectionSessionizer()
+    rule_engine = RuleEngine([Rule('idle', 'idle_hold', 2, min_seconds=600)])
+    rule_engine.observe(sessionizer)
+    for number in range(3):
+        connect(sessionizer, 1635015000, '10.244.0.12', 'held' + str(number))
+    connect(sessionizer, 1635015000, '10.244.0.13', 'other')
+
+    connect(sessionizer, 1635015100, '10.244.0.14', 'early')
+    assert findings(rule_engine, []) == set()
+    connect(sessionizer, 1635015700, '10.244.0.14', 'late')
+    assert findings(rule_engine, []) == {('idle', '10.244.0.12', 3)}
+    sessionizer.process_line('1635015701: Client held0 disconnected.')
+    assert findings(rule_engine, []) == set()
@@ -0,0 +1,151 @@
+"""Tests of the replay, the checkpoint and the dead letters of the spool.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import os
+import sqlite3
+
+import pytest
+from neo4j.exceptions import ServiceUnavailable
+
+import write_ahead_spool
+from in_memory_database_access import InMemoryDatabaseAccess
+from write_ahead_spool import CHECKPOINT_FILE, DEAD_LETTER_FILE, SpooledGraphStorage, is_transient
+
+
+def host(ip_address: str, is_blocked: str = 'False') -> str:
+    return json.dumps({'ip_address': ip_address, 'creation_time': '1635015162', 'is_blocked': is_blocked,
+                       'notification_sent': 'False'})
+
+
+def exists(storage, ip_address: str) -> bool:
+    return storage.check_if_node_exists('Host', 'ip_address', ip_address)
+
+
+def dead_letters(spool_directory) -> list:
+    path = os.path.join(spool_directory, DEAD_LETTER_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as dead_letter_file:
+        return [json.loads(line) for line in dead_letter_file]
+
+
+class FailingStorage(InMemoryDatabaseAccess):
+    """Raises an error for the first writes.
+    """
+
+    def __init__(self, error: Exception, failures: int):
+        super().__init__()
+        self.error = error
+        self.failures = failures
+
+    def write_batch(self, mutations):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        super().write_batch(mutations)
+
+    def update_service_port(self, service_name: str, port: str):
+        raise ValueError('The port ' + port + ' is no number')
+
+
+@pytest.fixture(autouse=True)
+def fixture_fast_retry(monkeypatch):
+    monkeypatch.setattr(write_ahead_spool, 'RETRY_SECONDS', 0.01)
+
+
+def test_the_mutations_are_replayed_before_stop_returns(tmp_path):
+    storage = InMemoryDatabaseAccess()
+    spool = SpooledGraphStorage(storage, str(tmp_path), batch_size=2)
+    for number in range(5):
+        spool.create_host(host('10.244.0.' + str(number)))
+    spool.start()
+    spool.stop(5)
+
+    assert all(exists(storage, '10.244.0.' + str(number)) for number in range(5))
+    assert spool.pending_bytes() == 0
+    with open(tmp_path / CHECKPOINT_FILE, 'r', encoding='utf-8') as checkpoint_file:
+        assert tuple(json.load(checkpoint_file).values()) == spool.checkpoint
+
+
+def test_a_restarted_spool_continues_after_the_checkpoint(tmp_path):
+    spool = SpooledGraphStorage(InMemoryDatabaseAccess(), str(tmp_path))
+    spool.create_host(host('10.244.0.1'))
+    spool.start()
+    spool.stop(5)
+    spool.create_host(host('10.244.0.2'))
+    spool.close()
+
+    storage = InMemoryDatabaseAccess()
+    restarted = SpooledGraphStorage(storage, str(tmp_path))
+    restarted.start()
+    restarted.stop(5)
+
+    assert not exists(storage, '10.244.0.1')
+    assert exists(storage, '10.244.0.2')
+
+
+def test_replayed_segments_are_deleted(tmp_path):
+    storage = InMemoryDatabaseAccess()
+    spool = SpooledGraphStorage(storage, str(tmp_path), segment_bytes=200)
+    for number in range(10):
+        spool.create_host(host('10.244.0.' + str(number)))
+    assert len(spool._segments()) > 2  # pylint: disable=protected-access
+    spool.start()
+    spool.stop(5)
+
+    assert len(spool._segments()) == 1  # pylint: disable=protected-access
+    assert all(exists(storage, '10.244.0.' + str(number)) for number in range(10))
+
+
+def test_transient_errors_are_retried(tmp_path):
+    storage = FailingStorage(ServiceUnavailable('neo4j restarts'), 3)
+    spool = SpooledGraphStorage(storage, str(tmp_path))
+    spool.create_host(host('10.244.0.1'))
+    spool.start()
+    spool.stop(5)
+
+    assert exists(storage, '10.244.0.1') and storage.failures == 0
+    assert dead_letters(tmp_path) == []
+
+
+def test_other_errors_are_dead_lettered_and_the_replay_continues(tmp_path):
+    storage = FailingStorage(ValueError('rejected'), 1)
+    spool = SpooledGraphStorage(storage, str(tmp_path))
+    spool.create_host(host('10.244.0.1'))
+    spool.update_service_port('Mosquitto', 'x')
+    spool._append('drop_everything')  # pylint: disable=protected-access
+    # A damaged line, e.g. of a disk which was full
+    segment_path = spool._segment_path(spool._segment_number)  # pylint: disable=protected-access
+    with open(segment_path, 'a', encoding='utf-8') as segment_file:
+        segment_file.write('["upsert_host",\n')
+    spool.create_host(host('10.244.0.2'))
+    spool.start()
+    spool.stop(5)
+
+    assert exists(storage, '10.244.0.1') and exists(storage, '10.244.0.2')
+    assert sorted(letter['line'] for letter in dead_letters(tmp_path)) == [
+        '["drop_everything"]', '["update_service_port","Mosquitto","x"]', '["upsert_host",']
+    assert spool.pending_bytes() == 0
+
+
+def test_blocked_hosts_are_answered_by_the_spool(tmp_path):
+    storage = InMemoryDatabaseAccess()
+    storage.create_host(host('10.244.0.1', 'True'))
+    spool = SpooledGraphStorage(storage, str(tmp_path))
+    spool.update_and_return_host_block('10.244.0.2', 'True')
+
+    assert spool.check_if_host_is_blocked('10.244.0.1') and spool.check_if_host_is_blocked('10.244.0.2')
+    assert not spool.check_if_host_is_blocked('10.244.0.3')
+
+
+@pytest.mark.parametrize('exception, transient', [(ServiceUnavailable('down'), True),
+                                                  (OSError('disk'), True),
+                                                  (sqlite3.OperationalError('database is locked'), True),
+                                                  (sqlite3.OperationalError('no such table: hosts'), False),
+                                                  (ValueError('rejected'), False),
+                                                  (TypeError('wrong arguments'), False)])
+def test_only_the_availability_of_the_storage_is_transient(exception, transient):
+    assert is_transient(exception) == transient
@@ -0,0 +1,326 @@
+"""This module keeps the static topology of the monitored system in sync with the
+    graph database. The topology (hosts, services, vulnerabilities, attacks, preconditions
+    and their relations) is described in a json or yaml file and compared with the nodes
+    and edges which were created by a previous sync. Only the difference is written to the
+    database in batched transactions, everything else in the graph stays untouched.
+
+    The sync only owns the nodes and edges it created. A node which already exists,
+    e.g. a host the log transformation created, gets the properties of the file but
+    stays owned by the ingest and is never deleted by the sync. A node of the sync which
+    the ingest connected to meanwhile is not deleted either, it is handed over to the
+    ingest. Values the running system updates, like the block status of a host or the
+    version of a service read from the log, belong in create_properties of the file,
+    which are only set when the node is created.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import time
+from typing import Callable, Dict, List, Tuple
+
+from beartype import beartype
+
+from metrics_endpoint import METRICS
+from neo4j_database_access import Neo4jDatabaseAccess
+
+IP_LOOKUPS = METRICS.counter('ids_topology_ip_lookups_total', 'Pod ip addresses of a sync by cache result', 'result')
+
+# Properties which identify a node of a given label.
+NODE_KEYS = {'Host': ['ip_address'],
+            'Service': ['name'],
+            'Connection': ['name'],
+            'Vulnerability': ['cve_code'],
+            'Attack': ['name'],
+            'Precondition': ['name']
+            }
+# Timestamps which are only set once when the node is created.
+CREATION_TIME_PROPERTIES = {'Host': 'creation_time',
+                            'Connection': 'last_update_time'
+                            }
+# Marks nodes and edges created by the sync so nodes created from the log are never deleted.
+MANAGED_PROPERTY = 'topology_managed'
+DEFAULT_BATCH_SIZE = 500
+
+
+class TopologySync:
+    """Reconciles a declarative topology file with the graph database.
+    """
+
+    @beartype
+    def __init__(self, neo4j_driver: Neo4jDatabaseAccess, ip_resolver: Callable[[str], str],
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        """Initializes the sync with a database connection.
+
+        Args:
+            neo4j_driver (Neo4jDatabaseAccess): connection to the graph database
+            ip_resolver (Callable[[str], str]): returns the ip address of a pod by its app label
+            batch_size (int): maximum number of nodes or edges written in one transaction
+        """
+        self.neo4j_driver = neo4j_driver
+        self.ip_resolver = ip_resolver
+        self.batch_size = batch_size
+        self._resolved_ips = {}
+
+    @staticmethod
+    @beartype
+    def load_topology_file(file_path: str) -> dict:
+        """Reads the topology description. Yaml files need the optional pyyaml package.
+
+        Args:
+            file_path (str): path to a .json, .yaml or .yml file
+
+        Returns:
+            dict: the topology with a list of nodes and a list of edges
+        """
+        with open(file_path, 'r', encoding='utf-8') as topology_file:
+            if file_path.endswith(('.yaml', '.yml')):
+                import yaml
+                return yaml.safe_load(topology_file)
+            return json.load(topology_file)
+
+    @beartype
+    def sync(self, file_path: str) -> dict:
+        """Brings the graph in line with the topology file.
+
+        Args:
+            file_path (str): path to the topology file
+
+        Returns:
+            dict: number of created, updated and deleted nodes and edges
+        """
+        self._resolved_ips = {}
+        desired_nodes, desired_edges = self.desired_state(self.load_topology_file(file_path))
+        current_nodes, current_edges = self.current_state()
+        diff = self.compute_diff(desired_nodes, desired_edges, current_nodes, current_edges)
+        self.apply_diff(diff, desired_nodes)
+
+        summary = {name: len(entries) for name, entries in diff.items()}
+        print(f'Topology sync finished: {summary}')
+        return summary
+
+    @beartype
+    def desired_state(self, topology: dict) -> Tuple[dict, dict]:
+        """Converts the topology description into nodes and edges indexed by their keys.
+
+        Args:
+            topology (dict): the content of the topology file
+
+        Returns:
+            Tuple[dict, dict]: nodes by (label, key values) and edges by
+            (edge name, label, key values, label, key values)
+        """
+        nodes = {}
+        for node in topology.get('nodes', []):
+            label = node['name']
+            properties = dict(node.get('properties', {}))
+            if 'app_selector' in node:
+                properties[NODE_KEYS[label][0]] = self._resolve_ip(node['app_selector'])
+            key = (label, tuple(properties[name] for name in NODE_KEYS[label]))
+            nodes[key] = {'properties': properties,
+                          'create_properties': node.get('create_properties', {})}
+
+        edges = {}
+        for edge in topology.get('edges', []):
+            node1 = self._resolve_reference(edge['node1'])
+            node2 = self._resolve_reference(edge['node2'])
+            edges[(edge['edge_name'],) + node1 + node2] = {}
+        return nodes, edges
+
+    def current_state(self) -> Tuple[dict, dict]:
+        """Reads all nodes and edges which were created by a previous sync.
+
+        Returns:
+            Tuple[dict, dict]: nodes and edges in the same format as desired_state
+        """
+        nodes = {}
+        edges = {}
+        for label, key_names in NODE_KEYS.items():
+            query = (
+                    'MATCH (n:' + label + ') '
+                    'WHERE n.' + MANAGED_PROPERTY + ' = "True" '
+                    'RETURN properties(n) AS properties'
+                    )
+            for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+                key = tuple(row['properties'].get(name) for name in key_names)
+                nodes[(label, key)] = {'properties': row['properties']}
+
+            # The start node of an edge of the sync may be owned by the ingest
+            query = (
+                    'MATCH (a:' + label + ')-[r]->(b) '
+                    'WHERE r.' + MANAGED_PROPERTY + ' = "True" '
+                    'RETURN type(r) AS edge_name, labels(b) AS labels, '
+                    'properties(a) AS node1, properties(b) AS node2'
+                    )
+            for row in self.neo4j_driver.execute_and_return_query_result(query) or []:
+                labels = [name for name in row['labels'] if name in NODE_KEYS]
+                if not labels:
+                    continue
+                key1 = tuple(row['node1'].get(name) for name in key_names)
+                key2 = tuple(row['node2'].get(name) for name in NODE_KEYS[labels[0]])
+                edges[(row['edge_name'], label, key1, labels[0], key2)] = {}
+        return nodes, edges
+
+    @staticmethod
+    @beartype
+    def compute_diff(desired_nodes: dict, desired_edges: dict,
+                     current_nodes: dict, current_edges: dict) -> Dict[str, list]:
+        """Compares the desired with the current state.
+
+        Args:
+            desired_nodes (dict): nodes from the topology file
+            desired_edges (dict): edges from the topology file
+            current_nodes (dict): nodes created by a previous sync
+            current_edges (dict): edges created by a previous sync
+
+        Returns:
+            Dict[str, list]: the keys of nodes and edges to create, update or delete
+        """
+        update_nodes = []
+        for key in desired_nodes.keys() & current_nodes.keys():
+            current = current_nodes[key]['properties']
+            for name, value in desired_nodes[key]['properties'].items():
+                if current.get(name) != value:
+                    update_nodes.append(key)
+                    break
+
+        return {'create_nodes': [key for key in desired_nodes if key not in current_nodes],
+                'update_nodes': update_nodes,
+                'delete_nodes': [key for key in current_nodes if key not in desired_nodes],
+                'create_edges': [key for key in desired_edges if key not in current_edges],
+                'delete_edges': [key for key in current_edges if key not in desired_edges]
+                }
+
+    @beartype
+    def apply_diff(self, diff: Dict[str, list], desired_nodes: dict):
+        """Writes the difference to the database. Edges are removed first so deleted nodes
+        do not need to detach them, new edges are created last once both nodes exist.
+
+        Args:
+            diff (Dict[str, list]): the output of compute_diff
+            desired_nodes (dict): nodes from the topology file with their properties
+        """
+        timestamp = str(int(time.time()))
+
+        for (edge_name, label1, label2), rows in self._group_edges(diff['delete_edges']).items():
+            for batch in self._batches(rows):
+                self.neo4j_driver.delete_edges(edge_name,
+                                               {'name': label1, 'property_names': NODE_KEYS[label1]},
+                                               {'name': label2, 'property_names': NODE_KEYS[label2]},
+                                               batch)
+
+        for label, rows in self._group_nodes(diff['delete_nodes']).items():
+            for batch in self._batches(rows):
+                self.neo4j_driver.delete_nodes(label, NODE_KEYS[label], batch, MANAGED_PROPERTY)
+
+        # The marker, the creation time and the create properties are not set on existing nodes
+        created = {}
+        for label, rows in self._group_nodes(diff['create_nodes']).items():
+            for row in rows:
+                key = (label, tuple(row[name] for name in NODE_KEYS[label]))
+                row.update(desired_nodes[key]['properties'])
+                create_row = dict(desired_nodes[key]['create_properties'])
+                create_row[MANAGED_PROPERTY] = 'True'
+                if label in CREATION_TIME_PROPERTIES:
+                    create_row[CREATION_TIME_PROPERTIES[label]] = timestamp
+                created.setdefault(label, []).append((row, create_row))
+        for label, rows in self._group_nodes(diff['update_nodes']).items():
+            for row in rows:
+                key = (label, tuple(row[name] for name in NODE_KEYS[label]))
+                row.update(desired_nodes[key]['properties'])
+                created.setdefault(label, []).append((row, {}))
+        for label, rows in created.items():
+            for batch in self._batches(rows):
+                self.neo4j_driver.merge_nodes(label, NODE_KEYS[label], [row for row, _ in batch],
+                                              [create_row for _, create_row in batch])
+
+        for (edge_name, label1, label2), rows in self._group_edges(diff['create_edges']).items():
+            for row in rows:
+                row['properties'] = {}
+                row['create_properties'] = {MANAGED_PROPERTY: 'True'}
+            for batch in self._batches(rows):
+                self.neo4j_driver.merge_edges(edge_name,
+                                              {'name': label1, 'property_names': NODE_KEYS[label1]},
+                                              {'name': label2, 'property_names': NODE_KEYS[label2]},
+                                              batch)
+
+    @beartype
+    def _resolve_ip(self, app_selector: str) -> str:
+        """Resolves the ip address of a pod only once per sync.
+
+        Args:
+            app_selector (str): the app label of the pod
+
+        Returns:
+            str: ip address of the pod
+        """
+        if app_selector not in self._resolved_ips:
+            IP_LOOKUPS.inc(1, 'miss')
+            self._resolved_ips[app_selector] = self.ip_resolver(app_selector)
+        else:
+            IP_LOOKUPS.inc(1, 'hit')
+        return self._resolved_ips[app_selector]
+
+    @beartype
+    def _resolve_reference(self, node: dict) -> Tuple[str, tuple]:
+        """Converts a node description of an edge to the key of the node.
+
+        Args:
+            node (dict): node description in the format used by create_edge or with
+            an app_selector for hosts
+
+        Returns:
+            Tuple[str, tuple]: label and key values of the node
+        """
+        label = node['name']
+        if 'app_selector' in node:
+            return (label, (self._resolve_ip(node['app_selector']),))
+        if node['property_names'] != NODE_KEYS[label]:
+            raise ValueError('Edges have to reference ' + label + ' nodes by '
+                             + ', '.join(NODE_KEYS[label]))
+        return (label, tuple(node['property_values']))
+
+    @staticmethod
+    def _group_nodes(keys: List[tuple]) -> Dict[str, List[dict]]:
+        """Groups node keys by label and converts them to rows with the key properties.
+
+        Args:
+            keys (List[tuple]): node keys as (label, key values)
+
+        Returns:
+            Dict[str, List[dict]]: rows by label
+        """
+        groups = {}
+        for label, values in keys:
+            row = dict(zip(NODE_KEYS[label], values))
+            groups.setdefault(label, []).append(row)
+        return groups
+
+    @staticmethod
+    def _group_edges(keys: List[tuple]) -> Dict[tuple, List[dict]]:
+        """Groups edge keys by type and labels and converts them to rows.
+
+        Args:
+            keys (List[tuple]): edge keys as (edge name, label, key values, label, key values)
+
+        Returns:
+            Dict[tuple, List[dict]]: rows by (edge name, label, label)
+        """
+        groups = {}
+        for edge_name, label1, values1, label2, values2 in keys:
+            row = {'node1': dict(zip(NODE_KEYS[label1], values1)),
+                   'node2': dict(zip(NODE_KEYS[label2], values2))}
+            groups.setdefault((edge_name, label1, label2), []).append(row)
+        return groups
+
+    def _batches(self, rows: list):
+        """Splits rows into chunks of the configured batch size.
+
+        Args:
+            rows (list): rows to split
+
+        Yields:
+            list: at most batch_size rows
+        """
+        for start in range(0, len(rows), self.batch_size):
+            yield rows[start:start + self.batch_size]
@@ -0,0 +1,413 @@
+"""This module evaluates the rules of the rule engine with NumPy instead of a loop over
+    the hosts. The features of every host are columns of arrays which are updated with
+    each session of the sessionizer:
+
+    - live sessions, the held sessions of the idle rules
+    - active connections of the graph, set from the rows of each pass
+    - sum of the open times of the live sessions, the mean idle time is now minus the
+      sum divided by the live sessions
+    - sessions opened in the current and the previous window, the connect rate is
+      approximated as sliding window from both
+    - the IPv4 address, grouped by the prefix of the subnet rules
+
+    A pass computes the values of all rules on the whole columns, compares them with
+    the thresholds and only converts the offending hosts back to ip addresses. It takes
+    milliseconds for a million hosts, see the example at the end.
+
+    The rules are the same as for the rule engine with two approximations: a
+    connection_rate rule uses the sliding window of the first rate rule scaled to its
+    window and an idle_hold rule matches if the host has more live sessions than the
+    threshold and their mean idle time is above min_seconds. Like in the rule engine the
+    count_threshold and subnet rules count the active connections of the graph, so
+    blocked and notified hosts are left out and the counts survive a restart, and the
+    other rules only know the sessions opened after the detection observes the
+    sessionizer. Without rows the live sessions are counted instead.
+
+    Adapted from:
+    https://blog.cloudflare.com/counting-things-a-lot-of-different-things/
+    [last accessed June 2022]
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from beartype import beartype
+
+from compact_state import IPV6_FLAG, int_to_ip, ip_from_key, ip_key
+from connection_sessionizer import ConnectionSessionizer, SessionEvent
+from rule_engine import Finding, Rule, RuleEngine
+
+INITIAL_CAPACITY = 1024
+# Window of the connect rate if no connection_rate rule is configured
+DEFAULT_WINDOW_SECONDS = 60
+
+
+class HostFeatures:
+    """The feature columns of all hosts, a host is a row in the order it was first seen.
+    """
+
+    def __init__(self, window_seconds: int = DEFAULT_WINDOW_SECONDS, capacity: int = INITIAL_CAPACITY):
+        """Creates empty columns.
+
+        Args:
+            window_seconds (int): length of the window of the connect rate
+            capacity (int): rows allocated up front, the columns double when full
+        """
+        self.window_seconds = window_seconds
+        self.index = {}
+        self.keys = []
+        self.size = 0
+        self.now = None
+        self.window_start = None
+        # The active connections are the live sessions until the graph counts are set
+        self.graph_counts = False
+        # -1 for addresses which are no IPv4 address
+        self.ipv4 = np.full(capacity, -1, dtype=np.int64)
+        self.live = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.opened_sum = np.zeros(capacity, dtype=np.float64)
+        self.opened_current = np.zeros(capacity, dtype=np.int64)
+        self.opened_previous = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def row(self, key) -> int:
+        """Returns the row of a host, a new host gets the next row.
+
+        Args:
+            key: the address as key of compact_state.ip_key
+
+        Returns:
+            int: the row
+        """
+        row = self.index.get(key)
+        if row is None:
+            if self.size == len(self.live):
+                self._grow()
+            row = self.index[key] = self.size
+            self.keys.append(key)
+            if isinstance(key, int) and not key & IPV6_FLAG:
+                self.ipv4[row] = key
+            self.size += 1
+        return row
+
+    def add_session(self, key, opened: int, now: int):
+        """Counts an opened session.
+
+        Args:
+            key: the address of the client
+            opened (int): log timestamp of the accepted socket
+            now (int): log timestamp of the event
+        """
+        self.advance(now)
+        row = self.row(key)
+        self.live[row] += 1
+        self.opened_sum[row] += opened
+        self.opened_current[row] += 1
+
+    def remove_session(self, key, opened: int, now: int):
+        """Removes a closed session.
+
+        Args:
+            key: the address of the client
+            opened (int): log timestamp of the accepted socket
+            now (int): log timestamp of the event
+        """
+        self.advance(now)
+        row = self.index.get(key)
+        if row is not None and self.live[row] > 0:
+            self.live[row] -= 1
+            self.opened_sum[row] -= opened
+
+    def set_counts(self, keys: Optional[list], counts: Optional[list]):
+        """Replaces the active connections by the counts of the graph, hosts which are
+        not given have none.
+
+        Args:
+            keys (list, optional): addresses of the hosts as keys of compact_state.ip_key,
+            the live sessions are counted if not set
+            counts (list, optional): active connections of the hosts
+        """
+        self.graph_counts = keys is not None
+        if keys is None:
+            return
+        rows = [self.row(key) for key in keys]
+        self.counts[:] = 0
+        self.counts[rows] = counts
+
+    def active(self) -> np.ndarray:
+        """Returns the active connections of each host.
+        """
+        return (self.counts if self.graph_counts else self.live)[:self.size]
+
+    def connect_rate(self) -> np.ndarray:
+        """Returns the sessions opened per host within the last window, the previous
+        window is weighted by the part which overlaps the last window.
+        """
+        if self.now is None:
+            return np.zeros(self.size)
+        overlap = 1.0 - (self.now - self.window_start) / self.window_seconds
+        return self.opened_current[:self.size] + overlap * self.opened_previous[:self.size]
+
+    def mean_idle(self) -> np.ndarray:
+        """Returns the mean seconds the live sessions of each host are open.
+        """
+        live = self.live[:self.size]
+        if self.now is None:
+            return np.zeros(self.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(live > 0, self.now - self.opened_sum[:self.size] / live, 0.0)
+
+    def advance(self, now: int):
+        """Moves the windows of the connect rate to the time of an event.
+
+        Args:
+            now (int): log timestamp of the event
+        """
+        self.now = now if self.now is None else max(self.now, now)
+        if self.window_start is None:
+            self.window_start = self.now
+        elapsed = (self.now - self.window_start) // self.window_seconds
+        if elapsed == 1:
+            self.opened_previous, self.opened_current = self.opened_current, self.opened_previous
+            self.opened_current[:] = 0
+        elif elapsed > 1:
+            self.opened_previous[:] = 0
+            self.opened_current[:] = 0
+        self.window_start += elapsed * self.window_seconds
+
+    def _grow(self):
+        """Doubles the capacity of all columns.
+        """
+        capacity = 2 * len(self.live)
+        for name in ('live', 'counts', 'opened_sum', 'opened_current', 'opened_previous'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+        ipv4 = np.full(capacity, -1, dtype=np.int64)
+        ipv4[:len(self.ipv4)] = self.ipv4
+        self.ipv4 = ipv4
+
+
+def graph_counts(rows: list) -> Tuple[list, list]:
+    """Splits the rows of count_active_connections_per_host into the keys of the hosts
+    and their counts.
+
+    Args:
+        rows (list): result of count_active_connections_per_host
+
+    Returns:
+        Tuple[list, list]: addresses as keys of compact_state.ip_key and the counts
+    """
+    return [ip_key(row['h']['ip_address']) for row in rows], [row['count'] for row in rows]
+
+
+class VectorizedDetection:
+    """Evaluates the rules on the feature columns, it can replace the rule engine of the
+    network monitoring.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        """Creates the detection.
+
+        Args:
+            rules (List[Rule]): the rules in the order their findings are returned
+        """
+        self.rules = rules
+        window_seconds = [rule.parameters['window_seconds'] for rule in rules if rule.rule_type == 'connection_rate']
+        self.features = HostFeatures(window_seconds[0] if window_seconds else DEFAULT_WINDOW_SECONDS)
+        self.reported = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    @beartype
+    def from_file(cls, file_path: Optional[str] = None) -> 'VectorizedDetection':
+        """Reads the rules file of the rule engine.
+
+        Args:
+            file_path (str, optional): path to the json file, IDS_DETECTION_RULES or the
+            default rules if not set
+
+        Returns:
+            VectorizedDetection: the detection with the rules of the file
+        """
+        return cls(RuleEngine.from_file(file_path).rules)
+
+    @beartype
+    def observe(self, sessionizer: ConnectionSessionizer):
+        """Updates the features with the sessions of the sessionizer.
+
+        Args:
+            sessionizer (ConnectionSessionizer): the sessionizer of the log transformation
+        """
+        sessionizer.add_listener(self.process_event)
+
+    @beartype
+    def process_event(self, event: SessionEvent):
+        """Counts an opened or closed session.
+
+        Args:
+            event (SessionEvent): event of the sessionizer
+        """
+        session = event.session
+        with self._lock:
+            if event.kind == 'opened':
+                self.features.add_session(session.address, session.opened, session.connected)
+            else:
+                self.features.remove_session(session.address, session.opened, event.closed)
+
+    def offending_rows(self) -> Dict[str, np.ndarray]:
+        """Computes the values of all rules and returns the rows above the thresholds.
+
+        Returns:
+            Dict[str, np.ndarray]: rows of the offending hosts per host rule and the
+            addresses of the offending networks per subnet rule
+        """
+        return {name: rows for name, (rows, _) in self._offending().items()}
+
+    def matching(self) -> Dict[str, List[Tuple[str, float]]]:
+        """Evaluates all rules and returns every subject above the threshold.
+
+        Returns:
+            Dict[str, List[Tuple[str, float]]]: subject and value per rule name
+        """
+        with self._lock:
+            offending = self._offending()
+            keys = self.features.keys
+            values = {}
+            for rule in self.rules:
+                rows, rule_values = offending[rule.name]
+                if rule.rule_type == 'subnet':
+                    subjects = [int_to_ip(network) + '/' + str(rule.parameters['prefix_length'])
+                                for network in rows.tolist()]
+                else:
+                    subjects = [ip_from_key(keys[row]) for row in rows.tolist()]
+                values[rule.name] = list(zip(subjects, rule_values.tolist()))
+        return values
+
+    def network_totals(self, prefix_length: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Sums the live sessions of the IPv4 hosts per prefix.
+
+        Args:
+            prefix_length (int): length of the prefix
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: the prefixes (address shifted by the host
+            bits) and their sums, prefixes without hosts may have a sum of zero
+        """
+        with self._lock:
+            return self._network_totals(prefix_length, {})
+
+    def evaluate(self, rows: Optional[list] = None) -> List[Finding]:
+        """Evaluates all rules and returns the findings which were not reported yet.
+
+        Args:
+            rows (list, optional): result of count_active_connections_per_host of this
+            pass, the live sessions are counted if not set
+
+        Returns:
+            List[Finding]: the new findings, ordered by rule
+        """
+        keys, counts = graph_counts(rows) if rows is not None else (None, None)
+        with self._lock:
+            self.features.set_counts(keys, counts)
+        values = self.matching()
+        findings = []
+        matching = set()
+        for rule in self.rules:
+            for subject, value in values[rule.name]:
+                matching.add((rule.name, subject))
+                if (rule.name, subject) not in self.reported:
+                    findings.append(Finding(rule, subject, int(round(value))))
+        self.reported = matching
+        return findings
+
+    def _offending(self) -> Dict[str, tuple]:
+        """Returns the offending rows, or networks, and their values per rule name.
+        Columns needed by several rules are computed once.
+        """
+        features = self.features
+        size = len(features)
+        live = features.live[:size]
+        active = features.active()
+        columns = {}
+        offending = {}
+        for rule in self.rules:
+            if rule.rule_type == 'subnet':
+                offending[rule.name] = self._offending_networks(rule, columns)
+                continue
+            if rule.rule_type == 'count_threshold':
+                values = active
+                mask = active > rule.threshold
+            elif rule.rule_type == 'connection_rate':
+                if 'rate' not in columns:
+                    columns['rate'] = features.connect_rate()
+                values = columns['rate'] * (rule.parameters['window_seconds'] / features.window_seconds)
+                mask = values > rule.threshold
+            else:
+                if 'idle' not in columns:
+                    columns['idle'] = features.mean_idle()
+                values = live
+                mask = (live > rule.threshold) & (columns['idle'] > rule.parameters['min_seconds'])
+            rows = np.flatnonzero(mask)
+            offending[rule.name] = (rows, values[rows])
+        return offending
+
+    def _offending_networks(self, rule: Rule, columns: dict) -> tuple:
+        """Sums the live sessions per prefix and returns the address and the sum of
+        every network above the threshold.
+        """
+        prefix_length = rule.parameters['prefix_length']
+        networks, totals = self._network_totals(prefix_length, columns)
+        mask = totals > rule.threshold
+        return networks[mask] << (32 - prefix_length), totals[mask]
+
+    def _network_totals(self, prefix_length: int, columns: dict) -> tuple:
+        """Returns the prefixes and the sum of their live sessions, cached in columns.
+        """
+        key = 'network' + str(prefix_length)
+        if key not in columns:
+            size = len(self.features)
+            ipv4 = self.features.ipv4[:size]
+            rows = np.flatnonzero(ipv4 >= 0)
+            networks = ipv4[rows] >> (32 - prefix_length)
+            live = self.features.active()[rows]
+            if not len(rows):
+                columns[key] = (networks, live)
+            elif networks.max() - networks.min() < max(4 * len(rows), 1 << 16):
+                # The networks of a cluster are close to each other, counting is cheaper than sorting
+                offset = networks.min()
+                totals = np.bincount(networks - offset, weights=live)
+                columns[key] = (np.arange(len(totals), dtype=np.int64) + offset, totals)
+            else:
+                networks, inverse = np.unique(networks, return_inverse=True)
+                columns[key] = (networks, np.bincount(inverse, weights=live, minlength=len(networks)))
+        return columns[key]
+
+
+if __name__ == '__main__':
+    import time
+
+    example_detection = VectorizedDetection.from_file()
+    example_features = example_detection.features
+    example_hosts = 1000000
+    # Fills the columns directly, a million hosts of 10.0.0.0/8 with 1 to 5 sessions
+    example_features.ipv4 = np.arange(example_hosts, dtype=np.int64) + (10 << 24)
+    example_features.keys = example_features.ipv4.tolist()
+    example_features.size = example_hosts
+    example_features.live = np.random.default_rng(0).integers(1, 6, example_hosts)
+    example_features.live[12345] = 80
+    example_features.opened_sum = example_features.live * 1635015000.0
+    example_features.opened_current = example_features.live.copy()
+    example_features.opened_previous = np.zeros(example_hosts, dtype=np.int64)
+    example_features.now = example_features.window_start = 1635015162
+    example_start = time.perf_counter()
+    example_rows = example_detection.offending_rows()
+    print(f'{example_hosts} hosts in {(time.perf_counter() - example_start) * 1000:.1f} ms',
+          {name: len(rows) for name, rows in example_rows.items()})
+    print([finding.message for finding in example_detection.evaluate()][:3])
@@ -0,0 +1,621 @@
+"""This module decouples the ingest from the availability of the graph storage. Every
+    mutation is appended as a json line to a local spool before it is applied, the
+    ingest continues while neo4j restarts or stalls. A replayer thread applies the
+    spooled mutations in batches and only moves its checkpoint after a batch was
+    applied, so nothing is lost if the database fails in between. Consecutive
+    mutations of a batch are written with one write_batch of the storage.
+
+    The spool is a directory of segment files which are deleted once they were
+    replayed. A batch may be applied twice if the process dies before its checkpoint
+    is written, so the mutations are replayed idempotent: nodes are upserted, edges
+    merged and properties set. With the spool a reconnect of a client with the same
+    name therefore reuses the STARTS_CONNECTION edge instead of adding a second one.
+
+    Only transient failures of the storage, like a restarting neo4j or a locked sqlite
+    file, are retried. A mutation which fails for another reason, e.g. an unknown
+    method or a value the storage rejects, would fail on every retry, so it is moved to
+    the dead letter file of the spool and the replay continues with the next one.
+
+    The spool is enabled by setting IDS_SPOOL_DIR to the directory of the segments.
+
+    Author: Thorsten Steuer
+    Licence: Apache 2.0
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from beartype import beartype
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+
+from graph_storage import GraphStorage
+from metrics_endpoint import METRICS
+from neo4j_database_access import BATCH_TRANSACTIONS
+from stage_timing import STAGE_TIMING
+
+SPOOL_DIR_VARIABLE = 'IDS_SPOOL_DIR'
+SEGMENT_BYTES = 16 * 1024 * 1024
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
+CHECKPOINT_FILE = 'checkpoint.json'
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+REPLAY_BATCH_SIZE = 5000
+RETRY_SECONDS = 0.5
+MAX_RETRY_SECONDS = 30.0
+BLOCKED_HOSTS_REFRESH_SECONDS = 1.0
+# Method of the storage each spooled mutation is replayed with
+REPLAY_METHODS = {'create_host': 'upsert_host',
+                  'upsert_host': 'upsert_host',
+                  'create_connection': 'upsert_connection',
+                  'upsert_connection': 'upsert_connection',
+                  'create_edge': 'merge_edge',
+                  'merge_edge': 'merge_edge',
+                  'create_unique_property_constraint': 'create_unique_property_constraint',
+                  'update_connection_status': 'update_connection_status',
+                  'update_connnection_time': 'update_connnection_time',
+                  'update_and_return_host_block': 'update_and_return_host_block',
+                  'update_and_return_host_notification_sent': 'update_and_return_host_notification_sent',
+                  'update_host_ip_address': 'update_host_ip_address',
+                  'update_service_version': 'update_service_version',
+                  'update_service_port': 'update_service_port'}
+
+SPOOLED = METRICS.counter('ids_spool_appended_total', 'Mutations appended to the spool')
+REPLAYED = METRICS.counter('ids_spool_replayed_total', 'Spooled mutations applied to the storage')
+REPLAY_ERRORS = METRICS.counter('ids_spool_replay_errors_total', 'Failed attempts to apply a spooled batch')
+DEAD_LETTERS = METRICS.counter('ids_spool_dead_letters_total', 'Spooled mutations moved to the dead letter file')
+
+
+def is_transient(exception: Exception) -> bool:
+    """Checks if a failed mutation can succeed when it is applied again.
+
+    Args:
+        exception (Exception): the error of the storage
+
+    Returns:
+        bool: True if the storage was unavailable, False if the mutation itself failed
+    """
+    if isinstance(exception, sqlite3.OperationalError):
+        return 'locked' in str(exception) or 'busy' in str(exception)
+    return isinstance(exception, (ServiceUnavailable, SessionExpired, TransientError, OSError))
+
+
+class SpooledGraphStorage(GraphStorage):
+    """Spools the mutations of a storage and replays them in a daemon thread. Reads go
+    to the storage, except the checks of the ingest which are answered locally.
+    """
+
+    @beartype
+    def __init__(self, graph_storage: GraphStorage, spool_directory: str,
+                 segment_bytes: int = SEGMENT_BYTES, batch_size: int = REPLAY_BATCH_SIZE):
+        """Opens a new segment in the spool directory, segments of an earlier run are
+        replayed first.
+
+        Args:
+            graph_storage (GraphStorage): the storage the mutations are applied to
+            spool_directory (str): directory of the segments and the checkpoint
+            segment_bytes (int): size after which a new segment is started
+            batch_size (int): number of mutations applied before the checkpoint is moved
+        """
+        self.graph_storage = graph_storage
+        self.spool_directory = spool_directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.blocked_hosts = set()
+        self.constraints = set()
+        self.replay_status = True
+        os.makedirs(spool_directory, exist_ok=True)
+        segments = self._segments()
+        self.checkpoint = self._load_checkpoint(segments)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._segment_number = segments[-1] + 1 if segments else 0
+        self._segment_file = open(self._segment_path(self._segment_number), 'a', encoding='utf-8')
+        self._segment_size = 0
+        try:
+            self.blocked_hosts = set(graph_storage.get_blocked_hosts())
+        # The storage may be down at startup, the hosts are read again by the replayer
+        except Exception as exception:  # pylint: disable=broad-except
+            logging.error('Reading the blocked hosts raised an error: \n %s', exception)
+        METRICS.gauge('ids_spool_pending_bytes', 'Bytes of the spool which were not replayed yet',
+                      function=self.pending_bytes)
+        STAGE_TIMING.instrument(self, 'spool.')
+
+    def start(self):
+        """Starts the replayer in a daemon thread.
+        """
+        self._thread = threading.Thread(target=self._replay, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stops the replayer after it drained the spool or the timeout passed.
+
+        Args:
+            timeout (float, optional): seconds to wait for the replayer
+        """
+        self.replay_status = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def close(self):
+        """Stops the replayer and closes the spool and the storage.
+        """
+        self.stop(MAX_RETRY_SECONDS)
+        with self._lock:
+            self._segment_file.close()
+        self.graph_storage.close()
+
+    def pending_bytes(self) -> int:
+        """Returns the size of the mutations which were not replayed yet.
+
+        Returns:
+            int: bytes of the segments after the checkpoint
+        """
+        segment, offset = self.checkpoint
+        total = 0
+        for number in self._segments():
+            if number >= segment:
+                try:
+                    total += os.path.getsize(self._segment_path(number))
+                except OSError:
+                    continue
+        return max(0, total - offset)
+
+    def _append(self, method_name: str, *args):
+        """Appends a mutation to the current segment and wakes up the replayer.
+        """
+        line = json.dumps([method_name] + list(args), separators=(',', ':')) + '\n'
+        with self._lock:
+            self._segment_file.write(line)
+            self._segment_file.flush()
+            self._segment_size += len(line)
+            if self._segment_size >= self.segment_bytes:
+                os.fsync(self._segment_file.fileno())
+                self._segment_file.close()
+                self._segment_number += 1
+                self._segment_file = open(self._segment_path(self._segment_number), 'a', encoding='utf-8')
+                self._segment_size = 0
+        SPOOLED.inc()
+        self._wakeup.set()
+
+    def _replay(self):
+        """Applies the spooled mutations until stopped and the spool is drained.
+        """
+        retry_seconds = RETRY_SECONDS
+        last_refresh = 0.0
+        while True:
+            try:
+                applied = self._replay_batch()
+                retry_seconds = RETRY_SECONDS
+            # Only transient failures get here, the mutations stay in the spool
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.error('Replaying the spool raised an error: \n %s', exception)
+                REPLAY_ERRORS.inc()
+                time.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+                continue
+            if applied:
+                continue
+            if not self.replay_status:
+                return
+            if time.monotonic() - last_refresh >= BLOCKED_HOSTS_REFRESH_SECONDS:
+                last_refresh = time.monotonic()
+                self._refresh_blocked_hosts()
+            self._wakeup.wait(BLOCKED_HOSTS_REFRESH_SECONDS)
+            self._wakeup.clear()
+
+    def _replay_batch(self) -> int:
+        """Applies up to one batch of mutations after the checkpoint and moves it.
+
+        Returns:
+            int: number of applied mutations, 0 if the spool is drained
+        """
+        segment, offset = self.checkpoint
+        path = self._segment_path(segment)
+        if not os.path.exists(path):
+            return self._next_segment(segment)
+        lines = []
+        with open(path, 'r', encoding='utf-8') as segment_file:
+            segment_file.seek(offset)
+            while len(lines) < self.batch_size:
+                line = segment_file.readline()
+                # A line without newline is still being written
+                if not line.endswith('\n'):
+                    break
+                lines.append(line)
+                offset = segment_file.tell()
+        if not lines:
+            return self._next_segment(segment)
+        self._apply(lines)
+        REPLAYED.inc(len(lines))
+        self._save_checkpoint(segment, offset)
+        return len(lines)
+
+    def _apply(self, lines: List[str]):
+        """Applies spooled mutations with their idempotent methods. Consecutive
+        mutations the storages can write in one transaction are written together.
+        """
+        run = []
+        for line in lines:
+            try:
+                method_name, *args = json.loads(line)
+                replay_method = REPLAY_METHODS[method_name]
+            except (ValueError, KeyError) as exception:
+                self._dead_letter(line, exception)
+                continue
+            if replay_method in BATCH_TRANSACTIONS:
+                run.append((line, replay_method, args))
+                continue
+            self._apply_run(run)
+            run = []
+            self._apply_one(line, replay_method, args)
+        self._apply_run(run)
+
+    def _apply_run(self, run: list):
+        """Writes a run of mutations in one batch, if it fails the mutations are applied
+        one by one to find the ones which can never be applied.
+        """
+        if not run:
+            return
+        try:
+            self.graph_storage.write_batch([(replay_method, tuple(args)) for _, replay_method, args in run])
+        # The batch is rolled back, applying its mutations again is idempotent
+        except Exception as exception:  # pylint: disable=broad-except
+            if is_transient(exception):
+                raise
+            for line, replay_method, args in run:
+                self._apply_one(line, replay_method, args)
+
+    def _apply_one(self, line: str, replay_method: str, args: list):
+        """Applies one mutation, it is moved to the dead letter file if it fails for
+        another reason than the availability of the storage.
+        """
+        try:
+            if replay_method == 'create_unique_property_constraint' and \
+                    self.graph_storage.check_if_constraint_exists(*args):
+                return
+            getattr(self.graph_storage, replay_method)(*args)
+        # A mutation which fails on every retry must not stall the replay
+        except Exception as exception:  # pylint: disable=broad-except
+            if is_transient(exception):
+                raise
+            self._dead_letter(line, exception)
+
+    def _dead_letter(self, line: str, exception: Exception):
+        """Moves a mutation which can not be applied to the dead letter file, together
+        with its error.
+        """
+        logging.error('Moving the spool line %s to the dead letter file, it raised an error: \n %s',
+                      line.rstrip('\n'), exception)
+        with open(os.path.join(self.spool_directory, DEAD_LETTER_FILE), 'a', encoding='utf-8') as dead_letter_file:
+            dead_letter_file.write(json.dumps({'line': line.rstrip('\n'), 'error': repr(exception)},
+                                              separators=(',', ':')) + '\n')
+        DEAD_LETTERS.inc()
+
+    def _next_segment(self, segment: int) -> int:
+        """Deletes a replayed segment if the writer moved on and continues with the next.
+
+        Returns:
+            int: 1 if the checkpoint moved to the next segment, 0 otherwise
+        """
+        with self._lock:
+            current = self._segment_number
+        if segment >= current:
+            return 0
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        self._save_checkpoint(segment + 1, 0)
+        return 1
+
+    def _refresh_blocked_hosts(self):
+        """Reads the blocked hosts from the storage once all mutations are applied, e.g.
+        to see the blocks of the network monitoring.
+        """
+        if self.pending_bytes() > 0:
+            return
+        try:
+            self.blocked_hosts = set(self.graph_storage.get_blocked_hosts())
+        # Keep the last known hosts while the storage is down
+        except Exception as exception:  # pylint: disable=broad-except
+            logging.error('Reading the blocked hosts raised an error: \n %s', exception)
+
+    def _segments(self) -> List[int]:
+        """Returns the numbers of the segments in the spool directory in order.
+        """
+        numbers = []
+        for file_name in os.listdir(self.spool_directory):
+            if file_name.startswith(SEGMENT_PREFIX) and file_name.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(file_name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+
+    def _segment_path(self, number: int) -> str:
+        """Returns the path of a segment.
+        """
+        return os.path.join(self.spool_directory, f'{SEGMENT_PREFIX}{number:012d}{SEGMENT_SUFFIX}')
+
+    def _load_checkpoint(self, segments: List[int]) -> tuple:
+        """Reads the segment and offset which were replayed last.
+        """
+        try:
+            with open(os.path.join(self.spool_directory, CHECKPOINT_FILE), 'r', encoding='utf-8') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            return checkpoint['segment'], checkpoint['offset']
+        except (OSError, ValueError, KeyError):
+            return (segments[0] if segments else 0), 0
+
+    def _save_checkpoint(self, segment: int, offset: int):
+        """Writes the checkpoint atomically by replacing the file.
+        """
+        path = os.path.join(self.spool_directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'segment': segment, 'offset': offset}, checkpoint_file)
+        os.replace(path + '.tmp', path)
+        self.checkpoint = (segment, offset)
+
+    @beartype
+    def create_host(self, host_json: str):
+        """Spools the creation of a host.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._append('create_host', host_json)
+
+    @beartype
+    def upsert_host(self, host_json: str):
+        """Spools the creation of a host if it does not exist.
+
+        Args:
+            host_json (str): data of the host in json format
+        """
+        self._append('upsert_host', host_json)
+
+    @beartype
+    def create_connection(self, connection_json: str):
+        """Spools the creation of a connection.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._append('create_connection', connection_json)
+
+    @beartype
+    def upsert_connection(self, connection_json: str):
+        """Spools the creation of a connection if it does not exist.
+
+        Args:
+            connection_json (str): data of the connection in json format.
+        """
+        self._append('upsert_connection', connection_json)
+
+    @beartype
+    def create_service(self, service_json: str):
+        """Creates a service right away, services are only created by the setup.
+
+        Args:
+            service_json (str): data of the service in json format.
+        """
+        self.graph_storage.create_service(service_json)
+
+    @beartype
+    def create_edge(self, edge_data: str):
+        """Spools the creation of an edge.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._append('create_edge', edge_data)
+
+    @beartype
+    def merge_edge(self, edge_data: str):
+        """Spools the creation of an edge if the nodes are not connected yet.
+
+        Args:
+            edge_data (str): data of the edge in json format.
+        """
+        self._append('merge_edge', edge_data)
+
+    @beartype
+    def create_unique_property_constraint(self, node_name: str, property_names: List[str]):
+        """Spools the creation of a constraint.
+
+        Args:
+            node_name (str): name of the node the constraint should be applied on.
+            property_names (List[str]): names of the properties of the constraint.
+        """
+        self.constraints.add((node_name, tuple(property_names)))
+        self._append('create_unique_property_constraint', node_name, property_names)
+
+    @beartype
+    def check_if_node_exists(self, node_name: str, property_name: str, property_value) -> bool:
+        """Checks the storage if a node exists, nodes which are still spooled are not
+        found.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_name (str): name of the property.
+            property_value ([type]): value of the property.
+
+        Returns:
+            bool: True if node exists False otherwise.
+        """
+        return self.graph_storage.check_if_node_exists(node_name, property_name, property_value)
+
+    @beartype
+    def check_if_constraint_exists(self, node_name: str, property_names: List[str]) -> bool:
+        """Checks if a constraint was spooled before or exists in the storage.
+
+        Args:
+            node_name (str): name of the node type to check.
+            property_names (List[str]): names of the properties of the constraint.
+
+        Returns:
+            bool: True if the constraint exists False otherwise
+        """
+        if (node_name, tuple(property_names)) in self.constraints:
+            return True
+        try:
+            exists = self.graph_storage.check_if_constraint_exists(node_name, property_names)
+        # The constraint is spooled and replayed only if it is missing
+        except Exception as exception:  # pylint: disable=broad-except
+            logging.error('Checking the constraint raised an error: \n %s', exception)
+            return False
+        if exists:
+            self.constraints.add((node_name, tuple(property_names)))
+        return exists
+
+    @beartype
+    def check_if_host_is_blocked(self, ip_address: str) -> bool:
+        """Checks the blocked hosts known locally, they are read from the storage
+        whenever the spool is drained.
+
+        Args:
+            ip_address (str): ip address of host to verify
+
+        Returns:
+            bool: True if host is currently blocked
+        """
+        return ip_address in self.blocked_hosts
+
+    @beartype
+    def update_connection_status(self, connection_name: str, status: str):
+        """Spools the status update of a connection.
+
+        Args:
+            connection_name (str): name of the connection to be updated
+            status (str): status to be set for the connection
+        """
+        self._append('update_connection_status', connection_name, status)
+
+    @beartype
+    def update_connnection_time(self, connection_name: str, time: str):
+        """Spools the time update of a connection.
+
+        Args:
+            connection_name (str): name of the connection
+            time (str): the timestamp to set
+        """
+        self._append('update_connnection_time', connection_name, time)
+
+    @beartype
+    def update_and_return_host_block(self, ip_address: str, is_blocked: str):
+        """Spools the block status update of a host.
+
+        Args:
+            ip_address (str): ip_address of the host to be blocked
+            is_blocked (str): state of the block status (True/False)
+        """
+        if is_blocked == 'True':
+            self.blocked_hosts.add(ip_address)
+        else:
+            self.blocked_hosts.discard(ip_address)
+        self._append('update_and_return_host_block', ip_address, is_blocked)
+
+    @beartype
+    def update_and_return_host_notification_sent(self, ip_address: str, sent: str):
+        """Spools the notification status update of a host.
+
+        Args:
+            ip_address (str): ip_address of the host
+            sent (str): state of the notification status (True/False)
+        """
+        self._append('update_and_return_host_notification_sent', ip_address, sent)
+
+    @beartype
+    def update_host_ip_address(self, old_ip_address: str, new_ip_address: str):
+        """Spools the ip address update of a host.
+
+        Args:
+            old_ip_address (str): current ip address of the host
+            new_ip_address (str): ip address to be set
+        """
+        self._append('update_host_ip_address', old_ip_address, new_ip_address)
+
+    @beartype
+    def update_service_version(self, service_name: str, version: str):
+        """Spools the version update of a service.
+
+        Args:
+            service_name (str): name of the service
+            version (str): version of the service
+        """
+        self._append('update_service_version', service_name, version)
+
+    @beartype
+    def update_service_port(self, service_name: str, port: str):
+        """Spools the port update of a service.
+
+        Args:
+            service_name (str): name of the service
+            port (str): port of the service
+        """
+        self._append('update_service_port', service_name, port)
+
+    def count_active_connections_per_host(self):
+        """Counts the active connections in the storage, mutations which are still
+        spooled are not counted.
+
+        Returns:
+            result (list): a list of dictonaries with the host properties as h and the
+            number of active connections as count
+        """
+        return self.graph_storage.count_active_connections_per_host()
+
+    def get_blocked_hosts(self):
+        """Returns the ip addresses of all blocked hosts of the storage.
+
+        Returns:
+            List[str]: the ip addresses
+        """
+        return self.graph_storage.get_blocked_hosts()
+
+
+@beartype
+def spool_from_environment(graph_storage: GraphStorage, name: Optional[str] = None) -> GraphStorage:
+    """Wraps the storage with a started spool if IDS_SPOOL_DIR is set.
+
+    Args:
+        graph_storage (GraphStorage): the storage of the ingest
+        name (str, optional): subdirectory of the spool, every writer needs its own
+        segments and checkpoint, e.g. the workers of the partitioned ingest
+
+    Returns:
+        GraphStorage: the spooled storage or the storage itself
+    """
+    spool_directory = os.environ.get(SPOOL_DIR_VARIABLE)
+    if not spool_directory:
+        return graph_storage
+    if name is not None:
+        spool_directory = os.path.join(spool_directory, name)
+    spooled_storage = SpooledGraphStorage(graph_storage, spool_directory)
+    spooled_storage.start()
+    print(f'Spooling graph writes to {spool_directory}')
+    return spooled_storage
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from in_memory_database_access import InMemoryDatabaseAccess
+
+    with tempfile.TemporaryDirectory() as example_directory:
+        example_storage = SpooledGraphStorage(InMemoryDatabaseAccess(), example_directory)
+        example_storage.start()
+        example_storage.upsert_host(json.dumps({'ip_address': '127.0.0.1', 'creation_time': '1635015162',
+                                                'is_blocked': 'False', 'notification_sent': 'False'}))
+        example_storage.upsert_connection(json.dumps({'status': 'active', 'name': 'mqtt-explorer-0a61e6f1',
+                                                      'last_update_time': '1635015162'}))
+        example_storage.create_edge(json.dumps({'edge_name': 'STARTS_CONNECTION',
+                                                'node1': {'name': 'Host', 'property_names': ['ip_address'],
+                                                          'property_values': ['127.0.0.1']},
+                                                'node2': {'name': 'Connection', 'property_names': ['name'],
+                                                          'property_values': ['mqtt-explorer-0a61e6f1']}}))
+        example_storage.close()
+        print(example_storage.count_active_connections_per_host())